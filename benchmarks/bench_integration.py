@@ -0,0 +1,73 @@
+# Benchmark of the TSDF integration backends on a reconstructed dataset.
+# Integrates the frames of scene/trajectory.log (written by integrate_scene)
+# with the legacy ScalableTSDFVolume and the tensor VoxelBlockGrid, after
+# decoding all frames up front so that only integration and extraction are
+# timed.
+#
+#   python -m benchmarks.bench_integration [--config config/realsense.json]
+#                                          [--frames 100]
+
+import argparse
+import json
+import time
+
+import open3d as o3d
+
+from src.frame_cache import RGBDFrameCache
+from src.initialize_config import initialize_config
+from src.integration_backend import make_integrator
+from src.open3d_example import join, get_rgbd_file_lists, read_poses_from_log
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config/realsense.json")
+    parser.add_argument("--frames", type=int, default=0,
+                        help="integrate only the first frames, 0 for all")
+    args = parser.parse_args()
+
+    with open(args.config) as json_file:
+        config = json.load(json_file)
+        initialize_config(config)
+    if config["path_intrinsic"]:
+        intrinsic = o3d.io.read_pinhole_camera_intrinsic(
+            config["path_intrinsic"])
+    else:
+        intrinsic = o3d.camera.PinholeCameraIntrinsic(
+            o3d.camera.PinholeCameraIntrinsicParameters.PrimeSenseDefault)
+
+    [color_files, depth_files] = get_rgbd_file_lists(config["path_dataset"])
+    poses = list(
+        enumerate(
+            read_poses_from_log(
+                join(config["path_dataset"], config["template_global_traj"]))))
+    if args.frames > 0:
+        poses = poses[:args.frames]
+    frames = RGBDFrameCache(color_files, depth_files, config,
+                            max_bytes=1 << 62)
+    for (index, _) in poses:
+        frames.get_raw(index)
+        frames.get(index, False)
+
+    print("%d frames" % len(poses))
+    print("%8s %12s %14s %14s %10s" %
+          ("backend", "setup [s]", "integrate [s]", "extract [s]",
+           "vertices"))
+    for backend in ["legacy", "tensor"]:
+        config["integration_backend"] = backend
+        start = time.perf_counter()
+        volume = make_integrator(frames, poses, intrinsic, config)
+        t_setup = time.perf_counter() - start
+        start = time.perf_counter()
+        for (index, pose) in poses:
+            volume.integrate(frames, index, pose)
+        t_integrate = time.perf_counter() - start
+        start = time.perf_counter()
+        mesh = volume.extract_triangle_mesh()
+        t_extract = time.perf_counter() - start
+        print("%8s %12.2f %14.2f %14.2f %10d" %
+              (backend, t_setup, t_integrate, t_extract, len(mesh.vertices)))
+
+
+if __name__ == "__main__":
+    main()
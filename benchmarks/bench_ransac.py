@@ -0,0 +1,124 @@
+# Microbenchmark of the 3D rigid RANSAC used for loop-closure pairs in
+# make_fragments. Compares estimate_3D_transform_RANSAC against the former
+# per-hypothesis implementation on synthetic correspondences.
+#
+#   python -m benchmarks.bench_ransac [--repeat 20]
+
+import argparse
+import copy
+import time
+
+import numpy as np
+
+from src.opencv_pose_estimation import estimate_3D_transform_RANSAC
+
+
+def reference_estimate_3D_transform_RANSAC(pts_xyz_s, pts_xyz_t):
+    max_iter = 1000
+    max_distance = 0.05
+    n_sample = 5
+    n_points = pts_xyz_s.shape[1]
+    Transform_good = np.identity(4)
+    max_inlier = n_sample
+    inlier_vec_good = []
+    success = False
+
+    if n_points < n_sample:
+        return False, np.identity(4), []
+
+    for i in range(max_iter):
+
+        # sampling
+        rand_idx = np.random.randint(n_points, size=n_sample)
+        sample_xyz_s = pts_xyz_s[:, rand_idx]
+        sample_xyz_t = pts_xyz_t[:, rand_idx]
+        R_approx, t_approx = reference_estimate_3D_transform(
+            sample_xyz_s, sample_xyz_t)
+
+        # evaluation
+        diff_mat = pts_xyz_t - (np.matmul(R_approx, pts_xyz_s) +
+                                np.tile(t_approx, [1, n_points]))
+        diff = [np.linalg.norm(diff_mat[:, i]) for i in range(n_points)]
+        n_inlier = len([1 for diff_iter in diff if diff_iter < max_distance])
+
+        if (n_inlier > max_inlier) and (np.linalg.det(R_approx) != 0.0) and \
+                (R_approx[0,0] > 0 and R_approx[1,1] > 0 and R_approx[2,2] > 0):
+            Transform_good[:3, :3] = R_approx
+            Transform_good[:3, 3] = t_approx.squeeze(1)
+            max_inlier = n_inlier
+            inlier_vec = [id_iter for diff_iter, id_iter \
+                    in zip(diff, range(n_points)) \
+                    if diff_iter < max_distance]
+            inlier_vec_good = inlier_vec
+            success = True
+
+    return success, Transform_good, inlier_vec_good
+
+
+def reference_estimate_3D_transform(input_xyz_s, input_xyz_t):
+    xyz_s = copy.copy(input_xyz_s)
+    xyz_t = copy.copy(input_xyz_t)
+    n_points = xyz_s.shape[1]
+    mean_s = np.mean(xyz_s, axis=1)
+    mean_t = np.mean(xyz_t, axis=1)
+    mean_s.shape = (3, 1)
+    mean_t.shape = (3, 1)
+    xyz_diff_s = xyz_s - np.tile(mean_s, [1, n_points])
+    xyz_diff_t = xyz_t - np.tile(mean_t, [1, n_points])
+    H = np.matmul(xyz_diff_s, xyz_diff_t.transpose())
+    U, s, V = np.linalg.svd(H)
+    R_approx = np.matmul(V.transpose(), U.transpose())
+    if np.linalg.det(R_approx) < 0.0:
+        det = np.linalg.det(np.matmul(U, V))
+        D = np.identity(3)
+        D[2, 2] = det
+        R_approx = np.matmul(U, np.matmul(D, V))
+    t_approx = mean_t - np.matmul(R_approx, mean_s)
+    return R_approx, t_approx
+
+
+def make_correspondences(n_points, outlier_ratio, rng):
+    angle = rng.uniform(-0.2, 0.2)
+    R = np.array([[np.cos(angle), 0, np.sin(angle)], [0, 1, 0],
+                  [-np.sin(angle), 0, np.cos(angle)]])
+    t = rng.uniform(-0.1, 0.1, (3, 1))
+    pts_xyz_s = rng.uniform([[-1], [-1], [0.5]], [[1], [1], [3]],
+                            (3, n_points))
+    pts_xyz_t = R @ pts_xyz_s + t + rng.normal(0, 0.005, (3, n_points))
+    n_outlier = int(outlier_ratio * n_points)
+    pts_xyz_t[:, :n_outlier] += rng.uniform(-0.5, 0.5, (3, n_outlier))
+    return pts_xyz_s, pts_xyz_t
+
+
+def time_call(function, repeat, *args):
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = function(*args)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print("%8s %8s %14s %14s %8s %10s" %
+          ("points", "outliers", "reference [ms]", "batched [ms]", "speedup",
+           "inliers"))
+    for n_points in [50, 100, 500]:
+        for outlier_ratio in [0.2, 0.5, 0.8]:
+            pts_xyz_s, pts_xyz_t = make_correspondences(n_points,
+                                                        outlier_ratio, rng)
+            t_ref, r_ref = time_call(reference_estimate_3D_transform_RANSAC,
+                                     max(1, args.repeat // 10), pts_xyz_s,
+                                     pts_xyz_t)
+            t_new, r_new = time_call(estimate_3D_transform_RANSAC,
+                                     args.repeat, pts_xyz_s, pts_xyz_t)
+            print("%8d %8.1f %14.2f %14.2f %7.1fx %4d / %-4d" %
+                  (n_points, outlier_ratio, t_ref * 1000, t_new * 1000,
+                   t_ref / t_new, len(r_ref[2]), len(r_new[2])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Benchmark of the point cloud construction of the main_gui live stream.
+# Builds the colored point cloud of one synthetic RealSense frame the former
+# way (per-point color loop, float32 vertices) and with texture_colors and
+# float64 vertices, and reports frames per second. The last row writes the
+# transformed frame into the preallocated buffers of the streaming renderer,
+# the "lod stride" rows do the same at the adaptive level-of-detail strides.
+#
+#   python -m benchmarks.bench_stream_colors [--width 1280] [--height 720]
+#                                            [--repeat 10]
+
+import argparse
+import time
+
+import numpy as np
+import open3d as o3d
+
+from src.live_stream import STREAM_TRANSFORM, StreamBuffers, decimate_grid, texture_colors
+
+
+def reference_texture_colors(color_image, colors):
+    color_data = []
+    for u, v in colors:
+        u = int(u * color_image.shape[1])
+        v = int(v * color_image.shape[0])
+        if 0 <= u < color_image.shape[1] and 0 <= v < color_image.shape[0]:
+            color_data.append(color_image[v, u] / 255.0)
+        else:
+            color_data.append([0, 0, 0])
+    return color_data
+
+
+def make_frame(width, height, rng):
+    # depth pixels map to texture coordinates slightly shifted from their own
+    # pixel, so the border of the frame falls outside the color image
+    color_image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    (v, u) = np.mgrid[0:height, 0:width].astype(np.float32)
+    colors = np.stack([(u + 0.5) / width * 1.02 - 0.01,
+                       (v + 0.5) / height * 1.02 - 0.01],
+                      axis=1).reshape(-1, 2).astype(np.float32)
+    vertices = rng.uniform(-1, 1, (width * height, 3)).astype(np.float32)
+    return color_image, colors, vertices
+
+
+def reference_point_cloud(color_image, colors, vertices):
+    o3d_pc = o3d.geometry.PointCloud()
+    o3d_pc.points = o3d.utility.Vector3dVector(vertices)
+    o3d_pc.colors = o3d.utility.Vector3dVector(
+        reference_texture_colors(color_image, colors))
+    return o3d_pc
+
+
+def point_cloud(color_image, colors, vertices):
+    o3d_pc = o3d.geometry.PointCloud()
+    o3d_pc.points = o3d.utility.Vector3dVector(vertices.astype(np.float64))
+    o3d_pc.colors = o3d.utility.Vector3dVector(
+        texture_colors(color_image, colors))
+    return o3d_pc
+
+
+def stream_buffer_frame(buffers, width, stride=1):
+    # the streaming path: the frame, decimated to every stride-th pixel, is
+    # written into a preallocated buffer and handed to the renderer through
+    # the mailbox
+    def fill(color_image, colors, vertices):
+        buffer = buffers.acquire()
+        buffer.fill(decimate_grid(vertices, width, stride),
+                    decimate_grid(colors, width, stride), color_image)
+        buffers.publish(buffer)
+        return buffers.take()
+
+    return fill
+
+
+def time_frames(function, repeat, *frame):
+    start = time.perf_counter()
+    for i in range(repeat):
+        o3d_pc = function(*frame)
+    return repeat / (time.perf_counter() - start), o3d_pc
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    frame = make_frame(args.width, args.height, np.random.default_rng(0))
+    fps_ref, pcd_ref = time_frames(reference_point_cloud, 1, *frame)
+    fps_new, pcd_new = time_frames(point_cloud, args.repeat, *frame)
+    assert np.array_equal(np.asarray(pcd_ref.points),
+                          np.asarray(pcd_new.points))
+    assert np.array_equal(np.asarray(pcd_ref.colors),
+                          np.asarray(pcd_new.colors))
+    fps_buf, buffer = time_frames(
+        stream_buffer_frame(StreamBuffers(len(frame[2])), args.width),
+        args.repeat, *frame)
+    assert np.allclose(buffer.positions,
+                       np.asarray(pcd_ref.points) @ STREAM_TRANSFORM.T,
+                       atol=1e-6)
+    assert np.allclose(buffer.colors, np.asarray(pcd_ref.colors), atol=1e-6)
+    print("%dx%d, %d points" % (args.width, args.height, len(frame[2])))
+    print("%16s %10s" % ("", "fps"))
+    print("%16s %10.2f" % ("reference", fps_ref))
+    print("%16s %10.2f" % ("vectorized", fps_new))
+    print("%16s %10.2f" % ("stream buffers", fps_buf))
+    for stride in [2, 4]:
+        n_points = len(decimate_grid(frame[2], args.width, stride))
+        fps_lod, buffer = time_frames(
+            stream_buffer_frame(StreamBuffers(n_points), args.width, stride),
+            args.repeat, *frame)
+        print("%16s %10.2f  (%d points)" % ("lod stride %d" % stride, fps_lod,
+                                            n_points))
+    print("speedup %.1fx, %.1fx with stream buffers" %
+          (fps_new / fps_ref, fps_buf / fps_ref))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,27 @@
+import datetime
 import os.path
+import time
 
 import numpy as np
 import open3d as o3d
 import pymeshlab
 from open3d.visualization import gui, rendering
 from sensors.realsense_helper import get_profiles
+from src.live_stream import LevelOfDetail, StreamBuffers, StreamStats, decimate_grid
+from src.reconstruction_worker import ReconstructionWorker
+from src.scene_assets import SceneAssetManager
 
 APP_NAME = "Realsense APP (FMFI UK project)"
 DEFAULT_WIDTH = 1280
 DEFAULT_HEIGHT = 720
 PLY_FILE_PATH = "dataset/realsense/scene/integrated.ply"
 SHADER_STYLE = "defaultUnlit"
+DEFAULT_STREAM_TARGET_FPS = 20
 
 BUTTON_START_STREAM_ID = "start_stream"
 BUTTON_STOP_STREAM_ID = "stop_stream"
 BUTTON_START_SCAN_ID = "start_scan"
+BUTTON_CANCEL_RECONSTRUCTION_ID = "cancel_reconstruction"
 BUTTON_EXPORT_ID = "export"
 BUTTON_START_MEASURE_ID = "start_measure"
 BUTTON_STOP_MEASURE_ID = "stop_measure"
@@ -29,6 +36,7 @@ class AppWindow:
         BUTTON_START_STREAM_ID: "START STREAM",
         BUTTON_STOP_STREAM_ID: "STOP STREAM",
         BUTTON_START_SCAN_ID: "START SCAN",
+        BUTTON_CANCEL_RECONSTRUCTION_ID: "CANCEL RECONSTRUCTION",
         BUTTON_EXPORT_ID: "EXPORT",
         BUTTON_START_MEASURE_ID: "START MEASURING",
         BUTTON_STOP_MEASURE_ID: "STOP MEASURING",
@@ -44,6 +52,23 @@ class AppWindow:
     def __init__(self, width, height):
         self.pcd = None
         self.pcd_kdtree = None
+        # the reconstructed cloud is read once per version of the file and
+        # shared by the scan view and the measurement mode
+        self.assets = SceneAssetManager()
+        self._shown_pcd = None
+        self._scene_requested = False
+        # frame buffers and rates of the live stream, see src/live_stream.py
+        self.stream_buffers = None
+        self.stream_stats = None
+        # live preview settings, changed from the "Live preview" panel
+        self.stream_adaptive_lod = False
+        self.stream_target_fps = DEFAULT_STREAM_TARGET_FPS
+        self.stream_depth_filters = {"decimation": False, "spatial": False, "temporal": False}
+        self.stream_lod = None
+        self.stream_points = (0, 0)
+        self._stream_info_sample = (0.0, 0)
+        # reconstruction running in a separate process after a scan
+        self.reconstruction = None
         self.resolution_height = DEFAULT_HEIGHT
         self.resolution_width = DEFAULT_WIDTH
         self.buttons = dict()
@@ -68,6 +93,8 @@ class AppWindow:
 
         gui.Application.instance.initialize()
         self._set_scene(width, height)
+        if self.exist_path(PLY_FILE_PATH):
+            self.assets.load(PLY_FILE_PATH)
 
     def _on_layout(self, layout_context):
         r = self.window.content_rect
@@ -105,6 +132,7 @@ class AppWindow:
         self.create_button_to_bar(BUTTON_STOP_STREAM_ID, function=self.stop_stream, visibility=False)
 
         self.create_button_to_bar(BUTTON_START_SCAN_ID, function=self.start_scan)
+        self.create_button_to_bar(BUTTON_CANCEL_RECONSTRUCTION_ID, function=self.cancel_reconstruction, visibility=False)
 
         self.create_button_to_bar(BUTTON_SHOW_SCAN_ID, function=self.show_ply_scene)
         self.create_button_to_bar(BUTTON_HIDE_SCAN_ID, function=self.hide_scan, visibility=False)
@@ -148,11 +176,14 @@ class AppWindow:
         collapse.add_child(rb)
         self._left_panel.add_child(collapse)
 
+        self._left_panel.add_child(self.create_stream_panel(em))
+        self._left_panel.add_child(self.create_reconstruction_panel(em))
 
         self.distance_text_label = self.create_distance_label()
         self._left_panel.add_child(self.distance_text_label)
 
         w.set_on_layout(self._on_layout)
+        w.set_on_close(self._on_close)
         w.add_child(self._scene)
         w.add_child(self._left_panel)
 
@@ -182,6 +213,9 @@ class AppWindow:
         return gui.Widget.EventCallbackResult.IGNORED
 
     def _calc_prefer_indicate(self, point):
+        # built on the first pick and kept with the cached cloud
+        if self.pcd_kdtree is None:
+            self.pcd_kdtree = self.assets.kdtree(self.pcd)
         [k, idx, _] = self.pcd_kdtree.search_knn_vector_3d(point, 1)
         return idx[0]
 
@@ -198,6 +232,73 @@ class AppWindow:
         label.visible = False
         return label
 
+    def create_stream_panel(self, em):
+        panel = gui.CollapsableVert("Live preview", 0.33 * em, gui.Margins(em, 0, 0, 0))
+
+        adaptive_lod = gui.Checkbox("Adaptive level of detail")
+        adaptive_lod.checked = self.stream_adaptive_lod
+
+        def adaptive_lod_changed(checked):
+            self.stream_adaptive_lod = checked
+
+        adaptive_lod.set_on_checked(adaptive_lod_changed)
+        panel.add_child(adaptive_lod)
+
+        target_fps = gui.Slider(gui.Slider.INT)
+        target_fps.set_limits(5, 30)
+        target_fps.int_value = self.stream_target_fps
+
+        def target_fps_changed(value):
+            self.stream_target_fps = int(value)
+            if self.stream_lod is not None:
+                self.stream_lod.target_frame_time = 1.0 / self.stream_target_fps
+
+        target_fps.set_on_value_changed(target_fps_changed)
+        target_row = gui.Horiz(0.25 * em)
+        target_row.add_child(gui.Label("Target FPS"))
+        target_row.add_child(target_fps)
+        panel.add_child(target_row)
+
+        # RealSense post-processing of the depth frame, before the point cloud
+        # is computed
+        for name in self.stream_depth_filters:
+            checkbox = gui.Checkbox(name.capitalize() + " filter")
+            checkbox.checked = self.stream_depth_filters[name]
+
+            def filter_changed(checked, name=name):
+                self.stream_depth_filters[name] = checked
+
+            checkbox.set_on_checked(filter_changed)
+            panel.add_child(checkbox)
+
+        self.stream_points_label = gui.Label("Points: --")
+        self.stream_fps_label = gui.Label("FPS: --")
+        panel.add_child(self.stream_points_label)
+        panel.add_child(self.stream_fps_label)
+        return panel
+
+    def create_reconstruction_panel(self, em):
+        panel = gui.Vert(0.25 * em)
+        self.reconstruction_label = gui.Label("Reconstruction: --")
+        self.reconstruction_progress = gui.ProgressBar()
+        panel.add_child(self.reconstruction_label)
+        panel.add_child(self.reconstruction_progress)
+        panel.visible = False
+        self.reconstruction_panel = panel
+        return panel
+
+    def update_stream_info(self):
+        # rates over the time since the last update, at most twice a second
+        now = time.time()
+        (last_time, last_rendered) = self._stream_info_sample
+        if now - last_time < 0.5:
+            return
+        fps = (self.stream_stats.n_rendered - last_rendered) / (now - last_time)
+        self._stream_info_sample = (now, self.stream_stats.n_rendered)
+        (n_points, n_pixels) = self.stream_points
+        self.stream_points_label.text = f"Points: {n_points} / {n_pixels}"
+        self.stream_fps_label.text = f"FPS: {fps:.1f}"
+
     @staticmethod
     def run():
         gui.Application.instance.run()
@@ -207,7 +308,7 @@ class AppWindow:
 
         geometry_name = "pcd"
         scene = self._scene.scene
-        pcd = o3d.io.read_point_cloud(PLY_FILE_PATH)
+        pcd = self.assets.point_cloud(PLY_FILE_PATH)
 
         material = rendering.MaterialRecord()
         material.point_size = 5.0
@@ -270,17 +371,15 @@ class AppWindow:
 
         self.distance_text_label.visible = True
 
-        self.pcd = o3d.io.read_point_cloud(PLY_FILE_PATH)
-        self.pcd_kdtree = o3d.geometry.KDTreeFlann(self.pcd)
+        # measures on the cloud of the scan view, which is already shown
+        # unless the file changed since
+        self.pcd = self.assets.point_cloud(PLY_FILE_PATH)
+        self.pcd_kdtree = None
+        self._scene_requested = True
+        self.show_scene_geometry(self.pcd)
 
         self._scene.set_on_mouse(self._start_measure_event)
 
-        material = rendering.MaterialRecord()
-        material.shader = SHADER_STYLE
-        material.point_size = 5.0
-
-        self._scene.scene.add_geometry(BUTTON_START_MEASURE_ID, self.pcd, material)
-
     def stop_measure(self):
         visibility_after_click_mapper = {
             BUTTON_START_STREAM_ID: False,
@@ -298,7 +397,6 @@ class AppWindow:
         self.distance_text_label.text = f"Distance -- m"
 
         self._scene.set_on_mouse(None)
-        self._scene.scene.remove_geometry(BUTTON_START_MEASURE_ID)
 
     def show_ply_scene(self):
         if not self.exist_path(PLY_FILE_PATH):
@@ -316,14 +414,31 @@ class AppWindow:
         }
         self.update_visiblity(visibility_after_click_mapper)
 
+        # loaded in the background unless it already is
+        self._scene_requested = True
+        self.assets.request(
+            PLY_FILE_PATH,
+            lambda pcd: gui.Application.instance.post_to_main_thread(
+                self.window, lambda: self.show_scene_geometry(pcd)))
+
+    def show_scene_geometry(self, pcd):
+        if not self._scene_requested:
+            return
         scene = self._scene.scene
+        self.pcd = pcd
+        # a cloud already on the GPU is shown again instead of uploaded
+        if scene.has_geometry(MAIN_SCREEN_ID) and self._shown_pcd is pcd:
+            scene.show_geometry(MAIN_SCREEN_ID, True)
+            return
+        if scene.has_geometry(MAIN_SCREEN_ID):
+            scene.remove_geometry(MAIN_SCREEN_ID)
 
         material = rendering.MaterialRecord()
         material.shader = SHADER_STYLE
         material.point_size = 5.0
 
-        self.pcd = o3d.io.read_point_cloud(PLY_FILE_PATH)
-        scene.add_geometry(MAIN_SCREEN_ID, self.pcd, material)
+        scene.add_geometry(MAIN_SCREEN_ID, pcd, material)
+        self._shown_pcd = pcd
 
     def hide_scan(self):
         visibility_after_click_mapper = {
@@ -340,12 +455,81 @@ class AppWindow:
 
         self.distance_text_label.visible = False
 
+        # kept on the GPU for the next SHOW SCAN
+        self._scene_requested = False
         scene = self._scene.scene
-        scene.remove_geometry(MAIN_SCREEN_ID)
+        if scene.has_geometry(MAIN_SCREEN_ID):
+            scene.show_geometry(MAIN_SCREEN_ID, False)
 
     def start_scan(self):
+        # the recorded frames are the input of a running reconstruction
+        if self.reconstruction is not None:
+            return
         from sensors.realsense_recorder import scan
-        gui.Application.instance.post_to_main_thread(self.window, lambda: scan(self.resolution_width, self.resolution_height))
+
+        def scan_and_reconstruct():
+            scan(self.resolution_width, self.resolution_height, reconstruct=False)
+            self.start_reconstruction()
+
+        gui.Application.instance.post_to_main_thread(self.window, scan_and_reconstruct)
+
+    def start_reconstruction(self):
+        # the pipeline runs in its own process, so the window keeps
+        # rendering while it uses all cores
+        self.reconstruction = ReconstructionWorker()
+        self.reconstruction.start()
+        self.update_visiblity({BUTTON_START_SCAN_ID: False, BUTTON_CANCEL_RECONSTRUCTION_ID: True})
+        self.buttons[BUTTON_CANCEL_RECONSTRUCTION_ID].enabled = True
+        self.reconstruction_label.text = "Reconstruction: starting"
+        self.reconstruction_progress.value = 0.0
+        self.reconstruction_panel.visible = True
+        self.reconstruction.subscribe(
+            lambda event: gui.Application.instance.post_to_main_thread(
+                self.window, lambda: self.on_reconstruction_event(event)))
+
+    @staticmethod
+    def format_seconds(seconds):
+        return str(datetime.timedelta(seconds=int(seconds)))
+
+    def on_reconstruction_event(self, event):
+        if event["type"] == "progress":
+            text = f"{event['stage']} ({event['stage_index'] + 1}/{event['n_stages']})"
+            if event["total"] > 0:
+                text += f"\n{event['done']} of {event['total']} {event['unit']}"
+            text += f"\nelapsed {self.format_seconds(event['elapsed'])}"
+            if event["eta"] is not None:
+                text += f", stage ETA {self.format_seconds(event['eta'])}"
+            self.reconstruction_label.text = text
+            self.reconstruction_progress.value = event["fraction"]
+            return
+
+        if event["type"] == "done":
+            self.reconstruction_label.text = f"Reconstruction finished in {self.format_seconds(event['elapsed'])}"
+            self.reconstruction_progress.value = 1.0
+            # the rewritten file has a new version; read it ahead of SHOW SCAN
+            if self.exist_path(PLY_FILE_PATH):
+                self.assets.load(PLY_FILE_PATH)
+        elif event["type"] == "cancelled":
+            self.reconstruction_label.text = f"Reconstruction cancelled during {event['stage']}"
+        else:
+            print(event["message"])
+            self.reconstruction_label.text = f"Reconstruction failed during {event['stage']}"
+        self.reconstruction = None
+        self.update_visiblity({BUTTON_START_SCAN_ID: True, BUTTON_CANCEL_RECONSTRUCTION_ID: False})
+
+    def cancel_reconstruction(self):
+        if self.reconstruction is None:
+            return
+        # the pipeline stops at its next progress update
+        self.reconstruction.cancel()
+        self.buttons[BUTTON_CANCEL_RECONSTRUCTION_ID].enabled = False
+        self.reconstruction_label.text = "Reconstruction: cancelling"
+
+    def _on_close(self):
+        if self.reconstruction is not None:
+            self.reconstruction.cancel()
+        self.assets.close()
+        return True
 
     def start_stream(self):
         visibility_after_click_mapper = {
@@ -370,11 +554,38 @@ class AppWindow:
 
         import pyrealsense2 as rs
         import threading
-
-        def add_and_clear(pcd):
-            scene.clear_geometry()
-            scene.add_geometry(geometry_name, pcd, material)
-            
+        from sensors.realsense_helper import get_depth_filters, filter_depth_frame
+
+        update_flags = (rendering.Scene.UPDATE_POINTS_FLAG |
+                        rendering.Scene.UPDATE_COLORS_FLAG)
+
+        # points of the rendered geometry; update_geometry needs the same count
+        rendered = {"n_points": None}
+
+        def render_latest_frame():
+            # runs on the main thread; at most one call is pending, and it
+            # renders whatever frame is newest by then
+            if self.stream_buffers is None or not self.button_is_clicked_mapper[BUTTON_STOP_STREAM_ID]:
+                return
+            buffer = self.stream_buffers.take()
+            if buffer is None:
+                return
+            start_time = time.time()
+            n_points = buffer.positions.shape[0]
+            if rendered["n_points"] == n_points and scene.has_geometry(geometry_name):
+                scene.scene.update_geometry(geometry_name, buffer.point_cloud, update_flags)
+            else:
+                if rendered["n_points"] is None:
+                    scene.clear_geometry()
+                elif scene.has_geometry(geometry_name):
+                    scene.remove_geometry(geometry_name)
+                scene.add_geometry(geometry_name, buffer.point_cloud, material)
+                rendered["n_points"] = n_points
+            self._scene.force_redraw()
+            self.stream_stats.last_render_time = time.time() - start_time
+            self.stream_stats.render_time += self.stream_stats.last_render_time
+            self.stream_stats.n_rendered += 1
+            self.update_stream_info()
 
         def capture_frames():
             pipeline = rs.pipeline()
@@ -385,10 +596,16 @@ class AppWindow:
 
             align_to = rs.stream.color
             align = rs.align(align_to)
+            pc = rs.pointcloud()
+            filters = get_depth_filters()
 
+            self.stream_buffers = None
+            self.stream_stats = StreamStats()
+            self.stream_lod = LevelOfDetail(1.0 / self.stream_target_fps)
             try:
                 while self.button_is_clicked_mapper[BUTTON_STOP_STREAM_ID]:
                     frames = pipeline.wait_for_frames()
+                    start_time = time.time()
                     aligned_frames = align.process(frames)
 
                     depth_frame = aligned_frames.get_depth_frame()
@@ -397,36 +614,43 @@ class AppWindow:
                         continue
 
                     color_image = np.asanyarray(color_frame.get_data())
+                    depth_frame = filter_depth_frame(depth_frame, filters, **self.stream_depth_filters)
 
-                    pc = rs.pointcloud()
                     pc.map_to(color_frame)
                     points = pc.calculate(depth_frame)
 
                     vertices = np.asanyarray(points.get_vertices()).view(np.float32).reshape(-1, 3)
                     colors = np.asanyarray(points.get_texture_coordinates()).view(np.float32).reshape(-1, 2)
-                    vertices[:, 2] = -vertices[:, 2]
-
-                    o3d_pc = o3d.geometry.PointCloud()
-                    o3d_pc.points = o3d.utility.Vector3dVector(vertices)
-
-                    color_data = []
-                    for u, v in colors:
-                        u = int(u * color_image.shape[1])
-                        v = int(v * color_image.shape[0])
-                        if 0 <= u < color_image.shape[1] and 0 <= v < color_image.shape[0]:
-                            color_data.append(color_image[v, u] / 255.0)
-                        else:
-                            color_data.append([0, 0, 0])
-
-                    o3d_pc.colors = o3d.utility.Vector3dVector(color_data)
-                    R = o3d.geometry.get_rotation_matrix_from_xyz([0, 0, np.pi])
-                    o3d_pc.rotate(R, center=(0, 0, 0))
-                    if self.button_is_clicked_mapper[BUTTON_STOP_STREAM_ID]:
+                    n_pixels = vertices.shape[0]
+
+                    # adaptive level of detail keeps every stride-th pixel
+                    # of every stride-th row
+                    stride = self.stream_lod.stride if self.stream_adaptive_lod else 1
+                    vertices = decimate_grid(vertices, depth_frame.get_width(), stride)
+                    colors = decimate_grid(colors, depth_frame.get_width(), stride)
+                    self.stream_points = (vertices.shape[0], n_pixels)
+
+                    # buffers are reused by all frames with the same number of
+                    # points
+                    if self.stream_buffers is None or self.stream_buffers.n_points != vertices.shape[0]:
+                        self.stream_buffers = StreamBuffers(vertices.shape[0], stats=self.stream_stats)
+                    buffer = self.stream_buffers.acquire()
+                    buffer.fill(vertices, colors, color_image)
+                    capture_time = time.time() - start_time
+                    self.stream_stats.capture_time += capture_time
+                    self.stream_stats.n_captured += 1
+                    if self.stream_adaptive_lod:
+                        self.stream_lod.update(capture_time + self.stream_stats.last_render_time)
+
+                    if self.stream_buffers.publish(buffer) and \
+                            self.button_is_clicked_mapper[BUTTON_STOP_STREAM_ID]:
                         gui.Application.instance.post_to_main_thread(
-                            self.window, lambda: add_and_clear(o3d_pc))
+                            self.window, render_latest_frame)
 
             finally:
                 pipeline.stop()
+                if self.stream_buffers is not None:
+                    print(self.stream_stats.summary())
 
         if self.button_is_clicked_mapper[BUTTON_STOP_STREAM_ID]:
             threading.Thread(target=capture_frames, daemon=True).start()
@@ -42,3 +42,31 @@ def get_profiles():
                         depth_profiles.append((w, h, fps, fmt))
 
     return color_profiles, depth_profiles
+
+
+def get_depth_filters():
+    # post-processing of depth frames in the order recommended by
+    # librealsense: decimation, then spatial and temporal smoothing in the
+    # disparity domain. Filters keep state (temporal averages frames), so
+    # one set is used for a whole stream
+    return {
+        "decimation": rs.decimation_filter(),
+        "to_disparity": rs.disparity_transform(True),
+        "spatial": rs.spatial_filter(),
+        "temporal": rs.temporal_filter(),
+        "to_depth": rs.disparity_transform(False),
+    }
+
+
+def filter_depth_frame(depth_frame, filters, decimation=False, spatial=False,
+                       temporal=False):
+    if decimation:
+        depth_frame = filters["decimation"].process(depth_frame)
+    if spatial or temporal:
+        depth_frame = filters["to_disparity"].process(depth_frame)
+        if spatial:
+            depth_frame = filters["spatial"].process(depth_frame)
+        if temporal:
+            depth_frame = filters["temporal"].process(depth_frame)
+        depth_frame = filters["to_depth"].process(depth_frame)
+    return depth_frame.as_depth_frame()
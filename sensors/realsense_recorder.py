@@ -59,7 +59,9 @@ def save_intrinsic_as_json(filename, frame):
             indent=4)
 
 
-def scan(width, height):
+def scan(width, height, reconstruct=True):
+    # with reconstruct=False the recording stops at ESC and the caller runs
+    # the reconstruction, e.g. in a ReconstructionWorker
     path_output = "dataset/realsense/"
     path_depth = join("dataset/realsense/", "depth")
     path_color = join("dataset/realsense/", "color")
@@ -163,8 +165,9 @@ def scan(width, height):
             # if 'esc' button pressed, escape loop and exit program
             if key == 27:
                 cv2.destroyAllWindows()
-                from src.run_system import get_pointcloud
-                get_pointcloud()
+                if reconstruct:
+                    from src.run_system import get_pointcloud
+                    get_pointcloud()
                 break
     finally:
         pipeline.stop()
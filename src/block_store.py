@@ -0,0 +1,85 @@
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+# block coordinates are packed into one int64, 21 bits per axis
+_KEY_BITS = 21
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+_KEY_MASK = (1 << _KEY_BITS) - 1
+
+
+def pack_block_keys(keys):
+    keys = keys.astype(np.int64) + _KEY_OFFSET
+    return (keys[:, 0] << (2 * _KEY_BITS)) | (keys[:, 1] << _KEY_BITS) | \
+            keys[:, 2]
+
+
+def unpack_block_keys(packed):
+    return np.stack([(packed >> (2 * _KEY_BITS)) - _KEY_OFFSET,
+                     ((packed >> _KEY_BITS) & _KEY_MASK) - _KEY_OFFSET,
+                     (packed & _KEY_MASK) - _KEY_OFFSET],
+                    axis=1)
+
+
+class BlockStore:
+    """Voxel blocks spilled to a temporary file.
+
+    Every block (packed block key, see ``pack_block_keys``) owns a fixed
+    slot of ``block_values`` float32 values in the file, which is rewritten
+    when the block is evicted again. Only the slot table is kept in memory.
+    The file is accessed with seek and read / write (no ``os.pread``, which
+    Windows lacks) and removed on ``close``.
+    """
+
+    def __init__(self, folder, block_values):
+        self.block_bytes = block_values * 4
+        self.block_values = block_values
+        self.slots = {}
+        self.bytes_written = 0
+        self.bytes_read = 0
+        (fd, self.filename) = tempfile.mkstemp(prefix="tsdf_blocks_",
+                                               suffix=".bin",
+                                               dir=folder)
+        self._file = os.fdopen(fd, "r+b")
+        # a seek and the read or write after it must not interleave
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def contains(self, packed_keys):
+        return np.array([key in self.slots for key in packed_keys.tolist()],
+                        dtype=bool)
+
+    def keys(self):
+        return np.fromiter(self.slots.keys(), np.int64, len(self.slots))
+
+    def write(self, packed_keys, values):
+        values = np.ascontiguousarray(values, dtype=np.float32)
+        with self._lock:
+            for (key, block) in zip(packed_keys.tolist(), values):
+                slot = self.slots.setdefault(key, len(self.slots))
+                self._file.seek(slot * self.block_bytes)
+                self._file.write(block.data)
+            self.bytes_written += values.nbytes
+
+    def read(self, packed_keys):
+        values = np.empty((packed_keys.shape[0], self.block_values),
+                          dtype=np.float32)
+        with self._lock:
+            # written blocks may still be in the write buffer
+            self._file.flush()
+            for (i, key) in enumerate(packed_keys.tolist()):
+                self._file.seek(self.slots[key] * self.block_bytes)
+                self._file.readinto(values[i].data)
+            self.bytes_read += values.nbytes
+        return values
+
+    def close(self):
+        if self._file is not None:
+            # Windows cannot remove a file that is still open
+            self._file.close()
+            os.remove(self.filename)
+            self._file = None
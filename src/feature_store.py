@@ -0,0 +1,86 @@
+import os
+import threading
+from os.path import basename, exists, join
+
+import numpy as np
+
+from src.opencv_pose_estimation import FrameFeatures, compute_frame_features
+
+
+class FeatureStore:
+    """ORB keypoints, descriptors and 3D points computed once per frame.
+
+    Features are kept in memory for the lifetime of the store and persisted
+    as one ``.npz`` file per frame in ``config["folder_features"]`` of the
+    dataset, so later runs only load them. A stored file is reused while the
+    color and depth files, the depth parameters and the intrinsic it was
+    computed from are unchanged.
+    """
+
+    def __init__(self, frame_cache, intrinsic, config):
+        self.frame_cache = frame_cache
+        self.intrinsic = intrinsic
+        self.config = config
+        self.path_features = join(config["path_dataset"],
+                                  config["folder_features"])
+        self._features = {}
+
+    def _feature_file(self, index):
+        return join(self.path_features,
+                    basename(self.frame_cache.color_files[index]) + ".npz")
+
+    def _signature(self, index):
+        color_stat = os.stat(self.frame_cache.color_files[index])
+        depth_stat = os.stat(self.frame_cache.depth_files[index])
+        return np.concatenate([
+            np.array([
+                color_stat.st_size, color_stat.st_mtime_ns, depth_stat.st_size,
+                depth_stat.st_mtime_ns
+            ],
+                     dtype=np.float64),
+            np.array([self.config["depth_scale"], self.config["depth_max"]],
+                     dtype=np.float64),
+            self.intrinsic.intrinsic_matrix.ravel()
+        ])
+
+    def get(self, index):
+        features = self._features.get(index)
+        if features is None:
+            signature = self._signature(index)
+            features = self._load(index, signature)
+            if features is None:
+                features = compute_frame_features(
+                    self.frame_cache.get(index, True), self.intrinsic)
+                self._save(index, signature, features)
+            self._features[index] = features
+        return features
+
+    def _load(self, index, signature):
+        feature_file = self._feature_file(index)
+        if not exists(feature_file):
+            return None
+        try:
+            with np.load(feature_file) as data:
+                if not np.array_equal(data["signature"], signature):
+                    return None
+                return FrameFeatures(data["keypoints"], data["descriptors"],
+                                     data["points_xyz"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save(self, index, signature, features):
+        if not exists(self.path_features):
+            os.makedirs(self.path_features, exist_ok=True)
+        feature_file = self._feature_file(index)
+        # written under a temporary name so that a reader never sees a
+        # partial file; the name is unique per thread, as threads of the
+        # thread pool backend may save the same frame at the same time
+        tmp_file = feature_file + ".%d.%d.tmp" % (os.getpid(),
+                                                  threading.get_ident())
+        with open(tmp_file, "wb") as f:
+            np.savez(f,
+                     signature=signature,
+                     keypoints=features.keypoints,
+                     descriptors=features.descriptors,
+                     points_xyz=features.points_xyz)
+        os.replace(tmp_file, feature_file)
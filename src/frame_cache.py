@@ -0,0 +1,89 @@
+import collections
+
+import numpy as np
+import open3d as o3d
+
+
+def _image_nbytes(image):
+    return np.asarray(image).nbytes
+
+
+class RGBDFrameCache:
+    """Bounded LRU cache of decoded RGBD frames of one fragment.
+
+    Color and depth files are decoded once per frame. The intensity and RGB
+    variants produced by ``read_rgbd_image`` are built from the decoded
+    images on first request and kept alongside them.
+    """
+
+    def __init__(self, color_files, depth_files, config, max_bytes=None):
+        self.color_files = color_files
+        self.depth_files = depth_files
+        self.config = config
+        if max_bytes is None:
+            max_bytes = config["frame_cache_size_mb"] * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.decoded = 0
+        self._frames = collections.OrderedDict()
+
+    def _frame(self, index):
+        frame = self._frames.get(index)
+        if frame is None:
+            color = o3d.io.read_image(self.color_files[index])
+            depth = o3d.io.read_image(self.depth_files[index])
+            frame = {
+                "color": color,
+                "depth": depth,
+                "nbytes": _image_nbytes(color) + _image_nbytes(depth)
+            }
+            self._frames[index] = frame
+            self.n_bytes += frame["nbytes"]
+            self.decoded += 1
+        else:
+            self._frames.move_to_end(index)
+        return frame
+
+    def get_raw(self, index):
+        # decoded color and depth images as stored in the files
+        frame = self._frame(index)
+        self._evict()
+        return (frame["color"], frame["depth"])
+
+    def get(self, index, convert_rgb_to_intensity):
+        frame = self._frame(index)
+        rgbd_image = frame.get(convert_rgb_to_intensity)
+        if rgbd_image is None:
+            self.misses += 1
+            rgbd_image = o3d.geometry.RGBDImage.create_from_color_and_depth(
+                frame["color"],
+                frame["depth"],
+                depth_scale=self.config["depth_scale"],
+                depth_trunc=self.config["depth_max"],
+                convert_rgb_to_intensity=convert_rgb_to_intensity)
+            frame[convert_rgb_to_intensity] = rgbd_image
+            nbytes = _image_nbytes(rgbd_image.color) + \
+                    _image_nbytes(rgbd_image.depth)
+            frame["nbytes"] += nbytes
+            self.n_bytes += nbytes
+            self._evict()
+        else:
+            self.hits += 1
+        return rgbd_image
+
+    def _evict(self):
+        # the most recently used frame always stays, even if it alone
+        # exceeds the budget
+        while self.n_bytes > self.max_bytes and len(self._frames) > 1:
+            _, frame = self._frames.popitem(last=False)
+            self.n_bytes -= frame["nbytes"]
+
+    def clear(self):
+        self._frames.clear()
+        self.n_bytes = 0
+
+    def summary(self):
+        return "frame cache %d hits, %d misses, %d frames decoded" % (
+            self.hits, self.misses, self.decoded)
@@ -0,0 +1,110 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import open3d as o3d
+
+
+class PrefetchingFrameReader:
+    """Frames of a fixed sequence, decoded ahead by background threads.
+
+    ``indices`` is the order in which the frames will be requested. Up to
+    ``config["integration_prefetch_depth"]`` frames are decoded ahead by
+    ``config["integration_prefetch_threads"]`` threads, so decoding overlaps
+    with the consumer. Offers the ``get`` / ``get_raw`` interface of
+    ``RGBDFrameCache`` for frames requested in sequence order. The time the
+    consumer waited for a frame and the time the producer waited for a free
+    slot are kept for ``summary``.
+    """
+
+    def __init__(self, color_files, depth_files, indices, config,
+                 build_rgbd=True):
+        self.color_files = color_files
+        self.depth_files = depth_files
+        self.indices = list(indices)
+        self.config = config
+        self.build_rgbd = build_rgbd
+        self.consumer_stall = 0.0
+        self.producer_stall = 0.0
+        self.n_frames = 0
+        self._current = (None, None)
+        self._closed = False
+        self._slots = threading.Semaphore(
+            max(1, config["integration_prefetch_depth"]))
+        self._pending = queue.Queue()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, config["integration_prefetch_threads"]))
+        self._producer = threading.Thread(target=self._produce, daemon=True)
+        self._producer.start()
+
+    def _decode(self, index):
+        color = o3d.io.read_image(self.color_files[index])
+        depth = o3d.io.read_image(self.depth_files[index])
+        frame = {"color": color, "depth": depth}
+        if self.build_rgbd:
+            frame["rgbd"] = o3d.geometry.RGBDImage.create_from_color_and_depth(
+                color,
+                depth,
+                depth_scale=self.config["depth_scale"],
+                depth_trunc=self.config["depth_max"],
+                convert_rgb_to_intensity=False)
+        return frame
+
+    def _produce(self):
+        for index in self.indices:
+            start_time = time.time()
+            self._slots.acquire()
+            self.producer_stall += time.time() - start_time
+            if self._closed:
+                return
+            self._pending.put((index, self._executor.submit(self._decode,
+                                                            index)))
+
+    def _frame(self, index):
+        if self._current[0] == index:
+            return self._current[1]
+        start_time = time.time()
+        (expected, future) = self._pending.get()
+        if expected != index:
+            raise ValueError("frame %d requested, but frame %d is next" %
+                             (index, expected))
+        frame = future.result()
+        self.consumer_stall += time.time() - start_time
+        self._slots.release()
+        self._current = (index, frame)
+        self.n_frames += 1
+        return frame
+
+    def get(self, index, convert_rgb_to_intensity):
+        frame = self._frame(index)
+        if convert_rgb_to_intensity or "rgbd" not in frame:
+            return o3d.geometry.RGBDImage.create_from_color_and_depth(
+                frame["color"],
+                frame["depth"],
+                depth_scale=self.config["depth_scale"],
+                depth_trunc=self.config["depth_max"],
+                convert_rgb_to_intensity=convert_rgb_to_intensity)
+        return frame["rgbd"]
+
+    def get_raw(self, index):
+        frame = self._frame(index)
+        return (frame["color"], frame["depth"])
+
+    def close(self):
+        self._closed = True
+        # wakes the producer if it waits for a slot
+        self._slots.release()
+        self._producer.join()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def summary(self):
+        return ("prefetch %d frames, consumer stalled %.2fs, "
+                "producer stalled %.2fs" %
+                (self.n_frames, self.consumer_stall, self.producer_stall))
@@ -59,9 +59,70 @@ def initialize_config(config):
     set_default_value(config, "preference_loop_closure_odometry", 0.1)
     set_default_value(config, "preference_loop_closure_registration", 5.0)
     set_default_value(config, "tsdf_cubic_size", 3.0)
+    # TSDF volume of make_fragments and integrate_scene: "legacy"
+    # (ScalableTSDFVolume) or "tensor" (o3d.t VoxelBlockGrid on `device`,
+    # sized from every frame_stride-th frame of the trajectory times margin)
+    set_default_value(config, "integration_backend", "legacy")
+    set_default_value(config, "integration_block_count_frame_stride", 5)
+    set_default_value(config, "integration_block_count_margin", 1.5)
+    # frames decoded ahead of integrate_scene and the threads decoding them
+    set_default_value(config, "integration_prefetch_depth", 8)
+    set_default_value(config, "integration_prefetch_threads", 2)
+    # integrate_scene: "single" integrates all frames into one volume,
+    # "partitioned" integrates cubic tiles of tile_size meters in parallel
+    # into tensor grids (whatever integration_backend is) and stitches their
+    # meshes, "fuse_fragments" fuses the tensor volumes that make_fragments
+    # saved for every fragment without reading any image
+    set_default_value(config, "scene_integration", "single")
+    set_default_value(config, "scene_integration_tile_size", 4.0)
+    # > 0 caps the voxel blocks kept in memory by the "single"
+    # integrate_scene volume and by slac_integrate (in MB); the others are
+    # spilled to disk and the result is extracted in tiles of tile_blocks
+    # blocks per axis
+    set_default_value(config, "tsdf_memory_limit_mb", 0)
+    set_default_value(config, "tsdf_extraction_tile_blocks", 16)
     set_default_value(config, "icp_method", "color")
     set_default_value(config, "global_registration", "ransac")
+    # "ransac" or "fgr"; "adaptive" (opt-in) tries FGR, then RANSAC with a
+    # small and a large budget, each pair limited to time_budget seconds
+    set_default_value(config, "global_registration_time_budget", 30.0)
+    set_default_value(config, "global_registration_min_fitness", 0.3)
+    set_default_value(config, "global_registration_max_rmse",
+                      config["voxel_size"])
+    set_default_value(config, "global_registration_ransac_small", 100000)
+    set_default_value(config, "global_registration_ransac_large", 1000000)
+    set_default_value(config, "global_registration_ransac_chunk", 100000)
     set_default_value(config, "python_multi_threading", True)
+    # workers shared by all stages: "process" (spawned processes) or
+    # "thread" (threads of the main process)
+    set_default_value(config, "worker_pool_backend", "process")
+    # fragment pairs tried for global registration: "overlap" keeps pairs
+    # likely to overlap (see pair_selection.py), "exhaustive" tries all
+    set_default_value(config, "pair_selection", "overlap")
+    set_default_value(config, "pair_selection_min_overlap", 0.1)
+    set_default_value(config, "pair_selection_descriptor_top_k", 2)
+    set_default_value(config, "pair_selection_max_per_fragment", 8)
+    set_default_value(config, "pair_selection_cell_size",
+                      config["voxel_size"] * 4.0)
+    # upper bound of decoded frames kept by make_fragments, in megabytes;
+    # split evenly between the frame caches of the pool workers
+    set_default_value(config, "frame_cache_size_mb", 1024)
+    # make_fragments parallelism: "fragment" runs one task per fragment,
+    # "pair" schedules the frame pairs of all fragments on the pool in
+    # chunks of fragment_pair_chunk_size, "auto" uses "pair" when there are
+    # fewer fragments than workers
+    set_default_value(config, "fragment_parallelism", "auto")
+    set_default_value(config, "fragment_pair_chunk_size", 8)
+    # keyframe pairs tried for loop closure inside a fragment:
+    # "vocabulary" keeps the top_k most similar keyframes of every keyframe,
+    # "exhaustive" tries every pair
+    set_default_value(config, "loop_closure_selection", "vocabulary")
+    set_default_value(config, "loop_closure_top_k", 5)
+    set_default_value(config, "loop_closure_min_similarity", 0.1)
+    set_default_value(config, "loop_closure_vocabulary_size", 64)
+    # downsampled fragment levels kept per process by refine_registration
+    # (three levels per fragment)
+    set_default_value(config, "pyramid_cache_size", 48)
 
     # `slac` and `slac_integrate` related parameters.
     # `voxel_size` and `depth_min` parameters from previous section,
@@ -81,14 +142,23 @@ def initialize_config(config):
 
     # path related parameters.
     set_default_value(config, "folder_fragment", "fragments/")
+    set_default_value(config, "folder_features", "features/")
+    set_default_value(config, "folder_fragment_fpfh", "fragments/fpfh/")
+    # input digests of every fragment, registration pair and stage
+    set_default_value(config, "folder_manifest", "manifests/")
     set_default_value(config, "subfolder_slac",
                       "slac/%0.3f/" % config["voxel_size"])
     set_default_value(config, "template_fragment_posegraph",
                       "fragments/fragment_%03d.json")
     set_default_value(config, "template_fragment_posegraph_optimized",
                       "fragments/fragment_optimized_%03d.json")
+    # optimized frame poses of all fragments, written by make_fragments
+    set_default_value(config, "template_fragment_pose_store",
+                      "fragments/fragment_poses.npy")
     set_default_value(config, "template_fragment_pointcloud",
                       "fragments/fragment_%03d.ply")
+    set_default_value(config, "template_fragment_volume",
+                      "fragments/fragment_volume_%03d.npz")
     set_default_value(config, "folder_scene", "scene/")
     set_default_value(config, "template_global_posegraph",
                       "scene/global_registration.json")
@@ -100,6 +170,14 @@ def initialize_config(config):
                       "scene/refined_registration_optimized.json")
     set_default_value(config, "template_global_mesh", "scene/integrated.ply")
     set_default_value(config, "template_global_traj", "scene/trajectory.log")
+    set_default_value(config, "template_global_traj_store",
+                      "scene/trajectory.npy")
+    # true skips the fragments, registration pairs and stages whose inputs
+    # (frames, config keys and upstream outputs) are unchanged since the
+    # last run, instead of rerunning everything from scratch
+    set_default_value(config, "incremental", False)
+    # measured task durations, used to schedule expensive tasks first
+    set_default_value(config, "template_task_timings", "task_timings.json")
 
     if config["path_dataset"].endswith(".bag"):
         assert os.path.isfile(config["path_dataset"]), (
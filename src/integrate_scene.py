@@ -16,59 +16,206 @@ import open3d as o3d
 #sys.path.append(pyexample_path)
 
 from src.open3d_example import *
+from src.frame_cache import RGBDFrameCache
+from src.frame_prefetcher import PrefetchingFrameReader
+from src.integration_backend import make_integrator, LegacyIntegrator, TensorIntegrator
+from src.make_fragments import read_intrinsic
+from src.manifest import Manifest, MANIFEST_CONFIG_KEYS
+from src.out_of_core_volume import OutOfCoreVolume
+from src.pose_store import fragment_pose_store, posegraph_poses, write_scene_trajectory
+from src.scene_partition import frame_tiles, partition_frames, crop_mesh_arrays, merge_mesh_arrays
+from src.progress import report_progress
+from src.task_scheduler import run_scheduled
+from src.volume_fusion import fuse_volume, load_volume
+from src.worker_pool import stage_pool
 
 
-def scalable_integrate_rgb_frames(path_dataset, intrinsic, config):
-    poses = []
+def scalable_integrate_rgb_frames(path_dataset, intrinsic, store, config,
+                                  pool=None):
     [color_files, depth_files] = get_rgbd_file_lists(path_dataset)
     n_files = len(color_files)
     n_fragments = int(math.ceil(float(n_files) / \
             config['n_frames_per_fragment']))
-    volume = o3d.pipelines.integration.ScalableTSDFVolume(
-        voxel_length=config["tsdf_cubic_size"] / 512.0,
-        sdf_trunc=0.04,
-        color_type=o3d.pipelines.integration.TSDFVolumeColorType.RGB8)
-
     pose_graph_fragment = o3d.io.read_pose_graph(
         join(path_dataset, config["template_refined_posegraph_optimized"]))
+    scene_poses = store.compose(posegraph_poses(pose_graph_fragment))
+    poses = list(zip(scene_poses.frames.tolist(), scene_poses.poses))
+
+    mesh_name = join(path_dataset, config["template_global_mesh"])
+    if config["scene_integration"] == "partitioned":
+        mesh = integrate_partitioned(color_files, depth_files, poses,
+                                     intrinsic, config, pool)
+    elif config["scene_integration"] == "fuse_fragments":
+        mesh = fuse_fragments(path_dataset, pose_graph_fragment, intrinsic,
+                              config)
+    elif config["tsdf_memory_limit_mb"] > 0:
+        # streamed to the mesh file, never assembled in memory
+        mesh = None
+        with OutOfCoreVolume(intrinsic, config,
+                             join(path_dataset,
+                                  config["folder_scene"])) as volume:
+            integrate_single_volume(color_files, depth_files, poses,
+                                    n_fragments, volume, config)
+            print("integrate scene :: %s." % volume.summary())
+            volume.write_triangle_mesh(mesh_name)
+    else:
+        # every frame is integrated once, so only the current one is kept
+        volume = make_integrator(
+            RGBDFrameCache(color_files, depth_files, config, max_bytes=0),
+            poses, intrinsic, config)
+        integrate_single_volume(color_files, depth_files, poses, n_fragments,
+                                volume, config)
+        mesh = volume.extract_triangle_mesh()
+    #if config["debug_mode"]:
+    #    o3d.visualization.draw_geometries([mesh])
 
-    for fragment_id in range(len(pose_graph_fragment.nodes)):
-        pose_graph_rgbd = o3d.io.read_pose_graph(
-            join(path_dataset,
-                 config["template_fragment_posegraph_optimized"] % fragment_id))
+    if mesh is not None:
+        o3d.io.write_triangle_mesh(mesh_name, mesh, False, True)
 
-        for frame_id in range(len(pose_graph_rgbd.nodes)):
-            frame_id_abs = fragment_id * \
-                    config['n_frames_per_fragment'] + frame_id
+    write_scene_trajectory(path_dataset, scene_poses, config)
+
+
+def integrate_single_volume(color_files, depth_files, poses, n_fragments,
+                            volume, config):
+    # frames are decoded ahead by background threads while integrating
+    frame_ids = [frame_id_abs for (frame_id_abs, _) in poses]
+    with PrefetchingFrameReader(color_files, depth_files, frame_ids, config,
+                                isinstance(volume,
+                                           LegacyIntegrator)) as frames:
+        for (n_done, (frame_id_abs, pose)) in enumerate(poses):
+            fragment_id = frame_id_abs // config['n_frames_per_fragment']
             print(
                 "Fragment %03d / %03d :: integrate rgbd frame %d (%d of %d)." %
-                (fragment_id, n_fragments - 1, frame_id_abs, frame_id + 1,
-                 len(pose_graph_rgbd.nodes)))
-            rgbd = read_rgbd_image(color_files[frame_id_abs],
-                                   depth_files[frame_id_abs], False, config)
-            pose = np.dot(pose_graph_fragment.nodes[fragment_id].pose,
-                          pose_graph_rgbd.nodes[frame_id].pose)
-            volume.integrate(rgbd, intrinsic, np.linalg.inv(pose))
-            poses.append(pose)
-
-    mesh = volume.extract_triangle_mesh()
-    mesh.compute_vertex_normals()
-    #if config["debug_mode"]:
-    #    o3d.visualization.draw_geometries([mesh])
+                (fragment_id, n_fragments - 1, frame_id_abs, n_done + 1,
+                 len(poses)))
+            volume.integrate(frames, frame_id_abs, pose)
+            report_progress(n_done + 1, len(poses), "frames")
+        print("integrate scene :: %s." % frames.summary())
 
-    mesh_name = join(path_dataset, config["template_global_mesh"])
-    o3d.io.write_triangle_mesh(mesh_name, mesh, False, True)
 
-    traj_name = join(path_dataset, config["template_global_traj"])
-    write_poses_to_log(traj_name, poses)
+def fuse_fragments(path_dataset, pose_graph_fragment, intrinsic, config):
+    # the fragment volumes saved by make_fragments are resampled into the
+    # scene at the refined fragment poses; no image is read
+    voxel_size = config["tsdf_cubic_size"] / 512.0
+    volume = TensorIntegrator(intrinsic,
+                              config,
+                              config["block_count"],
+                              device="CPU:0")
+    n_fragments = len(pose_graph_fragment.nodes)
+    for fragment_id in range(n_fragments):
+        print("Fragment %03d / %03d :: fuse fragment volume." %
+              (fragment_id, n_fragments - 1))
+        fragment_volume = load_volume(
+            join(path_dataset, config["template_fragment_volume"] % fragment_id))
+        fuse_volume(volume.voxel_grid, fragment_volume,
+                    pose_graph_fragment.nodes[fragment_id].pose, voxel_size, 16)
+        report_progress(fragment_id + 1, n_fragments, "fragments")
+    return volume.extract_triangle_mesh()
 
 
-def run(config):
-    print("integrate the whole RGBD sequence using estimated camera pose.")
+def integrate_tile(tile_min, tile_max, poses, color_files, depth_files,
+                   config):
+    # a tensor grid restricted to the blocks of the tile and one block
+    # around it, which marching cubes needs at the tile border
+    intrinsic = read_intrinsic(config)
+    block_size = config["tsdf_cubic_size"] / 512.0 * 16
+    block_bounds = (np.floor(tile_min / block_size).astype(int) - 1,
+                    np.floor(tile_max / block_size).astype(int) + 1)
+    block_count = int(np.prod(block_bounds[1] - block_bounds[0] + 1))
+    frames = RGBDFrameCache(color_files, depth_files, config, max_bytes=0)
+    volume = TensorIntegrator(intrinsic, config,
+                              min(block_count, config["block_count"]),
+                              block_bounds)
+    for (frame_id_abs, pose) in poses:
+        volume.integrate(frames, frame_id_abs, pose)
+    print("integrate scene :: tile %s - %s, %d frames." %
+          (tile_min, tile_max, len(poses)))
+    return crop_mesh_arrays(volume.extract_triangle_mesh(), tile_min,
+                            tile_max)
+
+
+def tiles_of_frames(poses, depth_files, config):
+    intrinsic = read_intrinsic(config)
+    return [
+        frame_tiles(o3d.io.read_image(depth_files[frame_id_abs]), pose,
+                    intrinsic, config) for (frame_id_abs, pose) in poses
+    ]
+
+
+def integrate_partitioned(color_files, depth_files, poses, intrinsic, config,
+                          pool):
+    # every tile integrates the frames that can reach it into its own tensor
+    # grid and keeps the triangles inside it; the tiles are stitched back
+    # into one mesh
+    chunk_size = config["n_frames_per_fragment"]
+    chunks = [
+        (poses[i:i + chunk_size], depth_files, config)
+        for i in range(0, len(poses), chunk_size)
+    ]
+    if pool is not None:
+        frame_tile_keys = pool.starmap(tiles_of_frames, chunks)
+    else:
+        frame_tile_keys = [tiles_of_frames(*chunk) for chunk in chunks]
+    tiles = partition_frames(poses, sum(frame_tile_keys, []), config)
+    print("integrate scene :: %d tiles, %d frame integrations for %d frames." %
+          (len(tiles), sum(len(tile_poses) for (_, _, tile_poses) in tiles),
+           len(poses)))
+    args = [(tile_min, tile_max, tile_poses, color_files, depth_files, config)
+            for (tile_min, tile_max, tile_poses) in tiles]
+    if pool is not None:
+        keys = [
+            "integrate_scene %s" % tile_min.tolist()
+            for (tile_min, _, _) in tiles
+        ]
+        costs = [len(tile_poses) for (_, _, tile_poses) in tiles]
+        tile_meshes = run_scheduled(pool, integrate_tile, args, keys, costs,
+                                    config, "tiles")
+    else:
+        tile_meshes = []
+        for tile_args in args:
+            tile_meshes.append(integrate_tile(*tile_args))
+            report_progress(len(tile_meshes), len(args), "tiles")
+    return merge_mesh_arrays(tile_meshes)
+
+
+def scene_manifest(config):
+    path_dataset = config["path_dataset"]
+    files = [
+        join(path_dataset, config["template_refined_posegraph_optimized"]),
+        join(path_dataset, config["template_fragment_pose_store"])
+    ]
     if config["path_intrinsic"]:
-        intrinsic = o3d.io.read_pinhole_camera_intrinsic(
-            config["path_intrinsic"])
+        files.append(config["path_intrinsic"])
+    if config["scene_integration"] == "fuse_fragments":
+        n_fragments = len(o3d.io.read_pose_graph(files[0]).nodes)
+        files += [
+            join(path_dataset, config["template_fragment_volume"] % fragment_id)
+            for fragment_id in range(n_fragments)
+        ]
+    [color_files, depth_files] = get_rgbd_file_lists(path_dataset)
+    return Manifest(config, "integrate_scene",
+                    MANIFEST_CONFIG_KEYS["integrate_scene"], files,
+                    color_files + depth_files)
+
+
+def run(config, pool=None):
+    print("integrate the whole RGBD sequence using estimated camera pose.")
+    # brings the fragment pose store up to date before it is hashed
+    store = fragment_pose_store(config["path_dataset"], config)
+    manifest = scene_manifest(config)
+    if manifest.is_current():
+        print("integrate scene :: up to date.")
+        return
+    intrinsic = read_intrinsic(config)
+    if config["scene_integration"] == "partitioned":
+        with stage_pool(config, pool) as pool:
+            scalable_integrate_rgb_frames(config["path_dataset"], intrinsic,
+                                          store, config, pool)
     else:
-        intrinsic = o3d.camera.PinholeCameraIntrinsic(
-            o3d.camera.PinholeCameraIntrinsicParameters.PrimeSenseDefault)
-    scalable_integrate_rgb_frames(config["path_dataset"], intrinsic, config)
+        scalable_integrate_rgb_frames(config["path_dataset"], intrinsic,
+                                      store, config)
+    manifest.record([
+        join(config["path_dataset"], config[template]) for template in
+        ["template_global_mesh", "template_global_traj",
+         "template_global_traj_store"]
+    ])
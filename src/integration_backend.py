@@ -0,0 +1,153 @@
+import numpy as np
+import open3d as o3d
+import open3d.core as o3c
+
+
+class LegacyIntegrator:
+    """TSDF integration into the legacy ``ScalableTSDFVolume``."""
+
+    def __init__(self, intrinsic, config):
+        self.intrinsic = intrinsic
+        self.volume = o3d.pipelines.integration.ScalableTSDFVolume(
+            voxel_length=config["tsdf_cubic_size"] / 512.0,
+            sdf_trunc=0.04,
+            color_type=o3d.pipelines.integration.TSDFVolumeColorType.RGB8)
+
+    def integrate(self, frames, index, pose):
+        rgbd = frames.get(index, False)
+        self.volume.integrate(rgbd, self.intrinsic, np.linalg.inv(pose))
+
+    def extract_triangle_mesh(self):
+        mesh = self.volume.extract_triangle_mesh()
+        mesh.compute_vertex_normals()
+        return mesh
+
+    def extract_point_cloud(self):
+        mesh = self.extract_triangle_mesh()
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = mesh.vertices
+        pcd.colors = mesh.vertex_colors
+        return pcd
+
+
+class TensorIntegrator:
+    """TSDF integration into an ``o3d.t.geometry.VoxelBlockGrid``.
+
+    Only the blocks in the frustum of each frame are touched, and the grid
+    is allocated up front for ``block_count`` blocks (see
+    ``estimate_block_count``), so it is not rehashed while integrating.
+    With ``block_bounds`` (lowest and highest block coordinate, inclusive)
+    only the blocks inside those bounds are integrated; they hold the same
+    values as in a grid of the whole scene.
+    """
+
+    def __init__(self,
+                 intrinsic,
+                 config,
+                 block_count,
+                 block_bounds=None,
+                 device=None):
+        self.config = config
+        self.device = o3c.Device(config["device"] if device is None else device)
+        self.intrinsic = o3c.Tensor(intrinsic.intrinsic_matrix,
+                                    o3c.float64)
+        self.voxel_size = config["tsdf_cubic_size"] / 512.0
+        self.block_bounds = block_bounds
+        self.trunc_voxel_multiplier = config["sdf_trunc"] / self.voxel_size
+        self.voxel_grid = o3d.t.geometry.VoxelBlockGrid(
+            attr_names=('tsdf', 'weight', 'color'),
+            attr_dtypes=(o3c.float32, o3c.float32, o3c.float32),
+            attr_channels=((1), (1), (3)),
+            voxel_size=self.voxel_size,
+            block_resolution=16,
+            block_count=block_count,
+            device=self.device)
+
+    def integrate(self, frames, index, pose):
+        (color, depth) = frames.get_raw(index)
+        color = o3d.t.geometry.Image.from_legacy(color).to(self.device)
+        depth = o3d.t.geometry.Image.from_legacy(depth).to(self.device)
+        extrinsic = o3c.Tensor(np.linalg.inv(pose), o3c.float64)
+        depth_scale = float(self.config["depth_scale"])
+        depth_max = float(self.config["depth_max"])
+        frustum_block_coords = self.voxel_grid.compute_unique_block_coordinates(
+            depth, self.intrinsic, extrinsic, depth_scale, depth_max,
+            self.trunc_voxel_multiplier)
+        if self.block_bounds is not None:
+            coords = frustum_block_coords.cpu().numpy()
+            inside = np.all((coords >= self.block_bounds[0]) &
+                            (coords <= self.block_bounds[1]),
+                            axis=1)
+            if not np.any(inside):
+                return
+            frustum_block_coords = o3c.Tensor(coords[inside]).to(self.device)
+        self.voxel_grid.integrate(frustum_block_coords, depth, color,
+                                  self.intrinsic, self.intrinsic, extrinsic,
+                                  depth_scale, depth_max,
+                                  self.trunc_voxel_multiplier)
+
+    def extract_triangle_mesh(self):
+        if self.voxel_grid.hashmap().size() == 0:
+            return o3d.geometry.TriangleMesh()
+        mesh = self.voxel_grid.extract_triangle_mesh().to(
+            o3c.Device("CPU:0")).to_legacy()
+        mesh.compute_vertex_normals()
+        return mesh
+
+    def save(self, filename):
+        self.voxel_grid.save(filename)
+
+    def extract_point_cloud(self):
+        # points and colors only, like the vertices of the legacy mesh
+        if self.voxel_grid.hashmap().size() == 0:
+            return o3d.geometry.PointCloud()
+        pcd_t = self.voxel_grid.extract_point_cloud().to(o3c.Device("CPU:0"))
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(
+            pcd_t.point.positions.numpy().astype(np.float64))
+        if "colors" in pcd_t.point:
+            pcd.colors = o3d.utility.Vector3dVector(
+                pcd_t.point.colors.numpy().astype(np.float64))
+        return pcd
+
+
+def estimate_block_count(frames, poses, intrinsic, config):
+    # backprojects every frame_stride-th frame at a coarse pixel stride,
+    # samples the truncation band along each ray and counts the distinct
+    # voxel blocks hit; the margin covers the frames and pixels skipped
+    pixel_stride = 4
+    block_size = config["tsdf_cubic_size"] / 512.0 * 16
+    trunc = config["sdf_trunc"]
+    fx, fy = intrinsic.get_focal_length()
+    cx, cy = intrinsic.get_principal_point()
+    keys = []
+    for (index, pose) in poses[::config["integration_block_count_frame_stride"]]:
+        (_, depth) = frames.get_raw(index)
+        depth = np.asarray(depth)[::pixel_stride, ::pixel_stride].astype(
+            np.float64) / config["depth_scale"]
+        (v, u) = np.nonzero((depth > 0) & (depth <= config["depth_max"]))
+        z = depth[v, u]
+        rays = np.stack([(u * pixel_stride - cx) / fx,
+                         (v * pixel_stride - cy) / fy,
+                         np.ones_like(z)])
+        for offset in (-trunc, 0.0, trunc):
+            points = rays * (z + offset)
+            points = pose[:3, :3] @ points + pose[:3, 3:]
+            keys.append(np.floor(points.T / block_size).astype(np.int64))
+    if len(keys) == 0:
+        return config["block_count"]
+    n_blocks = np.unique(np.concatenate(keys), axis=0).shape[0]
+    return max(int(n_blocks * config["integration_block_count_margin"]), 1000)
+
+
+def make_integrator(frames, poses, intrinsic, config, backend=None):
+    # poses are (frame index, camera pose) pairs of the frames to integrate
+    if backend is None:
+        backend = config["integration_backend"]
+    if backend == "tensor":
+        block_count = estimate_block_count(frames, poses, intrinsic, config)
+        print("integration :: tensor backend with %d blocks." % block_count)
+        return TensorIntegrator(intrinsic, config, block_count)
+    elif backend == "legacy":
+        return LegacyIntegrator(intrinsic, config)
+    raise ValueError("unknown integration_backend %s" % backend)
@@ -0,0 +1,178 @@
+import threading
+import time
+
+import numpy as np
+import open3d as o3d
+
+
+def texture_colors(color_image, texture_coordinates, out=None):
+    """Colors of the points of a RealSense point cloud.
+
+    ``texture_coordinates`` is the (N, 2) float32 array of
+    ``rs.points.get_texture_coordinates()``, ``color_image`` the (H, W, 3)
+    uint8 frame it was mapped to. Returns a contiguous (N, 3) float64 array
+    in [0, 1], written to ``out`` when given; coordinates are truncated to
+    pixels and points outside the image are black.
+    """
+    height, width = color_image.shape[:2]
+    # astype truncates toward zero, like int()
+    u = (texture_coordinates[:, 0] * width).astype(np.int64)
+    v = (texture_coordinates[:, 1] * height).astype(np.int64)
+    outside = (u < 0) | (u >= width) | (v < 0) | (v >= height)
+    pixels = v * width + u
+    pixels[outside] = 0
+    rgb = np.take(color_image.reshape(-1, color_image.shape[2]), pixels,
+                  axis=0)
+    if out is None:
+        out = np.empty(rgb.shape, dtype=np.float64)
+    np.divide(rgb, 255.0, out=out)
+    out[outside] = 0.0
+    return out
+
+
+# the preview flips z and then rotates by pi around z; both folded into one
+# transform of the camera vertices
+STREAM_TRANSFORM = np.matmul(
+    o3d.geometry.get_rotation_matrix_from_xyz([0, 0, np.pi]),
+    np.diag([1.0, 1.0, -1.0]))
+_STREAM_TRANSFORM_T = STREAM_TRANSFORM.T.astype(np.float32)
+
+
+class StreamBuffer:
+    """Positions and colors of one streamed frame.
+
+    The arrays are allocated once and shared with ``point_cloud``, an
+    ``o3d.t.geometry.PointCloud`` the renderer can hand to
+    ``update_geometry`` without copying.
+    """
+
+    def __init__(self, n_points):
+        self.positions = np.zeros((n_points, 3), dtype=np.float32)
+        self.colors = np.zeros((n_points, 3), dtype=np.float32)
+        self.point_cloud = o3d.t.geometry.PointCloud()
+        self.point_cloud.point.positions = o3d.core.Tensor.from_numpy(
+            self.positions)
+        self.point_cloud.point.colors = o3d.core.Tensor.from_numpy(
+            self.colors)
+
+    def fill(self, vertices, texture_coordinates, color_image):
+        np.matmul(vertices, _STREAM_TRANSFORM_T, out=self.positions)
+        texture_colors(color_image, texture_coordinates, out=self.colors)
+
+
+class StreamBuffers:
+    """Preallocated frame buffers with a single-slot latest-frame mailbox.
+
+    The capture thread fills the buffer returned by ``acquire`` and hands it
+    over with ``publish``; the renderer gets the newest published frame with
+    ``take``. A frame published before the previous one was taken replaces
+    it, so a slow renderer drops stale frames instead of queuing them. One
+    buffer is written, one waits in the mailbox and one is rendered, so
+    three buffers are enough for ``acquire`` to never block.
+    """
+
+    def __init__(self, n_points, n_buffers=3, stats=None):
+        self.n_points = n_points
+        self._free = [StreamBuffer(n_points) for i in range(n_buffers)]
+        self._mailbox = None
+        self._rendered = None
+        self._lock = threading.Lock()
+        # kept across buffers of different sizes of the same stream
+        self.stats = stats if stats is not None else StreamStats()
+
+    def acquire(self):
+        with self._lock:
+            return self._free.pop()
+
+    def publish(self, buffer):
+        # returns whether the mailbox was empty, i.e. whether the renderer
+        # has to be woken up for this frame
+        with self._lock:
+            stale = self._mailbox
+            self._mailbox = buffer
+            if stale is not None:
+                self._free.append(stale)
+                self.stats.n_dropped += 1
+            return stale is None
+
+    def take(self):
+        # the buffer rendered before is released: the renderer has copied it
+        # to the GPU by the time it asks for the next frame
+        with self._lock:
+            buffer = self._mailbox
+            if buffer is None:
+                return None
+            self._mailbox = None
+            if self._rendered is not None:
+                self._free.append(self._rendered)
+            self._rendered = buffer
+            return buffer
+
+
+class StreamStats:
+    """Frame counts and busy times of the capture thread and the renderer."""
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.n_captured = 0
+        self.n_rendered = 0
+        self.n_dropped = 0
+        self.capture_time = 0.0
+        self.render_time = 0.0
+        self.last_render_time = 0.0
+
+    def rates(self):
+        # frames per second captured, rendered and dropped
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        return (self.n_captured / elapsed, self.n_rendered / elapsed,
+                self.n_dropped / elapsed)
+
+    def summary(self):
+        (captured, rendered, dropped) = self.rates()
+        return ("stream captured %.1f fps (%.1f ms per frame), rendered "
+                "%.1f fps (%.1f ms per frame), dropped %.1f fps" %
+                (captured, 1000.0 * self.capture_time / max(
+                    self.n_captured, 1), rendered, 1000.0 *
+                 self.render_time / max(self.n_rendered, 1), dropped))
+
+
+def decimate_grid(values, width, stride):
+    # every stride-th pixel of every stride-th row of per-pixel values stored
+    # row by row, e.g. the vertices or texture coordinates of a depth frame
+    if stride == 1:
+        return values
+    grid = values.reshape(-1, width, values.shape[-1])
+    return grid[::stride, ::stride].reshape(-1, values.shape[-1])
+
+
+class LevelOfDetail:
+    """Grid stride of the live point cloud, adapted to a target frame time.
+
+    ``update`` gets the time the capture thread and the renderer spent on a
+    frame. Every ``interval`` frames the stride grows if frames took longer
+    than ``target_frame_time``, and shrinks if the denser grid (whose cost
+    grows with the number of points) is expected to still fit in the
+    target. Dropped frames are not counted: a camera faster than the target
+    rate drops frames whatever the stride.
+    """
+
+    def __init__(self, target_frame_time, max_stride=8, interval=15):
+        self.target_frame_time = target_frame_time
+        self.max_stride = max_stride
+        self.interval = interval
+        self.stride = 1
+        self._frame_times = []
+
+    def update(self, frame_time):
+        self._frame_times.append(frame_time)
+        if len(self._frame_times) < self.interval:
+            return self.stride
+        frame_time = float(np.median(self._frame_times))
+        self._frame_times = []
+        if frame_time > self.target_frame_time and \
+                self.stride < self.max_stride:
+            self.stride += 1
+        elif self.stride > 1 and frame_time * (
+                self.stride / (self.stride - 1.0))**2 < self.target_frame_time:
+            self.stride -= 1
+        return self.stride
@@ -8,8 +8,9 @@
 # examples/python/reconstruction_system/make_fragments.py
 
 import math
-import multiprocessing
 import os, sys
+import threading
+import uuid
 import numpy as np
 import open3d as o3d
 
@@ -20,27 +21,34 @@ from src.open3d_example import *
 
 #sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from src.optimize_posegraph import optimize_posegraph_for_fragment
+from src.frame_cache import RGBDFrameCache
+from src.integration_backend import make_integrator
+from src.manifest import Manifest, MANIFEST_CONFIG_KEYS
+from src.pose_store import build_fragment_pose_store
+from src.worker_pool import stage_pool, process_state, release_process_state
+from src.progress import report_progress
+from src.task_scheduler import run_scheduled, timed_call
 
 # check opencv python package
 with_opencv = initialize_opencv()
 if with_opencv:
     from src.opencv_pose_estimation import pose_estimation
+    from src.feature_store import FeatureStore
+    from src.place_recognition import KeyframeIndex
 
 
-def register_one_rgbd_pair(s, t, color_files, depth_files, intrinsic,
+def register_one_rgbd_pair(s, t, frame_cache, feature_store, intrinsic,
                            with_opencv, config):
-    source_rgbd_image = read_rgbd_image(color_files[s], depth_files[s], True,
-                                        config)
-    target_rgbd_image = read_rgbd_image(color_files[t], depth_files[t], True,
-                                        config)
+    source_rgbd_image = frame_cache.get(s, True)
+    target_rgbd_image = frame_cache.get(t, True)
 
     option = o3d.pipelines.odometry.OdometryOption()
     option.depth_diff_max = config["depth_diff_max"]
     if abs(s - t) != 1:
         if with_opencv:
-            success_5pt, odo_init = pose_estimation(source_rgbd_image,
-                                                    target_rgbd_image,
-                                                    intrinsic, False)
+            success_5pt, odo_init = pose_estimation(
+                source_rgbd_image, target_rgbd_image, intrinsic, False,
+                feature_store.get(s), feature_store.get(t))
             if success_5pt:
                 [success, trans, info
                 ] = o3d.pipelines.odometry.compute_rgbd_odometry(
@@ -57,86 +65,122 @@ def register_one_rgbd_pair(s, t, color_files, depth_files, intrinsic,
         return [success, trans, info]
 
 
-def make_posegraph_for_fragment(path_dataset, sid, eid, color_files,
-                                depth_files, fragment_id, n_fragments,
-                                intrinsic, with_opencv, config):
-    o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Error)
+def select_loop_closure_pairs(sid, eid, feature_store, fragment_id,
+                              n_fragments, with_opencv, config):
+    # None means every keyframe pair is tried
+    if config["loop_closure_selection"] != "vocabulary" or not with_opencv:
+        return None
+    keyframe_ids = [
+        i for i in range(sid, eid) if i % config['n_keyframes_per_n_frame'] == 0
+    ]
+    descriptors = [feature_store.get(i).descriptors for i in keyframe_ids]
+    index = KeyframeIndex(keyframe_ids, descriptors,
+                          config["loop_closure_vocabulary_size"])
+    pairs = index.candidate_pairs(config["loop_closure_top_k"],
+                                  config["loop_closure_min_similarity"])
+    n_pairs = len(keyframe_ids) * (len(keyframe_ids) - 1) // 2
+    print("Fragment %03d / %03d :: testing %d of %d keyframe pairs for loop "
+          "closure (%d pruned)." % (fragment_id, n_fragments - 1, len(pairs),
+                                    n_pairs, n_pairs - len(pairs)))
+    return pairs
+
+
+def fragment_rgbd_pairs(sid, eid, loop_closure_pairs, config):
+    # frame pairs registered for a fragment, as (s, t, loop_closure);
+    # t == s + 1 are the odometry pairs
+    pairs = []
+    for s in range(sid, eid):
+        for t in range(s + 1, eid):
+            # keyframe loop closure
+            loop_closure = s % config['n_keyframes_per_n_frame'] == 0 \
+                    and t % config['n_keyframes_per_n_frame'] == 0 \
+                    and (loop_closure_pairs is None
+                         or (s, t) in loop_closure_pairs)
+            if t == s + 1 or loop_closure:
+                pairs.append((s, t, loop_closure))
+    return pairs
+
+
+def posegraph_from_rgbd_pairs(sid, pairs, results):
     pose_graph = o3d.pipelines.registration.PoseGraph()
     trans_odometry = np.identity(4)
     pose_graph.nodes.append(
         o3d.pipelines.registration.PoseGraphNode(trans_odometry))
-    for s in range(sid, eid):
-        for t in range(s + 1, eid):
-            # odometry
-            if t == s + 1:
-                #print(
-                #    "Fragment %03d / %03d :: RGBD matching between frame : %d and %d"
-                #    % (fragment_id, n_fragments - 1, s, t))
-                [success, trans,
-                 info] = register_one_rgbd_pair(s, t, color_files, depth_files,
-                                                intrinsic, with_opencv, config)
-                trans_odometry = np.dot(trans, trans_odometry)
-                trans_odometry_inv = np.linalg.inv(trans_odometry)
-                pose_graph.nodes.append(
-                    o3d.pipelines.registration.PoseGraphNode(
-                        trans_odometry_inv))
-                pose_graph.edges.append(
-                    o3d.pipelines.registration.PoseGraphEdge(s - sid,
-                                                             t - sid,
-                                                             trans,
-                                                             info,
-                                                             uncertain=False))
+    for (s, t, loop_closure), (success, trans, info) in zip(pairs, results):
+        # odometry
+        if t == s + 1:
+            trans_odometry = np.dot(trans, trans_odometry)
+            trans_odometry_inv = np.linalg.inv(trans_odometry)
+            pose_graph.nodes.append(
+                o3d.pipelines.registration.PoseGraphNode(trans_odometry_inv))
+            pose_graph.edges.append(
+                o3d.pipelines.registration.PoseGraphEdge(s - sid,
+                                                         t - sid,
+                                                         trans,
+                                                         info,
+                                                         uncertain=False))
 
-            # keyframe loop closure
-            if s % config['n_keyframes_per_n_frame'] == 0 \
-                    and t % config['n_keyframes_per_n_frame'] == 0:
-                #print(
-                #    "Fragment %03d / %03d :: RGBD matching between frame : %d and %d"
-                #    % (fragment_id, n_fragments - 1, s, t))
-                [success, trans,
-                 info] = register_one_rgbd_pair(s, t, color_files, depth_files,
-                                                intrinsic, with_opencv, config)
-                if success:
-                    pose_graph.edges.append(
-                        o3d.pipelines.registration.PoseGraphEdge(
-                            s - sid, t - sid, trans, info, uncertain=True))
+        # keyframe loop closure
+        if loop_closure and success:
+            pose_graph.edges.append(
+                o3d.pipelines.registration.PoseGraphEdge(s - sid,
+                                                         t - sid,
+                                                         trans,
+                                                         info,
+                                                         uncertain=True))
+    return pose_graph
+
+
+def make_posegraph_for_fragment(path_dataset, sid, eid, frame_cache,
+                                feature_store, fragment_id, n_fragments,
+                                intrinsic, with_opencv, config):
+    o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Error)
+    loop_closure_pairs = select_loop_closure_pairs(sid, eid, feature_store,
+                                                   fragment_id, n_fragments,
+                                                   with_opencv, config)
+    pairs = fragment_rgbd_pairs(sid, eid, loop_closure_pairs, config)
+    #print(
+    #    "Fragment %03d / %03d :: RGBD matching between frame : %d and %d"
+    #    % (fragment_id, n_fragments - 1, s, t))
+    results = [
+        register_one_rgbd_pair(s, t, frame_cache, feature_store, intrinsic,
+                               with_opencv, config) for (s, t, _) in pairs
+    ]
+    pose_graph = posegraph_from_rgbd_pairs(sid, pairs, results)
     o3d.io.write_pose_graph(
         join(path_dataset, config["template_fragment_posegraph"] % fragment_id),
         pose_graph)
 
 
-def integrate_rgb_frames_for_fragment(color_files, depth_files, fragment_id,
-                                      n_fragments, pose_graph_name, intrinsic,
-                                      config):
+def integrate_rgb_frames_for_fragment(frame_cache, fragment_id, n_fragments,
+                                      pose_graph_name, intrinsic, config):
     pose_graph = o3d.io.read_pose_graph(pose_graph_name)
-    volume = o3d.pipelines.integration.ScalableTSDFVolume(
-        voxel_length=config["tsdf_cubic_size"] / 512.0,
-        sdf_trunc=0.04,
-        color_type=o3d.pipelines.integration.TSDFVolumeColorType.RGB8)
-    for i in range(len(pose_graph.nodes)):
-        i_abs = fragment_id * config['n_frames_per_fragment'] + i
+    poses = [(fragment_id * config['n_frames_per_fragment'] + i,
+              pose_graph.nodes[i].pose) for i in range(len(pose_graph.nodes))]
+    # fragment volumes fused by integrate_scene have to be tensor grids
+    volume = make_integrator(
+        frame_cache, poses, intrinsic, config, "tensor"
+        if config["scene_integration"] == "fuse_fragments" else None)
+    for i, (i_abs, pose) in enumerate(poses):
         print(
             "Fragment %03d / %03d :: integrate rgbd frame %d (%d of %d)." %
             (fragment_id, n_fragments - 1, i_abs, i + 1, len(pose_graph.nodes)))
-        rgbd = read_rgbd_image(color_files[i_abs], depth_files[i_abs], False,
-                               config)
-        pose = pose_graph.nodes[i].pose
-        volume.integrate(rgbd, intrinsic, np.linalg.inv(pose))
-    mesh = volume.extract_triangle_mesh()
-    mesh.compute_vertex_normals()
-    return mesh
-
-
-def make_pointcloud_for_fragment(path_dataset, color_files, depth_files,
-                                 fragment_id, n_fragments, intrinsic, config):
-    mesh = integrate_rgb_frames_for_fragment(
-        color_files, depth_files, fragment_id, n_fragments,
+        volume.integrate(frame_cache, i_abs, pose)
+    return volume
+
+
+def make_pointcloud_for_fragment(path_dataset, frame_cache, fragment_id,
+                                 n_fragments, intrinsic, config):
+    volume = integrate_rgb_frames_for_fragment(
+        frame_cache, fragment_id, n_fragments,
         join(path_dataset,
              config["template_fragment_posegraph_optimized"] % fragment_id),
         intrinsic, config)
-    pcd = o3d.geometry.PointCloud()
-    pcd.points = mesh.vertices
-    pcd.colors = mesh.vertex_colors
+    if config["scene_integration"] == "fuse_fragments":
+        volume.save(
+            join(path_dataset,
+                 config["template_fragment_volume"] % fragment_id))
+    pcd = volume.extract_point_cloud()
     pcd_name = join(path_dataset,
                     config["template_fragment_pointcloud"] % fragment_id)
     o3d.io.write_point_cloud(pcd_name,
@@ -146,46 +190,243 @@ def make_pointcloud_for_fragment(path_dataset, color_files, depth_files,
                              compressed=True)
 
 
-def process_single_fragment(fragment_id, color_files, depth_files, n_files,
-                            n_fragments, config):
+def read_intrinsic(config):
     if config["path_intrinsic"]:
-        intrinsic = o3d.io.read_pinhole_camera_intrinsic(
-            config["path_intrinsic"])
+        return process_state(
+            ("intrinsic", config["path_intrinsic"]),
+            lambda: o3d.io.read_pinhole_camera_intrinsic(config[
+                "path_intrinsic"]))
     else:
-        intrinsic = o3d.camera.PinholeCameraIntrinsic(
+        return o3d.camera.PinholeCameraIntrinsic(
             o3d.camera.PinholeCameraIntrinsicParameters.PrimeSenseDefault)
+
+
+def process_single_fragment(fragment_id, color_files, depth_files, n_files,
+                            n_fragments, config):
+    intrinsic = read_intrinsic(config)
     sid = fragment_id * config['n_frames_per_fragment']
     eid = min(sid + config['n_frames_per_fragment'], n_files)
 
-    make_posegraph_for_fragment(config["path_dataset"], sid, eid, color_files,
-                                depth_files, fragment_id, n_fragments,
+    # frames are decoded once and shared by odometry, loop closure and
+    # integration of this fragment
+    frame_cache = RGBDFrameCache(color_files, depth_files, config)
+    feature_store = FeatureStore(frame_cache, intrinsic,
+                                 config) if with_opencv else None
+    make_posegraph_for_fragment(config["path_dataset"], sid, eid, frame_cache,
+                                feature_store, fragment_id, n_fragments,
                                 intrinsic, with_opencv, config)
     optimize_posegraph_for_fragment(config["path_dataset"], fragment_id, config)
-    make_pointcloud_for_fragment(config["path_dataset"], color_files,
-                                 depth_files, fragment_id, n_fragments,
-                                 intrinsic, config)
+    make_pointcloud_for_fragment(config["path_dataset"], frame_cache,
+                                 fragment_id, n_fragments, intrinsic, config)
+    print("Fragment %03d / %03d :: %s." %
+          (fragment_id, n_fragments - 1, frame_cache.summary()))
 
 
-def run(config):
+def pair_worker_state(color_files, depth_files, run_token, config):
+    # frame cache and feature store of one pool worker (process or thread),
+    # reused by all tasks of a run
+    state = process_state(("make_fragments", threading.get_ident()), dict)
+    if state.get("run_token") != run_token:
+        intrinsic = read_intrinsic(config)
+        frame_cache = RGBDFrameCache(color_files, depth_files, config)
+        state.clear()
+        state["run_token"] = run_token
+        state["intrinsic"] = intrinsic
+        state["frame_cache"] = frame_cache
+        state["feature_store"] = FeatureStore(frame_cache, intrinsic,
+                                              config) if with_opencv else None
+    return state
+
+
+def plan_fragment_pairs(fragment_id, color_files, depth_files, n_files,
+                        n_fragments, run_token, config):
+    state = pair_worker_state(color_files, depth_files, run_token, config)
+    sid = fragment_id * config['n_frames_per_fragment']
+    eid = min(sid + config['n_frames_per_fragment'], n_files)
+    loop_closure_pairs = select_loop_closure_pairs(sid, eid,
+                                                   state["feature_store"],
+                                                   fragment_id, n_fragments,
+                                                   with_opencv, config)
+    return fragment_rgbd_pairs(sid, eid, loop_closure_pairs, config)
+
+
+def register_rgbd_pairs(pairs, color_files, depth_files, run_token, config):
+    o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Error)
+    state = pair_worker_state(color_files, depth_files, run_token, config)
+    return [
+        register_one_rgbd_pair(s, t, state["frame_cache"],
+                               state["feature_store"], state["intrinsic"],
+                               with_opencv, config) for (s, t, _) in pairs
+    ]
+
+
+def join_fragment(fragment_id, pairs, results, color_files, depth_files,
+                  n_files, n_fragments, run_token, config):
+    state = pair_worker_state(color_files, depth_files, run_token, config)
+    sid = fragment_id * config['n_frames_per_fragment']
+    pose_graph = posegraph_from_rgbd_pairs(sid, pairs, results)
+    o3d.io.write_pose_graph(
+        join(config["path_dataset"],
+             config["template_fragment_posegraph"] % fragment_id), pose_graph)
+    optimize_posegraph_for_fragment(config["path_dataset"], fragment_id, config)
+    make_pointcloud_for_fragment(config["path_dataset"], state["frame_cache"],
+                                 fragment_id, n_fragments, state["intrinsic"],
+                                 config)
+    print("Fragment %03d / %03d :: %s." %
+          (fragment_id, n_fragments - 1, state["frame_cache"].summary()))
+
+
+def make_fragments_by_pairs(pool, fragment_ids, color_files, depth_files,
+                            n_files, n_fragments, config):
+    # candidate selection per fragment, then the frame pairs of all fragments
+    # as one set of tasks, then assembling, optimizing and integrating every
+    # fragment; keeps the pool busy when there are fewer fragments than
+    # workers
+    run_token = uuid.uuid4().hex
+    plans = dict(
+        zip(
+            fragment_ids,
+            pool.starmap(plan_fragment_pairs,
+                         [(fragment_id, color_files, depth_files, n_files,
+                           n_fragments, run_token, config)
+                          for fragment_id in fragment_ids])))
+
+    chunk_size = config["fragment_pair_chunk_size"]
+    args = []
+    keys = []
+    costs = []
+    owners = []
+    for fragment_id, pairs in plans.items():
+        for i in range(0, len(pairs), chunk_size):
+            chunk = pairs[i:i + chunk_size]
+            args.append((chunk, color_files, depth_files, run_token, config))
+            keys.append("make_fragments %d-%d x%d" %
+                        (chunk[0][0], chunk[0][1], len(chunk)))
+            # loop closures add feature matching and a 3D RANSAC
+            costs.append(
+                sum(1.0 if t == s + 1 else 3.0 for (s, t, _) in chunk))
+            owners.append(fragment_id)
+    chunk_results = run_scheduled(pool, register_rgbd_pairs, args, keys,
+                                  costs, config, "frame pair chunks")
+
+    results = {fragment_id: [] for fragment_id in fragment_ids}
+    for fragment_id, chunk_result in zip(owners, chunk_results):
+        results[fragment_id].extend(chunk_result)
+    pool.starmap(join_fragment,
+                 [(fragment_id, plans[fragment_id], results[fragment_id],
+                   color_files, depth_files, n_files, n_fragments, run_token,
+                   config) for fragment_id in fragment_ids])
 
-    print("making fragments from RGBD sequence.")
-    make_clean_folder(join(config["path_dataset"], config["folder_fragment"]))
 
+def fragment_manifest(fragment_id, color_files, depth_files, n_files,
+                      config):
+    # a fragment only depends on its own frames
+    sid = fragment_id * config['n_frames_per_fragment']
+    eid = min(sid + config['n_frames_per_fragment'], n_files)
+    return Manifest(
+        config, "make_fragments/fragment_%03d" % fragment_id,
+        MANIFEST_CONFIG_KEYS["make_fragments"],
+        [config["path_intrinsic"]] if config["path_intrinsic"] else [],
+        color_files[sid:eid] + depth_files[sid:eid], [with_opencv])
+
+
+def fragment_outputs(fragment_id, config):
+    templates = [
+        "template_fragment_posegraph", "template_fragment_posegraph_optimized",
+        "template_fragment_pointcloud"
+    ]
+    if config["scene_integration"] == "fuse_fragments":
+        templates.append("template_fragment_volume")
+    return [
+        join(config["path_dataset"], config[template] % fragment_id)
+        for template in templates
+    ]
+
+
+def remove_fragments_from(first_fragment_id, config):
+    # outputs of fragments past the end of a shortened sequence
+    templates = [
+        "template_fragment_posegraph", "template_fragment_posegraph_optimized",
+        "template_fragment_pointcloud", "template_fragment_volume"
+    ]
+    fragment_id = first_fragment_id
+    removed = False
+    while True:
+        names = [
+            join(config["path_dataset"], config[template] % fragment_id)
+            for template in templates
+        ]
+        names = [name for name in names if exists(name)]
+        if len(names) == 0:
+            return removed
+        for name in names:
+            os.remove(name)
+        removed = True
+        fragment_id += 1
+
+
+def run(config, pool=None):
+
+    print("making fragments from RGBD sequence.")
     [color_files, depth_files] = get_rgbd_file_lists(config["path_dataset"])
     n_files = len(color_files)
     n_fragments = int(
         math.ceil(float(n_files) / config['n_frames_per_fragment']))
 
-    if config["python_multi_threading"] is True:
-        max_workers = min(max(1, multiprocessing.cpu_count() - 1), n_fragments)
-        # Prevent over allocation of open mp threads in child processes
-        os.environ['OMP_NUM_THREADS'] = '1'
-        mp_context = multiprocessing.get_context('spawn')
-        with mp_context.Pool(processes=max_workers) as pool:
-            args = [(fragment_id, color_files, depth_files, n_files,
-                     n_fragments, config) for fragment_id in range(n_fragments)]
-            pool.starmap(process_single_fragment, args)
+    manifests = [
+        fragment_manifest(fragment_id, color_files, depth_files, n_files,
+                          config) for fragment_id in range(n_fragments)
+    ]
+    if config["incremental"]:
+        # fragments whose frames and parameters are unchanged are kept
+        os.makedirs(join(config["path_dataset"], config["folder_fragment"]),
+                    exist_ok=True)
+        removed = remove_fragments_from(n_fragments, config)
+        fragment_ids = [
+            fragment_id for fragment_id in range(n_fragments)
+            if not manifests[fragment_id].is_current()
+        ]
+        print("making fragments :: %d of %d fragments up to date." %
+              (n_fragments - len(fragment_ids), n_fragments))
     else:
-        for fragment_id in range(n_fragments):
-            process_single_fragment(fragment_id, color_files, depth_files,
-                                    n_files, n_fragments, config)
+        make_clean_folder(
+            join(config["path_dataset"], config["folder_fragment"]))
+        fragment_ids = list(range(n_fragments))
+        removed = False
+    if len(fragment_ids) == 0 and not removed:
+        return
+
+    with stage_pool(config, pool) as pool:
+        if pool is not None:
+            # every worker keeps a frame cache of its own, so the budget of
+            # the machine is split between them
+            config = dict(config,
+                          frame_cache_size_mb=config["frame_cache_size_mb"] /
+                          pool.max_workers)
+        if pool is not None and \
+                (config["fragment_parallelism"] == "pair" or
+                 (config["fragment_parallelism"] == "auto" and
+                  len(fragment_ids) < pool.max_workers)):
+            make_fragments_by_pairs(pool, fragment_ids, color_files,
+                                    depth_files, n_files, n_fragments, config)
+        elif pool is not None:
+            args = [(fragment_id, color_files, depth_files, n_files,
+                     n_fragments, config) for fragment_id in fragment_ids]
+            for (n_done, _) in enumerate(
+                    pool.imap_unordered(timed_call,
+                                        [(i, process_single_fragment, a)
+                                         for (i, a) in enumerate(args)])):
+                report_progress(n_done + 1, len(args), "fragments")
+        else:
+            for (n_done, fragment_id) in enumerate(fragment_ids):
+                process_single_fragment(fragment_id, color_files, depth_files,
+                                        n_files, n_fragments, config)
+                report_progress(n_done + 1, len(fragment_ids), "fragments")
+        # the pool outlives the stage; frame caches and feature stores of
+        # its workers are not needed by the later stages
+        if pool is not None:
+            pool.broadcast(release_process_state, ("make_fragments",))
+    for fragment_id in fragment_ids:
+        manifests[fragment_id].record(fragment_outputs(fragment_id, config))
+    # the later stages read the fragment poses from one binary store
+    build_fragment_pose_store(config["path_dataset"], config)
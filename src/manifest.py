@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import threading
+
+from src.open3d_example import join, file_content_hash
+
+# config keys each unit of work depends on; keys that only change how the
+# work is scheduled or cached are left out
+MANIFEST_CONFIG_KEYS = {
+    "make_fragments": [
+        "n_frames_per_fragment", "n_keyframes_per_n_frame", "depth_scale",
+        "depth_max", "depth_diff_max", "preference_loop_closure_odometry",
+        "loop_closure_selection", "loop_closure_vocabulary_size",
+        "loop_closure_top_k", "loop_closure_min_similarity",
+        "tsdf_cubic_size", "sdf_trunc", "integration_backend",
+        "scene_integration"
+    ],
+    "register_fragments": [
+        "voxel_size", "icp_method", "global_registration",
+        "global_registration_max_rmse", "global_registration_min_fitness",
+        "global_registration_ransac_small", "global_registration_ransac_large",
+        "global_registration_ransac_chunk", "global_registration_time_budget",
+        "pair_selection", "pair_selection_cell_size",
+        "pair_selection_descriptor_top_k", "pair_selection_max_per_fragment",
+        "pair_selection_min_overlap", "preference_loop_closure_registration"
+    ],
+    # single registration pairs: odometry pairs are aligned with ICP, loop
+    # closures with global registration
+    "register_fragments odometry": ["voxel_size", "icp_method"],
+    "register_fragments loop closure": [
+        "voxel_size", "global_registration", "global_registration_max_rmse",
+        "global_registration_min_fitness", "global_registration_ransac_small",
+        "global_registration_ransac_large", "global_registration_ransac_chunk",
+        "global_registration_time_budget"
+    ],
+    "refine_registration": [
+        "voxel_size", "icp_method", "preference_loop_closure_registration"
+    ],
+    "refine_registration pair": ["voxel_size", "icp_method"],
+    "integrate_scene": [
+        "n_frames_per_fragment", "depth_scale", "depth_max",
+        "tsdf_cubic_size", "sdf_trunc", "integration_backend",
+        "scene_integration", "scene_integration_tile_size",
+        "tsdf_memory_limit_mb", "tsdf_extraction_tile_blocks"
+    ],
+}
+
+
+def frame_signatures(filenames):
+    # frames are identified by name, size and modification time instead of
+    # being read; appended or replaced frames change their signature
+    signatures = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        signatures.append(
+            [os.path.basename(filename), stat.st_size, stat.st_mtime_ns])
+    return signatures
+
+
+def _output_signature(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class Manifest:
+    """Digest of the inputs of one unit of work and what it produced.
+
+    The digest covers the values of ``config_keys``, the content of the
+    upstream ``files``, the signatures of the ``frames`` and any other JSON
+    serializable ``values``. With ``config["incremental"]`` a unit whose
+    manifest holds the same digest, and whose outputs are still the ones it
+    recorded, is up to date and can be skipped. Manifests are written in
+    ``config["folder_manifest"]`` of the dataset whether or not the run is
+    incremental, so a later incremental run can start from them.
+    """
+
+    def __init__(self, config, name, config_keys, files=(), frames=(),
+                 values=()):
+        self.incremental = config["incremental"]
+        self.filename = join(config["path_dataset"], config["folder_manifest"],
+                             name + ".json")
+        inputs = {
+            "config": {key: config.get(key) for key in config_keys},
+            "files": [[os.path.basename(filename),
+                       file_content_hash(filename)] for filename in files],
+            "frames": frame_signatures(frames),
+            "values": list(values)
+        }
+        self.digest = hashlib.sha1(
+            json.dumps(inputs, sort_keys=True,
+                       default=str).encode("utf-8")).hexdigest()
+        self._recorded = None
+        if os.path.exists(self.filename):
+            with open(self.filename) as manifest_file:
+                try:
+                    self._recorded = json.load(manifest_file)
+                except ValueError:
+                    self._recorded = None
+
+    def is_current(self):
+        if not self.incremental or self._recorded is None or \
+                self._recorded["digest"] != self.digest:
+            return False
+        for (filename, signature) in self._recorded["outputs"].items():
+            if not os.path.exists(filename) or \
+                    _output_signature(filename) != signature:
+                return False
+        return True
+
+    def result(self):
+        # what was recorded with the outputs, only valid if is_current()
+        return self._recorded.get("result")
+
+    def record(self, outputs=(), result=None):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        manifest = {
+            "digest": self.digest,
+            "outputs": {
+                filename: _output_signature(filename) for filename in outputs
+            },
+            "result": result
+        }
+        temp_name = "%s.%d.%d.tmp" % (self.filename, os.getpid(),
+                                      threading.get_ident())
+        with open(temp_name, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temp_name, self.filename)
+        self._recorded = manifest
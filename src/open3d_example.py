@@ -7,6 +7,7 @@
 
 import open3d as o3d
 import numpy as np
+import hashlib
 import os
 import shutil
 import sys
@@ -222,6 +223,14 @@ def make_clean_folder(path_folder):
         makedirs(path_folder)
 
 
+def file_content_hash(filename, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
 def check_folder_structure(path_dataset):
     if isfile(path_dataset) and path_dataset.endswith(".bag"):
         return
@@ -233,41 +242,22 @@ def check_folder_structure(path_dataset):
 
 
 def write_poses_to_log(filename, poses):
+    # one formatting call per pose instead of one per matrix row
+    poses = np.asarray(poses, dtype=np.float64).reshape(-1, 16)
+    template = '%d %d %d\n' + '%.8f %.8f %.8f %.8f\n' * 4
+    ids = np.arange(poses.shape[0])
     with open(filename, 'w') as f:
-        for i, pose in enumerate(poses):
-            f.write('{} {} {}\n'.format(i, i, i + 1))
-            f.write('{0:.8f} {1:.8f} {2:.8f} {3:.8f}\n'.format(
-                pose[0, 0], pose[0, 1], pose[0, 2], pose[0, 3]))
-            f.write('{0:.8f} {1:.8f} {2:.8f} {3:.8f}\n'.format(
-                pose[1, 0], pose[1, 1], pose[1, 2], pose[1, 3]))
-            f.write('{0:.8f} {1:.8f} {2:.8f} {3:.8f}\n'.format(
-                pose[2, 0], pose[2, 1], pose[2, 2], pose[2, 3]))
-            f.write('{0:.8f} {1:.8f} {2:.8f} {3:.8f}\n'.format(
-                pose[3, 0], pose[3, 1], pose[3, 2], pose[3, 3]))
+        f.write(''.join(
+            template % ((i, i, i + 1) + tuple(pose))
+            for (i, pose) in zip(ids.tolist(), poses.tolist())))
 
 
 def read_poses_from_log(traj_log):
-    import numpy as np
-
-    trans_arr = []
+    # every entry is "%d (src) %d (tgt) %f (fitness)" followed by the 16
+    # values of the pose, so the whole file parses as rows of 19 numbers
     with open(traj_log) as f:
-        content = f.readlines()
-
-        # Load .log file.
-        for i in range(0, len(content), 5):
-            # format %d (src) %d (tgt) %f (fitness)
-            data = list(map(float, content[i].strip().split(' ')))
-            ids = (int(data[0]), int(data[1]))
-            fitness = data[2]
-
-            # format %f x 16
-            T_gt = np.array(
-                list(map(float, (''.join(
-                    content[i + 1:i + 5])).strip().split()))).reshape((4, 4))
-
-            trans_arr.append(T_gt)
-
-    return trans_arr
+        values = np.array(f.read().split(), dtype=np.float64)
+    return list(values.reshape(-1, 19)[:, 3:].reshape(-1, 4, 4))
 
 
 flip_transform = [[1, 0, 0, 0], [0, -1, 0, 0], [0, 0, -1, 0], [0, 0, 0, 1]]
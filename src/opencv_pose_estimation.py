@@ -17,17 +17,21 @@
 import numpy as np
 import cv2
 from matplotlib import pyplot as plt  # for visualizing feature matching
-import copy
 
 
-def pose_estimation(source_rgbd_image, target_rgbd_image,
-                    pinhole_camera_intrinsic, debug_draw_correspondences):
-    success = False
-    trans = np.identity(4)
+class FrameFeatures:
+
+    def __init__(self, keypoints, descriptors, points_xyz):
+        # keypoints: (n, 2) pixel coordinates, descriptors: (n, 32) ORB,
+        # points_xyz: (3, n) depth backprojection of the keypoints
+        self.keypoints = keypoints
+        self.descriptors = descriptors
+        self.points_xyz = points_xyz
+
 
+def compute_frame_features(rgbd_image, pinhole_camera_intrinsic):
     # transform double array to unit8 array
-    color_cv_s = np.uint8(np.asarray(source_rgbd_image.color) * 255.0)
-    color_cv_t = np.uint8(np.asarray(target_rgbd_image.color) * 255.0)
+    color_cv = np.uint8(np.asarray(rgbd_image.color) * 255.0)
 
     orb = cv2.ORB_create(scaleFactor=1.2,
                          nlevels=8,
@@ -37,31 +41,63 @@ def pose_estimation(source_rgbd_image, target_rgbd_image,
                          scoreType=cv2.ORB_HARRIS_SCORE,
                          nfeatures=100,
                          patchSize=31)  # to save time
-    [kp_s, des_s] = orb.detectAndCompute(color_cv_s, None)
-    [kp_t, des_t] = orb.detectAndCompute(color_cv_t, None)
-    if len(kp_s) == 0 or len(kp_t) == 0:
+    [kp, des] = orb.detectAndCompute(color_cv, None)
+    if des is None:
+        des = np.zeros((0, 32), dtype=np.uint8)
+    keypoints = np.array([k.pt for k in kp], dtype=np.float32).reshape(-1, 2)
+
+    focal_input, pp_x, pp_y = get_focal_and_principal_point(
+        pinhole_camera_intrinsic)
+    points_xyz = get_xyz_from_pts_array(keypoints.astype(np.float64),
+                                        np.asarray(rgbd_image.depth), pp_x,
+                                        pp_y, focal_input)
+    return FrameFeatures(keypoints, des, points_xyz)
+
+
+def get_focal_and_principal_point(pinhole_camera_intrinsic):
+    focal_input = (pinhole_camera_intrinsic.intrinsic_matrix[0, 0] +
+                   pinhole_camera_intrinsic.intrinsic_matrix[1, 1]) / 2.0
+    pp_x = pinhole_camera_intrinsic.intrinsic_matrix[0, 2]
+    pp_y = pinhole_camera_intrinsic.intrinsic_matrix[1, 2]
+    return focal_input, pp_x, pp_y
+
+
+def pose_estimation(source_rgbd_image,
+                    target_rgbd_image,
+                    pinhole_camera_intrinsic,
+                    debug_draw_correspondences,
+                    source_features=None,
+                    target_features=None):
+    success = False
+    trans = np.identity(4)
+
+    # features precomputed by a FeatureStore skip the ORB extraction
+    if source_features is None:
+        source_features = compute_frame_features(source_rgbd_image,
+                                                 pinhole_camera_intrinsic)
+    if target_features is None:
+        target_features = compute_frame_features(target_rgbd_image,
+                                                 pinhole_camera_intrinsic)
+    des_s = source_features.descriptors
+    des_t = target_features.descriptors
+    if des_s.shape[0] == 0 or des_t.shape[0] == 0:
         return success, trans
 
     bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
     matches = bf.match(des_s, des_t)
 
-    pts_s = []
-    pts_t = []
-    for match in matches:
-        pts_t.append(kp_t[match.trainIdx].pt)
-        pts_s.append(kp_s[match.queryIdx].pt)
-    pts_s = np.asarray(pts_s)
-    pts_t = np.asarray(pts_t)
+    idx_s = np.array([match.queryIdx for match in matches], dtype=np.int64)
+    idx_t = np.array([match.trainIdx for match in matches], dtype=np.int64)
+    pts_s = source_features.keypoints[idx_s].astype(np.float64)
+    pts_t = target_features.keypoints[idx_t].astype(np.float64)
     # inlier points after initial BF matching
     if debug_draw_correspondences:
         draw_correspondences(np.asarray(source_rgbd_image.color),
                              np.asarray(target_rgbd_image.color), pts_s, pts_t,
                              np.ones(pts_s.shape[0]), "Initial BF matching")
 
-    focal_input = (pinhole_camera_intrinsic.intrinsic_matrix[0, 0] +
-                   pinhole_camera_intrinsic.intrinsic_matrix[1, 1]) / 2.0
-    pp_x = pinhole_camera_intrinsic.intrinsic_matrix[0, 2]
-    pp_y = pinhole_camera_intrinsic.intrinsic_matrix[1, 2]
+    focal_input, pp_x, pp_y = get_focal_and_principal_point(
+        pinhole_camera_intrinsic)
 
     # Essential matrix is made for masking inliers
     pts_s_int = np.int32(pts_s + 0.5)
@@ -83,39 +119,26 @@ def pose_estimation(source_rgbd_image, target_rgbd_image,
                              mask, "5-pt RANSAC")
 
     # make 3D correspondences
-    depth_s = np.asarray(source_rgbd_image.depth)
-    depth_t = np.asarray(target_rgbd_image.depth)
-    pts_xyz_s = np.zeros([3, pts_s.shape[0]])
-    pts_xyz_t = np.zeros([3, pts_s.shape[0]])
-    cnt = 0
-    for i in range(pts_s.shape[0]):
-        if mask[i]:
-            xyz_s = get_xyz_from_pts(pts_s[i, :], depth_s, pp_x, pp_y,
-                                     focal_input)
-            pts_xyz_s[:, cnt] = xyz_s
-            xyz_t = get_xyz_from_pts(pts_t[i, :], depth_t, pp_x, pp_y,
-                                     focal_input)
-            pts_xyz_t[:, cnt] = xyz_t
-            cnt = cnt + 1
-    pts_xyz_s = pts_xyz_s[:, :cnt]
-    pts_xyz_t = pts_xyz_t[:, :cnt]
+    inlier = mask.ravel() != 0
+    pts_xyz_s = source_features.points_xyz[:, idx_s[inlier]]
+    pts_xyz_t = target_features.points_xyz[:, idx_t[inlier]]
 
     success, trans, inlier_id_vec = estimate_3D_transform_RANSAC(
         pts_xyz_s, pts_xyz_t)
 
     if debug_draw_correspondences:
-        pts_s_new = np.zeros(shape=(len(inlier_id_vec), 2))
-        pts_t_new = np.zeros(shape=(len(inlier_id_vec), 2))
+        inlier_id_vec = np.asarray(inlier_id_vec, dtype=np.int64)
+        u_s, v_s = get_uv_from_xyz(pts_xyz_s[0, inlier_id_vec],
+                                   pts_xyz_s[1, inlier_id_vec],
+                                   pts_xyz_s[2, inlier_id_vec], pp_x, pp_y,
+                                   focal_input)
+        u_t, v_t = get_uv_from_xyz(pts_xyz_t[0, inlier_id_vec],
+                                   pts_xyz_t[1, inlier_id_vec],
+                                   pts_xyz_t[2, inlier_id_vec], pp_x, pp_y,
+                                   focal_input)
+        pts_s_new = np.stack([u_s, v_s], axis=1)
+        pts_t_new = np.stack([u_t, v_t], axis=1)
         mask = np.ones(len(inlier_id_vec))
-        cnt = 0
-        for i in inlier_id_vec:
-            u_s, v_s = get_uv_from_xyz(pts_xyz_s[0, i], pts_xyz_s[1, i],
-                                       pts_xyz_s[2, i], pp_x, pp_y, focal_input)
-            u_t, v_t = get_uv_from_xyz(pts_xyz_t[0, i], pts_xyz_t[1, i],
-                                       pts_xyz_t[2, i], pp_x, pp_y, focal_input)
-            pts_s_new[cnt, :] = [u_s, v_s]
-            pts_t_new[cnt, :] = [u_t, v_t]
-            cnt = cnt + 1
         draw_correspondences(np.asarray(source_rgbd_image.color),
                              np.asarray(target_rgbd_image.color), pts_s_new,
                              pts_t_new, mask, "5-pt RANSAC + 3D Rigid RANSAC")
@@ -146,8 +169,12 @@ def draw_correspondences(img_s, img_t, pts_s, pts_t, mask, title):
     plt.close()
 
 
-def estimate_3D_transform_RANSAC(pts_xyz_s, pts_xyz_t):
-    max_iter = 1000
+def estimate_3D_transform_RANSAC(pts_xyz_s,
+                                 pts_xyz_t,
+                                 max_iter=1000,
+                                 confidence=0.999,
+                                 batch_size=100,
+                                 seed=0):
     max_distance = 0.05
     n_sample = 5
     n_points = pts_xyz_s.shape[1]
@@ -159,33 +186,47 @@ def estimate_3D_transform_RANSAC(pts_xyz_s, pts_xyz_t):
     if n_points < n_sample:
         return False, np.identity(4), []
 
-    for i in range(max_iter):
-
-        # sampling
-        rand_idx = np.random.randint(n_points, size=n_sample)
-        sample_xyz_s = pts_xyz_s[:, rand_idx]
-        sample_xyz_t = pts_xyz_t[:, rand_idx]
-        R_approx, t_approx = estimate_3D_transform(sample_xyz_s, sample_xyz_t)
+    rng = np.random.default_rng(seed)
+    n_required = max_iter
+    n_iter = 0
+    while n_iter < n_required:
+        # a batch of hypotheses is sampled, solved and scored at once
+        n_batch = min(batch_size, max_iter - n_iter)
+        rand_idx = rng.integers(n_points, size=(n_batch, n_sample))
+        sample_xyz_s = pts_xyz_s[:, rand_idx].transpose(1, 0, 2)
+        sample_xyz_t = pts_xyz_t[:, rand_idx].transpose(1, 0, 2)
+        R_approx, t_approx = estimate_3D_transform_batch(
+            sample_xyz_s, sample_xyz_t)
+        n_iter += n_batch
 
         # evaluation
-        diff_mat = pts_xyz_t - (np.matmul(R_approx, pts_xyz_s) +
-                                np.tile(t_approx, [1, n_points]))
-        diff = [np.linalg.norm(diff_mat[:, i]) for i in range(n_points)]
-        n_inlier = len([1 for diff_iter in diff if diff_iter < max_distance])
+        diff_mat = pts_xyz_t[np.newaxis] - (np.matmul(R_approx, pts_xyz_s) +
+                                            t_approx)
+        is_inlier = np.einsum('bij,bij->bj', diff_mat,
+                              diff_mat) < max_distance * max_distance
+        n_inlier = np.count_nonzero(is_inlier, axis=1)
 
         # note: diag(R_approx) > 0 prevents ankward transformation between
         # RGBD pair of relatively small amount of baseline.
-        if (n_inlier > max_inlier) and (np.linalg.det(R_approx) != 0.0) and \
-                (R_approx[0,0] > 0 and R_approx[1,1] > 0 and R_approx[2,2] > 0):
-            Transform_good[:3, :3] = R_approx
-            Transform_good[:3, 3] = t_approx.squeeze(1)
-            max_inlier = n_inlier
-            inlier_vec = [id_iter for diff_iter, id_iter \
-                    in zip(diff, range(n_points)) \
-                    if diff_iter < max_distance]
-            inlier_vec_good = inlier_vec
+        valid = (np.linalg.det(R_approx) != 0.0) & \
+                np.all(np.diagonal(R_approx, axis1=1, axis2=2) > 0, axis=1)
+        n_inlier = np.where(valid, n_inlier, -1)
+        best = np.argmax(n_inlier)
+        if n_inlier[best] > max_inlier:
+            Transform_good[:3, :3] = R_approx[best]
+            Transform_good[:3, 3] = t_approx[best].squeeze(1)
+            max_inlier = n_inlier[best]
+            inlier_vec_good = np.flatnonzero(is_inlier[best]).tolist()
             success = True
 
+            # adaptive stopping from the best inlier ratio so far
+            p_good = (max_inlier / n_points)**n_sample
+            if p_good >= 1.0:
+                break
+            n_required = min(
+                max_iter,
+                int(np.ceil(np.log(1.0 - confidence) / np.log(1.0 - p_good))))
+
     return success, Transform_good, inlier_vec_good
 
 
@@ -193,49 +234,62 @@ def estimate_3D_transform_RANSAC(pts_xyz_s, pts_xyz_t):
 # based on the description in the sec 3.1.2 in
 # http://graphics.stanford.edu/~smr/ICP/comparison/eggert_comparison_mva97.pdf
 def estimate_3D_transform(input_xyz_s, input_xyz_t):
+    R_approx, t_approx = estimate_3D_transform_batch(
+        input_xyz_s[np.newaxis], input_xyz_t[np.newaxis])
+    return R_approx[0], t_approx[0]
+
+
+def estimate_3D_transform_batch(xyz_s, xyz_t):
+    # xyz_s, xyz_t: (n_batch, 3, n_points), solved independently per batch
     # compute H
-    xyz_s = copy.copy(input_xyz_s)
-    xyz_t = copy.copy(input_xyz_t)
-    n_points = xyz_s.shape[1]
-    mean_s = np.mean(xyz_s, axis=1)
-    mean_t = np.mean(xyz_t, axis=1)
-    mean_s.shape = (3, 1)
-    mean_t.shape = (3, 1)
-    xyz_diff_s = xyz_s - np.tile(mean_s, [1, n_points])
-    xyz_diff_t = xyz_t - np.tile(mean_t, [1, n_points])
-    H = np.matmul(xyz_diff_s, xyz_diff_t.transpose())
+    mean_s = np.mean(xyz_s, axis=2, keepdims=True)
+    mean_t = np.mean(xyz_t, axis=2, keepdims=True)
+    xyz_diff_s = xyz_s - mean_s
+    xyz_diff_t = xyz_t - mean_t
+    H = np.matmul(xyz_diff_s, xyz_diff_t.transpose(0, 2, 1))
     # solve system
     U, s, V = np.linalg.svd(H)
-    R_approx = np.matmul(V.transpose(), U.transpose())
-    if np.linalg.det(R_approx) < 0.0:
-        det = np.linalg.det(np.matmul(U, V))
-        D = np.identity(3)
-        D[2, 2] = det
-        R_approx = np.matmul(U, np.matmul(D, V))
+    R_approx = np.matmul(V.transpose(0, 2, 1), U.transpose(0, 2, 1))
+    reflection = np.linalg.det(R_approx) < 0.0
+    if np.any(reflection):
+        U_r = U[reflection]
+        V_r = V[reflection]
+        D = np.tile(np.identity(3), (U_r.shape[0], 1, 1))
+        D[:, 2, 2] = np.linalg.det(np.matmul(U_r, V_r))
+        R_approx[reflection] = np.matmul(U_r, np.matmul(D, V_r))
     t_approx = mean_t - np.matmul(R_approx, mean_s)
     return R_approx, t_approx
 
 
 def get_xyz_from_pts(pts_row, depth, px, py, focal):
-    u = pts_row[0]
-    v = pts_row[1]
-    u0 = int(u)
-    v0 = int(v)
+    return get_xyz_from_pts_array(
+        np.asarray(pts_row, dtype=np.float64).reshape(1, 2), depth, px, py,
+        focal)[:, 0]
+
+
+def get_xyz_from_pts_array(pts, depth, px, py, focal):
+    # pts: (n, 2) pixel coordinates, returns (3, n) points; points without
+    # a full 2x2 depth neighbourhood inside the image are set to zero
+    u = pts[:, 0]
+    v = pts[:, 1]
+    u0 = u.astype(np.int64)
+    v0 = v.astype(np.int64)
     height = depth.shape[0]
     width = depth.shape[1]
+    valid = (u0 > 0) & (u0 < width - 1) & (v0 > 0) & (v0 < height - 1)
+    u0 = np.where(valid, u0, 0)
+    v0 = np.where(valid, v0, 0)
     # bilinear depth interpolation
-    if u0 > 0 and u0 < width - 1 and v0 > 0 and v0 < height - 1:
-        up = pts_row[0] - u0
-        vp = pts_row[1] - v0
-        d0 = depth[v0, u0]
-        d1 = depth[v0, u0 + 1]
-        d2 = depth[v0 + 1, u0]
-        d3 = depth[v0 + 1, u0 + 1]
-        d = (1 - vp) * (d1 * up + d0 * (1 - up)) + vp * (d3 * up + d2 *
-                                                         (1 - up))
-        return get_xyz_from_uv(u, v, d, px, py, focal)
-    else:
-        return [0, 0, 0]
+    up = u - u0
+    vp = v - v0
+    d0 = depth[v0, u0]
+    d1 = depth[v0, u0 + 1]
+    d2 = depth[v0 + 1, u0]
+    d3 = depth[v0 + 1, u0 + 1]
+    d = (1 - vp) * (d1 * up + d0 * (1 - up)) + vp * (d3 * up + d2 * (1 - up))
+    xyz = get_xyz_from_uv(u, v, d, px, py, focal)
+    xyz[:, ~valid] = 0
+    return xyz
 
 
 def get_xyz_from_uv(u, v, d, px, py, focal):
@@ -243,16 +297,18 @@ def get_xyz_from_uv(u, v, d, px, py, focal):
         x = (u - px) / focal * d
         y = (v - py) / focal * d
     else:
-        x = 0
-        y = 0
-    return np.array([x, y, d]).transpose()
+        x = np.zeros_like(d)
+        y = np.zeros_like(d)
+    return np.array([x, y, d], dtype=np.float64)
 
 
 def get_uv_from_xyz(x, y, z, px, py, focal):
-    if z != 0:
-        u = focal * x / z + px
-        v = focal * y / z + py
-    else:
-        u = 0
-        v = 0
+    # works element-wise on arrays, pixels of points with z == 0 are 0
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+    valid = z != 0
+    z_safe = np.where(valid, z, 1.0)
+    u = np.where(valid, focal * x / z_safe + px, 0.0)
+    v = np.where(valid, focal * y / z_safe + py, 0.0)
     return u, v
@@ -0,0 +1,264 @@
+import itertools
+
+import numpy as np
+import open3d as o3d
+import open3d.core as o3c
+
+from src.block_store import BlockStore, pack_block_keys, unpack_block_keys
+from src.ply_writer import StreamingPlyWriter
+from src.scene_partition import crop_mesh_indices
+
+# attributes of the blocks and their channels, stored interleaved per voxel
+_ATTRIBUTES = (("tsdf", 1), ("weight", 1), ("color", 3))
+_N_CHANNELS = 5
+
+# offsets of the 26 neighbours of a block
+_NEIGHBOURS = np.array(
+    [offset for offset in itertools.product((-1, 0, 1), repeat=3)
+     if offset != (0, 0, 0)],
+    dtype=np.int64)
+
+
+class OutOfCoreVolume:
+    """TSDF volume that keeps at most ``config["tsdf_memory_limit_mb"]`` of
+    voxel blocks in memory.
+
+    The resident blocks live in a CPU ``VoxelBlockGrid``. Before a frame is
+    integrated, the blocks of its frustum are paged in from a disk-backed
+    ``BlockStore`` (or allocated empty); when they do not fit, the blocks
+    that have been out of the camera frustum the longest are written to the
+    store and dropped from the grid. Meshes and point clouds are extracted
+    tile by tile and streamed to the output file, so peak memory is bounded
+    by the cap and not by the size of the scene.
+    """
+
+    def __init__(self, intrinsic, config, folder, trunc_voxel_multiplier=None):
+        self.config = config
+        self.device = o3c.Device("CPU:0")
+        self.intrinsic = o3c.Tensor(intrinsic.intrinsic_matrix, o3c.float64)
+        self.voxel_size = config["tsdf_cubic_size"] / 512.0
+        self.block_resolution = 16
+        self.block_size = self.voxel_size * self.block_resolution
+        if trunc_voxel_multiplier is None:
+            trunc_voxel_multiplier = config["sdf_trunc"] / self.voxel_size
+        self.trunc_voxel_multiplier = trunc_voxel_multiplier
+        block_values = self.block_resolution**3 * _N_CHANNELS
+        # a tile and its neighbours have to fit for extraction
+        self.capacity = max(
+            int(config["tsdf_memory_limit_mb"] * (1 << 20) /
+                (block_values * 4)), 64)
+        self.voxel_grid = o3d.t.geometry.VoxelBlockGrid(
+            attr_names=('tsdf', 'weight', 'color'),
+            attr_dtypes=(o3c.float32, o3c.float32, o3c.float32),
+            attr_channels=((1), (1), (3)),
+            voxel_size=self.voxel_size,
+            block_resolution=self.block_resolution,
+            block_count=self.capacity,
+            device=self.device)
+        self.store = BlockStore(folder, block_values)
+        # frame in which each resident block (packed key) was last in view
+        self.last_used = {}
+        self.n_frames = 0
+        self.n_evicted = 0
+        self.n_paged_in = 0
+
+    def _block_values(self, buf_indices):
+        return np.concatenate([
+            self.voxel_grid.attribute(name).numpy()[buf_indices].reshape(
+                buf_indices.shape[0], -1, channels)
+            for (name, channels) in _ATTRIBUTES
+        ],
+                              axis=2).reshape(buf_indices.shape[0], -1)
+
+    def _find(self, packed):
+        (buf_indices, _) = self.voxel_grid.hashmap().find(
+            o3c.Tensor(unpack_block_keys(packed).astype(np.int32)))
+        return buf_indices.numpy().astype(np.int64)
+
+    def _evict(self, packed, write_back=True):
+        if packed.shape[0] == 0:
+            return
+        if write_back:
+            self.store.write(packed, self._block_values(self._find(packed)))
+            self.n_evicted += packed.shape[0]
+        self.voxel_grid.hashmap().erase(
+            o3c.Tensor(unpack_block_keys(packed).astype(np.int32)))
+        for key in packed.tolist():
+            del self.last_used[key]
+
+    def _page_in(self, packed):
+        # activated blocks reuse the buffers of erased ones, so blocks that
+        # are not in the store are cleared
+        if packed.shape[0] == 0:
+            return
+        (buf_indices, _) = self.voxel_grid.hashmap().activate(
+            o3c.Tensor(unpack_block_keys(packed).astype(np.int32)))
+        buf_indices = buf_indices.numpy().astype(np.int64)
+        values = np.zeros((packed.shape[0], self.store.block_values),
+                          dtype=np.float32)
+        stored = self.store.contains(packed)
+        if np.any(stored):
+            values[stored] = self.store.read(packed[stored])
+            self.n_paged_in += int(np.count_nonzero(stored))
+        values = values.reshape(packed.shape[0], -1, _N_CHANNELS)
+        channel = 0
+        for (name, channels) in _ATTRIBUTES:
+            attribute = self.voxel_grid.attribute(name).numpy()
+            attribute[buf_indices] = values[:, :, channel:channel +
+                                            channels].reshape(
+                                                (-1,) + attribute.shape[1:])
+            channel += channels
+        self.last_used.update(zip(packed.tolist(),
+                                  itertools.repeat(self.n_frames)))
+
+    def _require(self, packed):
+        # makes the blocks resident, evicting the least recently used others
+        resident = np.fromiter(self.last_used.keys(), np.int64,
+                               len(self.last_used))
+        missing = packed[~np.isin(packed, resident)]
+        n_over = len(self.last_used) + missing.shape[0] - self.capacity
+        if n_over > 0:
+            candidates = resident[~np.isin(resident, packed)]
+            if n_over > candidates.shape[0]:
+                # a single frustum needs more blocks than the cap allows
+                self.capacity = len(self.last_used) + missing.shape[0]
+                self.voxel_grid.hashmap().reserve(self.capacity)
+                print("integrate :: frustum needs %d blocks, raising the "
+                      "block capacity." % packed.shape[0])
+                n_over = 0
+            if n_over > 0:
+                last_used = np.array(
+                    [self.last_used[key] for key in candidates.tolist()])
+                oldest = np.argpartition(last_used, n_over - 1)[:n_over]
+                self._evict(candidates[oldest])
+        self._page_in(missing)
+        self.last_used.update(zip(packed.tolist(),
+                                  itertools.repeat(self.n_frames)))
+
+    def integrate_images(self, depth, color, extrinsic):
+        depth_scale = float(self.config["depth_scale"])
+        depth_max = float(self.config["depth_max"])
+        frustum_block_coords = self.voxel_grid.compute_unique_block_coordinates(
+            depth, self.intrinsic, extrinsic, depth_scale, depth_max,
+            self.trunc_voxel_multiplier)
+        self._require(pack_block_keys(frustum_block_coords.numpy()))
+        self.voxel_grid.integrate(frustum_block_coords, depth, color,
+                                  self.intrinsic, self.intrinsic, extrinsic,
+                                  depth_scale, depth_max,
+                                  self.trunc_voxel_multiplier)
+        self.n_frames += 1
+
+    def integrate(self, frames, index, pose):
+        (color, depth) = frames.get_raw(index)
+        self.integrate_images(o3d.t.geometry.Image.from_legacy(depth),
+                              o3d.t.geometry.Image.from_legacy(color),
+                              o3c.Tensor(np.linalg.inv(pose), o3c.float64))
+
+    def _tiles(self, keys, tile_min, tile_blocks, stored):
+        # tiles of at most tile_blocks blocks per axis whose blocks and
+        # neighbours fit into the grid, split in octants where they do not
+        neighbours = np.unique(
+            pack_block_keys((unpack_block_keys(keys)[:, None, :] +
+                             _NEIGHBOURS).reshape(-1, 3)))
+        neighbours = neighbours[np.isin(neighbours, stored) &
+                                ~np.isin(neighbours, keys)]
+        if keys.shape[0] + neighbours.shape[0] <= self.capacity or \
+                tile_blocks == 1:
+            yield (tile_min, tile_min + tile_blocks,
+                   np.concatenate([keys, neighbours]))
+            return
+        half = tile_blocks // 2
+        octants = (unpack_block_keys(keys) - tile_min) // half
+        for octant in np.unique(octants, axis=0):
+            inside = np.all(octants == octant, axis=1)
+            yield from self._tiles(keys[inside], tile_min + octant * half,
+                                   half, stored)
+
+    def _extraction_tiles(self):
+        # writes every block to the store and yields (tile_min, tile_max)
+        # in meters after loading the blocks of the tile and its neighbours
+        self._evict(np.fromiter(self.last_used.keys(), np.int64,
+                                len(self.last_used)))
+        stored = np.sort(self.store.keys())
+        tile_blocks = self.config["tsdf_extraction_tile_blocks"]
+        tile_keys = unpack_block_keys(stored) // tile_blocks
+        (tiles, inverse) = np.unique(pack_block_keys(tile_keys),
+                                     return_inverse=True)
+        for (i, tile) in enumerate(unpack_block_keys(tiles)):
+            for (block_min, block_max,
+                 keys) in self._tiles(stored[inverse.reshape(-1) == i],
+                                      tile * tile_blocks, tile_blocks,
+                                      stored):
+                # the blocks loaded for the previous tile are still in the
+                # store
+                self._evict(np.fromiter(self.last_used.keys(), np.int64,
+                                        len(self.last_used)),
+                            write_back=False)
+                self._page_in(keys)
+                yield (block_min * self.block_size,
+                       block_max * self.block_size)
+        self._evict(np.fromiter(self.last_used.keys(), np.int64,
+                                len(self.last_used)),
+                    write_back=False)
+
+    def write_triangle_mesh(self, filename):
+        # vertices on tile seams are produced identically by both tiles; the
+        # ones within a voxel of a tile face are remembered by position, so
+        # the next tile reuses them and the mesh is welded as a whole
+        seam = {}
+        with StreamingPlyWriter(filename) as writer:
+            for (tile_min, tile_max) in self._extraction_tiles():
+                mesh = self.voxel_grid.extract_triangle_mesh().to_legacy()
+                # the neighbour blocks are loaded, so every vertex of the
+                # tile gets the normal of all of its triangles
+                mesh.compute_vertex_normals()
+                (used, triangles) = crop_mesh_indices(mesh, tile_min,
+                                                      tile_max)
+                if triangles.shape[0] == 0:
+                    continue
+                vertices = np.asarray(mesh.vertices)[used]
+                near = np.flatnonzero(
+                    np.any((np.abs(vertices - tile_min) <= self.voxel_size) |
+                           (np.abs(vertices - tile_max) <= self.voxel_size),
+                           axis=1))
+                keys = [vertices[i].tobytes() for i in near.tolist()]
+                indices = np.full(used.shape[0], -1, dtype=np.int64)
+                indices[near] = [seam.get(key, -1) for key in keys]
+                new = indices < 0
+                indices[new] = writer.n_vertices + np.arange(
+                    np.count_nonzero(new))
+                seam.update(zip(keys, indices[near].tolist()))
+                writer.write(vertices[new],
+                             np.asarray(mesh.vertex_colors)[used][new],
+                             np.asarray(mesh.vertex_normals)[used][new],
+                             indices[triangles] - writer.n_vertices)
+        print("integrate :: %d triangles written tile by tile." %
+              writer.n_faces)
+
+    def write_point_cloud(self, filename):
+        with StreamingPlyWriter(filename, with_faces=False) as writer:
+            for (tile_min, tile_max) in self._extraction_tiles():
+                pcd = self.voxel_grid.extract_point_cloud()
+                points = pcd.point.positions.numpy().astype(np.float64)
+                inside = np.all((points >= tile_min) & (points < tile_max),
+                                axis=1)
+                normals = pcd.point.normals.numpy()[inside]
+                colors = pcd.point.colors.numpy()[inside]
+                writer.write(points[inside], colors, normals)
+        print("integrate :: %d points written tile by tile." %
+              writer.n_vertices)
+
+    def close(self):
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def summary(self):
+        return ("%d blocks in memory at most, %d evicted, %d paged in, "
+                "%.1f MB spilled to disk" %
+                (self.capacity, self.n_evicted, self.n_paged_in,
+                 self.store.bytes_written / float(1 << 20)))
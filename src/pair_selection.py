@@ -0,0 +1,85 @@
+import numpy as np
+
+
+def fragment_poses_from_odometry(store, n_fragments):
+    # fragment t starts where fragment t-1 ends, so chaining the last frame
+    # pose of every fragment gives a drifting but cheap estimate of where
+    # each fragment lies in the frame of fragment 0
+    poses = [np.identity(4)]
+    for fragment_id in range(n_fragments - 1):
+        poses.append(np.dot(poses[-1], store.fragment(fragment_id).poses[-1]))
+    return poses
+
+
+def transform_points(points, pose):
+    return points @ pose[:3, :3].T + pose[:3, 3]
+
+
+def voxel_keys(points, cell_size):
+    return set(map(tuple, np.floor(points / cell_size).astype(np.int64)))
+
+
+def bounding_boxes_overlap(min_s, max_s, min_t, max_t, margin):
+    return np.all(min_s - margin <= max_t) and np.all(min_t - margin <= max_s)
+
+
+def global_descriptor(fpfh):
+    # mean FPFH histogram of the fragment, normalized for cosine similarity
+    descriptor = np.asarray(fpfh.data).mean(axis=1)
+    return descriptor / max(np.linalg.norm(descriptor), 1e-12)
+
+
+def select_fragment_pairs(points, fpfhs, poses, config):
+    """Fragment pairs worth a global registration attempt.
+
+    Odometry pairs (t == s + 1) are always kept. Other pairs are kept when
+    their voxels overlap by at least pair_selection_min_overlap under the
+    chained odometry poses, or when t is among the
+    pair_selection_descriptor_top_k fragments most similar to s by mean FPFH
+    (this survives odometry drift). At most pair_selection_max_per_fragment
+    loop closure pairs are kept per fragment, best scored first.
+    """
+    n_files = len(points)
+    cell_size = config["pair_selection_cell_size"]
+    world_points = [
+        transform_points(points[i], poses[i]) for i in range(n_files)
+    ]
+    bounds = [(p.min(axis=0), p.max(axis=0)) if p.shape[0] > 0 else
+              (np.full(3, np.inf), np.full(3, -np.inf)) for p in world_points]
+    keys = [voxel_keys(p, cell_size) for p in world_points]
+    descriptors = np.array([global_descriptor(fpfh) for fpfh in fpfhs])
+    similarity = descriptors @ descriptors.T
+
+    overlap = np.zeros((n_files, n_files))
+    for s in range(n_files):
+        for t in range(s + 2, n_files):
+            if not bounding_boxes_overlap(bounds[s][0], bounds[s][1],
+                                          bounds[t][0], bounds[t][1],
+                                          cell_size):
+                continue
+            n_min = min(len(keys[s]), len(keys[t]))
+            if n_min > 0:
+                overlap[s, t] = overlap[t, s] = \
+                        len(keys[s] & keys[t]) / n_min
+
+    candidates = set()
+    for s in range(n_files):
+        for t in range(s + 2, n_files):
+            if overlap[s, t] >= config["pair_selection_min_overlap"]:
+                candidates.add((s, t))
+        ranked = [
+            t for t in np.argsort(-similarity[s]) if abs(int(t) - s) > 1
+        ]
+        for t in ranked[:config["pair_selection_descriptor_top_k"]]:
+            candidates.add((min(s, int(t)), max(s, int(t))))
+
+    n_selected = np.zeros(n_files, dtype=int)
+    pairs = [(s, s + 1) for s in range(n_files - 1)]
+    for (s, t) in sorted(candidates,
+                         key=lambda p: -(overlap[p] + similarity[p])):
+        if n_selected[s] < config["pair_selection_max_per_fragment"] and \
+                n_selected[t] < config["pair_selection_max_per_fragment"]:
+            pairs.append((s, t))
+            n_selected[s] += 1
+            n_selected[t] += 1
+    return sorted(pairs)
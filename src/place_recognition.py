@@ -0,0 +1,74 @@
+import numpy as np
+
+
+def train_vocabulary(descriptors, n_words, n_iter=10, seed=0):
+    # k-means over the unpacked descriptor bits, where squared euclidean
+    # distance equals the hamming distance of the binary descriptors
+    bits = np.unpackbits(descriptors, axis=1).astype(np.float32)
+    n_words = min(n_words, bits.shape[0])
+    rng = np.random.default_rng(seed)
+    words = bits[rng.choice(bits.shape[0], n_words, replace=False)]
+    for i in range(n_iter):
+        labels = assign_words(bits, words)
+        for k in range(n_words):
+            members = bits[labels == k]
+            if members.shape[0] > 0:
+                words[k] = members.mean(axis=0)
+    return words
+
+
+def assign_words(bits, words):
+    distance = (bits * bits).sum(axis=1)[:, None] - 2.0 * bits @ words.T + \
+            (words * words).sum(axis=1)[None, :]
+    return np.argmin(distance, axis=1)
+
+
+class KeyframeIndex:
+    """Bag-of-visual-words index over the keyframes of one fragment.
+
+    The vocabulary is trained on the ORB descriptors of the fragment itself
+    and frames are compared by cosine similarity of their tf-idf weighted
+    word histograms.
+    """
+
+    def __init__(self, keyframe_ids, descriptors, n_words=64, seed=0):
+        self.keyframe_ids = list(keyframe_ids)
+        n_keyframes = len(self.keyframe_ids)
+        self.vectors = np.zeros((n_keyframes, 0))
+        non_empty = [des for des in descriptors if des.shape[0] > 0]
+        if len(non_empty) == 0:
+            return
+
+        words = train_vocabulary(np.concatenate(non_empty), n_words, seed=seed)
+        histograms = np.zeros((n_keyframes, words.shape[0]))
+        for i, des in enumerate(descriptors):
+            if des.shape[0] > 0:
+                labels = assign_words(
+                    np.unpackbits(des, axis=1).astype(np.float32), words)
+                histograms[i] = np.bincount(labels, minlength=words.shape[0])
+
+        n_containing = np.count_nonzero(histograms, axis=0)
+        idf = np.log(n_keyframes / np.maximum(n_containing, 1))
+        tf = histograms / np.maximum(histograms.sum(axis=1, keepdims=True), 1)
+        vectors = tf * idf
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors = vectors / np.maximum(norms, 1e-12)
+
+    def similarity(self):
+        return self.vectors @ self.vectors.T
+
+    def candidate_pairs(self, top_k, min_similarity):
+        n_keyframes = len(self.keyframe_ids)
+        pairs = set()
+        if self.vectors.shape[1] == 0:
+            return pairs
+        similarity = self.similarity()
+        np.fill_diagonal(similarity, -np.inf)
+        for i in range(n_keyframes):
+            for j in np.argsort(-similarity[i])[:top_k]:
+                if similarity[i, j] < min_similarity:
+                    break
+                s = self.keyframe_ids[min(i, j)]
+                t = self.keyframe_ids[max(i, j)]
+                pairs.add((s, t))
+        return pairs
@@ -0,0 +1,74 @@
+import os
+import shutil
+
+import numpy as np
+
+
+class StreamingPlyWriter:
+    """Binary PLY file written in chunks of vertices and triangles.
+
+    The element counts go into the header but are only known at the end,
+    so vertices and faces are spooled to files next to ``filename`` and
+    copied behind the header on ``close``. Triangles index the vertices of
+    their own ``write`` call; negative indices count back into the vertices
+    written by earlier calls.
+    """
+
+    def __init__(self, filename, with_normals=True, with_faces=True):
+        self.filename = filename
+        self.with_normals = with_normals
+        self.with_faces = with_faces
+        fields = [("x", "<f8"), ("y", "<f8"), ("z", "<f8")]
+        if with_normals:
+            fields += [("nx", "<f8"), ("ny", "<f8"), ("nz", "<f8")]
+        fields += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+        self.vertex_dtype = np.dtype(fields)
+        self.face_dtype = np.dtype([("n", "u1"), ("v", "<i4", (3,))])
+        self.n_vertices = 0
+        self.n_faces = 0
+        self._vertex_file = open(filename + ".vertices", "wb")
+        self._face_file = open(filename + ".faces", "wb")
+
+    def write(self, vertices, colors, normals=None, triangles=None):
+        chunk = np.zeros(vertices.shape[0], dtype=self.vertex_dtype)
+        for (i, axis) in enumerate("xyz"):
+            chunk[axis] = vertices[:, i]
+            if self.with_normals:
+                chunk["n" + axis] = normals[:, i]
+        for (i, channel) in enumerate(("red", "green", "blue")):
+            chunk[channel] = np.clip(np.round(colors[:, i] * 255), 0, 255)
+        self._vertex_file.write(chunk.tobytes())
+        if self.with_faces and triangles is not None:
+            faces = np.zeros(triangles.shape[0], dtype=self.face_dtype)
+            faces["n"] = 3
+            faces["v"] = triangles + self.n_vertices
+            self._face_file.write(faces.tobytes())
+            self.n_faces += triangles.shape[0]
+        self.n_vertices += vertices.shape[0]
+
+    def close(self):
+        self._vertex_file.close()
+        self._face_file.close()
+        header = ["ply", "format binary_little_endian 1.0",
+                  "element vertex %d" % self.n_vertices]
+        header += ["property double %s" % name for name in "xyz"]
+        if self.with_normals:
+            header += ["property double n%s" % name for name in "xyz"]
+        header += ["property uchar red", "property uchar green",
+                   "property uchar blue"]
+        if self.with_faces:
+            header += ["element face %d" % self.n_faces,
+                       "property list uchar int vertex_indices"]
+        header.append("end_header")
+        with open(self.filename, "wb") as ply_file:
+            ply_file.write(("\n".join(header) + "\n").encode("ascii"))
+            for part in (self._vertex_file.name, self._face_file.name):
+                with open(part, "rb") as part_file:
+                    shutil.copyfileobj(part_file, ply_file)
+                os.remove(part)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,120 @@
+import os
+import threading
+
+import numpy as np
+import open3d as o3d
+
+from src.open3d_example import join, write_poses_to_log
+from src.worker_pool import process_state
+
+
+class PoseStore:
+    """Camera poses with the fragment and the frame they belong to.
+
+    One float64 row per pose: fragment index, absolute frame index and the
+    16 values of the 4x4 pose in row-major order. Saved as ``.npy`` and
+    loaded memory mapped, so reading a store does not parse anything.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @classmethod
+    def from_poses(cls, fragments, frames, poses):
+        rows = np.empty((len(poses), 18))
+        rows[:, 0] = fragments
+        rows[:, 1] = frames
+        rows[:, 2:] = np.asarray(poses, dtype=np.float64).reshape(-1, 16)
+        return cls(rows)
+
+    @classmethod
+    def load(cls, filename):
+        return cls(np.load(filename, mmap_mode="r"))
+
+    def __len__(self):
+        return self.rows.shape[0]
+
+    @property
+    def fragments(self):
+        return self.rows[:, 0].astype(np.int64)
+
+    @property
+    def frames(self):
+        return self.rows[:, 1].astype(np.int64)
+
+    @property
+    def poses(self):
+        return self.rows[:, 2:].reshape(-1, 4, 4)
+
+    def fragment(self, fragment_id):
+        return PoseStore(self.rows[self.fragments == fragment_id])
+
+    def compose(self, fragment_poses):
+        # poses in the scene frame, given the pose of every fragment
+        fragment_poses = np.asarray(fragment_poses, dtype=np.float64)
+        return PoseStore.from_poses(
+            self.fragments, self.frames,
+            np.matmul(fragment_poses[self.fragments], self.poses))
+
+    def save(self, filename):
+        # written next to the target and renamed, so a reader never maps a
+        # partial file
+        temp_name = "%s.%d.%d.tmp.npy" % (filename, os.getpid(),
+                                          threading.get_ident())
+        np.save(temp_name, np.ascontiguousarray(self.rows))
+        os.replace(temp_name, filename)
+
+    def export_log(self, filename):
+        write_poses_to_log(filename, self.poses)
+
+
+def posegraph_poses(pose_graph):
+    return np.array([node.pose for node in pose_graph.nodes]).reshape(-1, 4, 4)
+
+
+def fragment_posegraph_names(path_dataset, config):
+    names = []
+    while True:
+        name = join(path_dataset,
+                    config["template_fragment_posegraph_optimized"] % len(names))
+        if not os.path.exists(name):
+            return names
+        names.append(name)
+
+
+def build_fragment_pose_store(path_dataset, config):
+    # the optimized poses of every fragment, relative to its first frame
+    stores = []
+    for (fragment_id, posegraph_name) in enumerate(
+            fragment_posegraph_names(path_dataset, config)):
+        poses = posegraph_poses(o3d.io.read_pose_graph(posegraph_name))
+        frames = fragment_id * config["n_frames_per_fragment"] + np.arange(
+            poses.shape[0])
+        stores.append(PoseStore.from_poses(fragment_id, frames, poses))
+    store = PoseStore(np.concatenate([s.rows for s in stores]) if stores else
+                      np.zeros((0, 18)))
+    store.save(join(path_dataset, config["template_fragment_pose_store"]))
+    return store
+
+
+def fragment_pose_store(path_dataset, config):
+    """Frame poses of all fragments, loaded once per process.
+
+    Reads the store written by make_fragments; it is rebuilt from the
+    fragment pose graphs when it is missing or older than one of them.
+    """
+    filename = join(path_dataset, config["template_fragment_pose_store"])
+    if not os.path.exists(filename) or any(
+            os.stat(name).st_mtime_ns > os.stat(filename).st_mtime_ns
+            for name in fragment_posegraph_names(path_dataset, config)):
+        build_fragment_pose_store(path_dataset, config)
+    stat = os.stat(filename)
+    return process_state(
+        ("pose_store", os.path.abspath(filename), stat.st_mtime_ns),
+        lambda: PoseStore.load(filename))
+
+
+def write_scene_trajectory(path_dataset, store, config):
+    # the binary trajectory, and the .log for tools that read it
+    store.save(join(path_dataset, config["template_global_traj_store"]))
+    store.export_log(join(path_dataset, config["template_global_traj"]))
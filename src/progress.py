@@ -0,0 +1,96 @@
+import time
+
+
+class ReconstructionCancelled(Exception):
+    pass
+
+
+class ProgressReporter:
+    """Structured progress events of a reconstruction run.
+
+    Events are dicts passed to ``publish``, e.g. ``Queue.put`` of the
+    process that displays them. A ``"progress"`` event holds the stage, its
+    index among ``n_stages``, the units done of ``total`` (fragments, pairs,
+    frames, ...), the seconds elapsed in the run and in the stage, the
+    estimated seconds left in the stage and the estimated fraction of the
+    whole run. Updates within a stage are published at most every
+    ``interval`` seconds. When ``cancel_event`` is set, the next update
+    raises ``ReconstructionCancelled``.
+    """
+
+    def __init__(self, publish, cancel_event=None, interval=0.2):
+        self.publish = publish
+        self.cancel_event = cancel_event
+        self.interval = interval
+        self.start_time = time.time()
+        self.stage = None
+        self.stage_index = 0
+        self.n_stages = 1
+        self.stage_start_time = self.start_time
+        self._last_publish_time = 0.0
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise ReconstructionCancelled(self.stage)
+
+    def start_stage(self, stage, stage_index, n_stages):
+        self.check_cancelled()
+        self.stage = stage
+        self.stage_index = stage_index
+        self.n_stages = n_stages
+        self.stage_start_time = time.time()
+        self._last_publish_time = 0.0
+        self.update(0, 0, "")
+
+    def update(self, done, total, unit):
+        self.check_cancelled()
+        now = time.time()
+        if 0 < done < total and now - self._last_publish_time < self.interval:
+            return
+        self._last_publish_time = now
+        stage_elapsed = now - self.stage_start_time
+        fraction = float(done) / total if total > 0 else 0.0
+        eta = stage_elapsed / done * (total - done) if done > 0 else None
+        self.publish({
+            "type": "progress",
+            "stage": self.stage,
+            "stage_index": self.stage_index,
+            "n_stages": self.n_stages,
+            "done": done,
+            "total": total,
+            "unit": unit,
+            "elapsed": now - self.start_time,
+            "stage_elapsed": stage_elapsed,
+            "eta": eta,
+            "fraction": (self.stage_index + fraction) / self.n_stages
+        })
+
+    def finish(self, event_type, message=""):
+        # "done", "cancelled" or "error"
+        self.publish({
+            "type": event_type,
+            "stage": self.stage,
+            "elapsed": time.time() - self.start_time,
+            "message": message
+        })
+
+
+# reporter of this process, None when the stages run without a listener
+_reporter = None
+
+
+def set_progress_reporter(reporter):
+    global _reporter
+    _reporter = reporter
+
+
+def start_stage(stage, stage_index, n_stages):
+    if _reporter is not None:
+        _reporter.start_stage(stage, stage_index, n_stages)
+
+
+def report_progress(done, total, unit):
+    # called by the stages as units of work complete; also where a
+    # cancelled run stops
+    if _reporter is not None:
+        _reporter.update(done, total, unit)
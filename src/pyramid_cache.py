@@ -0,0 +1,91 @@
+import os
+import threading
+from collections import OrderedDict
+
+import open3d as o3d
+
+
+def fragment_key(ply_file_name):
+    # identifies the content of a fragment without reading it
+    stat = os.stat(ply_file_name)
+    return (os.path.abspath(ply_file_name), stat.st_size, stat.st_mtime_ns)
+
+
+class PyramidCache:
+    """Downsampled levels of fragment point clouds, built once per process.
+
+    A level is the fragment voxel-downsampled to one ICP scale, with normals
+    estimated when the ICP method needs them. Levels are built lazily on
+    first use and the least recently used ones are dropped once more than
+    ``max_entries`` are held. ``pcd`` may also be a function returning the
+    full resolution cloud, so that it is only loaded on a miss.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._levels = OrderedDict()
+        # workers of the thread backend share the cache
+        self._lock = threading.Lock()
+
+    def get(self, key, pcd, voxel_size, with_normals):
+        level_key = (key, voxel_size, with_normals)
+        with self._lock:
+            pcd_down = self._levels.get(level_key)
+            if pcd_down is not None:
+                self._levels.move_to_end(level_key)
+                self.hits += 1
+                return pcd_down
+            self.misses += 1
+        if callable(pcd):
+            pcd = pcd()
+        pcd_down = downsample_point_cloud(pcd, voxel_size, with_normals)
+        if self.max_entries > 0:
+            with self._lock:
+                self._levels[level_key] = pcd_down
+                while len(self._levels) > self.max_entries:
+                    self._levels.popitem(last=False)
+        return pcd_down
+
+    def summary(self):
+        return "pyramid cache %d hits, %d misses" % (self.hits, self.misses)
+
+
+def downsample_point_cloud(pcd, voxel_size, with_normals):
+    pcd_down = pcd.voxel_down_sample(voxel_size)
+    if with_normals:
+        pcd_down.estimate_normals(
+            o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2.0,
+                                                 max_nn=30))
+    return pcd_down
+
+
+_pyramid_cache = None
+
+
+_pyramid_cache_lock = threading.Lock()
+
+
+def get_pyramid_cache(config):
+    # one cache per process, so pool workers keep their levels across tasks
+    global _pyramid_cache
+    with _pyramid_cache_lock:
+        if _pyramid_cache is None or \
+                _pyramid_cache.max_entries != config["pyramid_cache_size"]:
+            _pyramid_cache = PyramidCache(config["pyramid_cache_size"])
+        return _pyramid_cache
+
+
+def pyramid_cache_counts(config):
+    # hits and misses of the cache of this process, run in every pool worker
+    cache = get_pyramid_cache(config)
+    return (os.getpid(), cache.hits, cache.misses)
+
+
+def pool_pyramid_cache_summary(counts):
+    # threads of the thread backend share one cache, counted once
+    per_process = {pid: (hits, misses) for (pid, hits, misses) in counts}
+    return "pyramid cache %d hits, %d misses in %d worker processes" % (
+        sum(hits for (hits, _) in per_process.values()),
+        sum(misses for (_, misses) in per_process.values()), len(per_process))
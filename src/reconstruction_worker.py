@@ -0,0 +1,99 @@
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import traceback
+
+from src.progress import ProgressReporter, ReconstructionCancelled, set_progress_reporter
+
+# events after which the worker process has nothing more to report
+FINAL_EVENTS = ("done", "cancelled", "error")
+
+# priority class of SetPriorityClass, between idle and normal
+BELOW_NORMAL_PRIORITY_CLASS = 0x4000
+
+
+def lower_process_priority():
+    # the pool started by the pipeline inherits the lower priority, so the
+    # process that started the reconstruction keeps its share of the cores
+    if hasattr(os, "nice"):
+        os.nice(5)
+    elif sys.platform == "win32":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetPriorityClass(kernel32.GetCurrentProcess(),
+                                  BELOW_NORMAL_PRIORITY_CLASS)
+
+
+def run_reconstruction(events, cancel_event):
+    # entry point of the worker process
+    lower_process_priority()
+    reporter = ProgressReporter(events.put, cancel_event)
+    set_progress_reporter(reporter)
+    try:
+        from src.run_system import get_pointcloud
+        get_pointcloud()
+        reporter.finish("done")
+    except ReconstructionCancelled:
+        reporter.finish("cancelled")
+    except Exception:
+        reporter.finish("error", traceback.format_exc())
+
+
+class ReconstructionWorker:
+    """The reconstruction pipeline of run_system, run in its own process.
+
+    Progress events (see ``ProgressReporter``) arrive on ``events``;
+    ``subscribe`` hands them to a callback from a background thread, ending
+    with one of ``FINAL_EVENTS``. ``cancel`` asks the pipeline to stop at
+    its next progress update, which also terminates its worker pool.
+    """
+
+    def __init__(self):
+        mp_context = multiprocessing.get_context("spawn")
+        self.events = mp_context.Queue()
+        self.cancel_event = mp_context.Event()
+        # not a daemon: the pipeline starts a pool of its own
+        self.process = mp_context.Process(target=run_reconstruction,
+                                          args=(self.events,
+                                                self.cancel_event))
+
+    def start(self):
+        self.process.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def subscribe(self, callback):
+
+        def listen():
+            while True:
+                try:
+                    event = self.events.get(timeout=1.0)
+                except queue.Empty:
+                    if self.process.is_alive():
+                        continue
+                    # the process died without reporting how it ended
+                    event = {
+                        "type": "error",
+                        "stage": None,
+                        "elapsed": None,
+                        "message": "exit code %s" % self.process.exitcode
+                    }
+                callback(event)
+                if event["type"] in FINAL_EVENTS:
+                    self.process.join()
+                    return
+
+        listener = threading.Thread(target=listen, daemon=True)
+        listener.start()
+        return listener
+
+    def terminate(self):
+        # last resort when the pipeline does not reach a progress update
+        self.process.terminate()
+        self.process.join()
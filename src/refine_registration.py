@@ -7,7 +7,6 @@
 
 # examples/python/reconstruction_system/refine_registration.py
 
-import multiprocessing
 import os
 import sys
 
@@ -17,10 +16,17 @@ import open3d as o3d
 #pyexample_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 #sys.path.append(pyexample_path)
 
-from src.open3d_example import join, get_file_list, write_poses_to_log, draw_registration_result_original_color
+from src.open3d_example import join, get_file_list, file_content_hash, draw_registration_result_original_color
 
 #sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from src.optimize_posegraph import optimize_posegraph_for_refined_scene
+from src.shared_point_clouds import SharedArrays, attach_point_cloud, point_cloud_to_arrays
+from src.manifest import Manifest, MANIFEST_CONFIG_KEYS
+from src.pose_store import fragment_pose_store, posegraph_poses, write_scene_trajectory
+from src.pyramid_cache import fragment_key, get_pyramid_cache, downsample_point_cloud, pool_pyramid_cache_summary, pyramid_cache_counts
+from src.worker_pool import stage_pool
+from src.progress import report_progress
+from src.task_scheduler import run_scheduled
 
 
 def update_posegraph_for_scene(s, t, transformation, information, odometry,
@@ -46,19 +52,32 @@ def update_posegraph_for_scene(s, t, transformation, information, odometry,
     return (odometry, pose_graph)
 
 
+def pyramid_level(pcd, key, voxel_size, config):
+    with_normals = config["icp_method"] != "point_to_point"
+    if key is None:
+        return downsample_point_cloud(pcd, voxel_size, with_normals)
+    return get_pyramid_cache(config).get(key, pcd, voxel_size, with_normals)
+
+
 def multiscale_icp(source,
                    target,
                    voxel_size,
                    max_iter,
                    config,
-                   init_transformation=np.identity(4)):
+                   init_transformation=np.identity(4),
+                   source_key=None,
+                   target_key=None):
+    # with source_key / target_key the downsampled levels come from the
+    # per-process pyramid cache
     current_transformation = init_transformation
     for i, scale in enumerate(range(len(max_iter))):  # multi-scale approach
         iter = max_iter[scale]
         distance_threshold = config["voxel_size"] * 1.4
         print("voxel_size {}".format(voxel_size[scale]))
-        source_down = source.voxel_down_sample(voxel_size[scale])
-        target_down = target.voxel_down_sample(voxel_size[scale])
+        source_down = pyramid_level(source, source_key, voxel_size[scale],
+                                    config)
+        target_down = pyramid_level(target, target_key, voxel_size[scale],
+                                    config)
         if config["icp_method"] == "point_to_point":
             result_icp = o3d.pipelines.registration.registration_icp(
                 source_down, target_down, distance_threshold,
@@ -68,14 +87,6 @@ def multiscale_icp(source,
                 o3d.pipelines.registration.ICPConvergenceCriteria(
                     max_iteration=iter))
         else:
-            source_down.estimate_normals(
-                o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size[scale] *
-                                                     2.0,
-                                                     max_nn=30))
-            target_down.estimate_normals(
-                o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size[scale] *
-                                                     2.0,
-                                                     max_nn=30))
             if config["icp_method"] == "point_to_plane":
                 result_icp = o3d.pipelines.registration.registration_icp(
                     source_down, target_down, distance_threshold,
@@ -118,31 +129,67 @@ def multiscale_icp(source,
     return (result_icp.transformation, information_matrix)
 
 
-def local_refinement(source, target, transformation_init, config):
+def local_refinement(source,
+                     target,
+                     transformation_init,
+                     config,
+                     source_key=None,
+                     target_key=None):
     voxel_size = config["voxel_size"]
     (transformation, information) = \
             multiscale_icp(
             source, target,
             [voxel_size, voxel_size/2.0, voxel_size/4.0], [50, 30, 14],
-            config, transformation_init)
+            config, transformation_init, source_key, target_key)
 
     return (transformation, information)
 
 
-def register_point_cloud_pair(ply_file_names, s, t, transformation_init,
-                              config):
-    print("reading %s ..." % ply_file_names[s])
-    source = o3d.io.read_point_cloud(ply_file_names[s])
-    print("reading %s ..." % ply_file_names[t])
-    target = o3d.io.read_point_cloud(ply_file_names[t])
+def register_point_cloud_pair(source,
+                              target,
+                              transformation_init,
+                              config,
+                              source_key=None,
+                              target_key=None):
     (transformation, information) = \
-            local_refinement(source, target, transformation_init, config)
+            local_refinement(source, target, transformation_init, config,
+                             source_key, target_key)
     #if config["debug_mode"]:
     #    print(transformation)
     #    print(information)
     return (transformation, information)
 
 
+def lazy_point_cloud(handle):
+    pcd = []
+
+    def load():
+        if len(pcd) == 0:
+            pcd.append(attach_point_cloud(handle))
+        return pcd[0]
+
+    return load
+
+
+def register_shared_point_cloud_pair(source_handle, target_handle,
+                                     transformation_init, config, source_key,
+                                     target_key):
+    # the fragments live in shared memory owned by the parent and are only
+    # attached when a pyramid level is missing from this worker's cache
+    (transformation, information) = register_point_cloud_pair(
+        lazy_point_cloud(source_handle), lazy_point_cloud(target_handle),
+        transformation_init, config, source_key, target_key)
+    return (transformation, information)
+
+
+def read_fragments(ply_file_names):
+    fragments = []
+    for ply_file_name in ply_file_names:
+        print("reading %s ..." % ply_file_name)
+        fragments.append(o3d.io.read_point_cloud(ply_file_name))
+    return fragments
+
+
 # other types instead of class?
 class matching_result:
 
@@ -154,7 +201,8 @@ class matching_result:
         self.infomation = np.identity(6)
 
 
-def make_posegraph_for_refined_scene(ply_file_names, config):
+def make_posegraph_for_refined_scene(ply_file_names, fragment_hashes, config,
+                                     pool=None):
     pose_graph = o3d.io.read_pose_graph(
         join(config["path_dataset"],
              config["template_global_posegraph_optimized"]))
@@ -167,26 +215,71 @@ def make_posegraph_for_refined_scene(ply_file_names, config):
         matching_results[s * n_files + t] = \
             matching_result(s, t, edge.transformation)
 
-    if config["python_multi_threading"] is True:
-        os.environ['OMP_NUM_THREADS'] = '1'
-        max_workers = max(
-            1, min(multiprocessing.cpu_count() - 1, len(pose_graph.edges)))
-        mp_context = multiprocessing.get_context('spawn')
-        with mp_context.Pool(processes=max_workers) as pool:
-            args = [(ply_file_names, v.s, v.t, v.transformation, config)
-                    for k, v in matching_results.items()]
-            results = pool.starmap(register_point_cloud_pair, args)
-
-        for i, r in enumerate(matching_results):
+    # edges whose fragments, initial transformation and parameters are
+    # unchanged take the recorded result
+    manifests = {
+        r: Manifest(config,
+                    "refine_registration/pair_%03d_%03d" % (v.s, v.t),
+                    MANIFEST_CONFIG_KEYS["refine_registration pair"],
+                    values=[
+                        fragment_hashes[v.s], fragment_hashes[v.t],
+                        np.asarray(v.transformation).tolist()
+                    ]) for r, v in matching_results.items()
+    }
+    cached = {r for r in matching_results if manifests[r].is_current()}
+    for r in cached:
+        (transformation, information) = manifests[r].result()
+        matching_results[r].transformation = np.array(transformation)
+        matching_results[r].information = np.array(information)
+    pending = {
+        r: v for r, v in matching_results.items() if r not in cached
+    }
+    print("refine registration :: %d of %d pairs up to date." %
+          (len(cached), len(matching_results)))
+
+    # every fragment is read once here instead of once per edge
+    fragments = read_fragments(ply_file_names) if pending else []
+    keys = [fragment_key(ply_file_name) for ply_file_name in ply_file_names]
+
+    if pool is not None:
+        with SharedArrays([point_cloud_to_arrays(pcd)
+                           for pcd in fragments]) as shared:
+            args = [(shared.handles[v.s], shared.handles[v.t],
+                     v.transformation, config, keys[v.s], keys[v.t])
+                    for k, v in pending.items()]
+            task_keys = [
+                "refine_registration %03d-%03d" % (v.s, v.t)
+                for k, v in pending.items()
+            ]
+            # multiscale ICP scales with the points of both fragments
+            costs = [
+                len(fragments[v.s].points) + len(fragments[v.t].points)
+                for k, v in pending.items()
+            ]
+            results = run_scheduled(pool, register_shared_point_cloud_pair,
+                                    args, task_keys, costs, config, "pairs")
+        print(pool_pyramid_cache_summary(
+            pool.broadcast(pyramid_cache_counts, (config,))))
+
+        for i, r in enumerate(pending):
             matching_results[r].transformation = results[i][0]
             matching_results[r].information = results[i][1]
     else:
-        for r in matching_results:
+        for (n_done, r) in enumerate(pending):
             (matching_results[r].transformation,
              matching_results[r].information) = \
-                register_point_cloud_pair(ply_file_names,
-                                          matching_results[r].s, matching_results[r].t,
-                                          matching_results[r].transformation, config)
+                register_point_cloud_pair(fragments[matching_results[r].s],
+                                          fragments[matching_results[r].t],
+                                          matching_results[r].transformation, config,
+                                          keys[matching_results[r].s], keys[matching_results[r].t])
+            report_progress(n_done + 1, len(pending), "pairs")
+        print(get_pyramid_cache(config).summary())
+
+    for r in pending:
+        manifests[r].record(result=[
+            np.asarray(matching_results[r].transformation).tolist(),
+            np.asarray(matching_results[r].information).tolist()
+        ])
 
     pose_graph_new = o3d.pipelines.registration.PoseGraph()
     odometry = np.identity(4)
@@ -203,31 +296,42 @@ def make_posegraph_for_refined_scene(ply_file_names, config):
         pose_graph_new)
 
 
-def run(config):
+def run(config, pool=None):
     print("refine rough registration of fragments.")
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Debug)
     ply_file_names = get_file_list(
         join(config["path_dataset"], config["folder_fragment"]), ".ply")
-    make_posegraph_for_refined_scene(ply_file_names, config)
+    path_dataset = config['path_dataset']
+    fragment_hashes = [
+        file_content_hash(ply_file_name) for ply_file_name in ply_file_names
+    ]
+    # brings the fragment pose store up to date before it is hashed
+    store = fragment_pose_store(path_dataset, config)
+    manifest = Manifest(
+        config, "refine_registration",
+        MANIFEST_CONFIG_KEYS["refine_registration"], [
+            join(path_dataset, config["template_global_posegraph_optimized"]),
+            join(path_dataset, config["template_fragment_pose_store"])
+        ],
+        values=fragment_hashes)
+    # the trajectory is rewritten by integrate_scene, so it is not checked
+    outputs = [
+        join(path_dataset, config["template_refined_posegraph"]),
+        join(path_dataset, config["template_refined_posegraph_optimized"])
+    ]
+    if manifest.is_current():
+        print("refine registration :: up to date.")
+        return
+    with stage_pool(config, pool) as pool:
+        make_posegraph_for_refined_scene(ply_file_names, fragment_hashes,
+                                         config, pool)
     optimize_posegraph_for_refined_scene(config["path_dataset"], config)
 
-    path_dataset = config['path_dataset']
     n_fragments = len(ply_file_names)
 
     # Save to trajectory
-    poses = []
     pose_graph_fragment = o3d.io.read_pose_graph(
         join(path_dataset, config["template_refined_posegraph_optimized"]))
-    for fragment_id in range(len(pose_graph_fragment.nodes)):
-        pose_graph_rgbd = o3d.io.read_pose_graph(
-            join(path_dataset,
-                 config["template_fragment_posegraph_optimized"] % fragment_id))
-        for frame_id in range(len(pose_graph_rgbd.nodes)):
-            frame_id_abs = fragment_id * \
-                    config['n_frames_per_fragment'] + frame_id
-            pose = np.dot(pose_graph_fragment.nodes[fragment_id].pose,
-                          pose_graph_rgbd.nodes[frame_id].pose)
-            poses.append(pose)
-
-    traj_name = join(path_dataset, config["template_global_traj"])
-    write_poses_to_log(traj_name, poses)
+    poses = store.compose(posegraph_poses(pose_graph_fragment))
+    write_scene_trajectory(path_dataset, poses, config)
+    manifest.record(outputs)
@@ -7,9 +7,10 @@
 
 # examples/python/reconstruction_system/register_fragments.py
 
-import multiprocessing
 import os
 import sys
+import threading
+import time
 
 import numpy as np
 import open3d as o3d
@@ -17,11 +18,18 @@ import open3d as o3d
 #pyexample_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 #sys.path.append(pyexample_path)
 
-from src.open3d_example import join, get_file_list, make_clean_folder, draw_registration_result
+from src.open3d_example import join, exists, basename, splitext, get_file_list, make_clean_folder, file_content_hash, draw_registration_result
 
 #sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from src.optimize_posegraph import optimize_posegraph_for_scene
 from src.refine_registration import multiscale_icp
+from src.manifest import Manifest, MANIFEST_CONFIG_KEYS
+from src.pose_store import fragment_pose_store
+from src.pair_selection import fragment_poses_from_odometry, select_fragment_pairs
+from src.shared_point_clouds import SharedArrays, attach_arrays, point_cloud_from_arrays
+from src.worker_pool import stage_pool
+from src.progress import report_progress
+from src.task_scheduler import run_scheduled
 
 
 def preprocess_point_cloud(pcd, config):
@@ -37,9 +45,104 @@ def preprocess_point_cloud(pcd, config):
     return (pcd_down, pcd_fpfh)
 
 
-def register_point_cloud_fpfh(source, target, source_fpfh, target_fpfh, config):
+def fragment_feature_file(ply_file_name, config):
+    # keyed by fragment content and voxel size, so a rewritten fragment or a
+    # changed voxel_size never picks up stale features
+    return join(
+        config["path_dataset"], config["folder_fragment_fpfh"],
+        "%s_%s_%.4f.npz" % (splitext(basename(ply_file_name))[0],
+                            file_content_hash(ply_file_name),
+                            config["voxel_size"]))
+
+
+def precompute_fragment_features(ply_file_name, config):
+    feature_file = fragment_feature_file(ply_file_name, config)
+    if exists(feature_file):
+        return feature_file
+    print("reading %s ..." % ply_file_name)
+    pcd = o3d.io.read_point_cloud(ply_file_name)
+    (pcd_down, pcd_fpfh) = preprocess_point_cloud(pcd, config)
+    tmp_file = feature_file + ".%d.%d.tmp" % (os.getpid(),
+                                              threading.get_ident())
+    with open(tmp_file, "wb") as f:
+        np.savez(f,
+                 points=np.asarray(pcd_down.points),
+                 colors=np.asarray(pcd_down.colors),
+                 normals=np.asarray(pcd_down.normals),
+                 fpfh=np.asarray(pcd_fpfh.data))
+    os.replace(tmp_file, feature_file)
+    return feature_file
+
+
+def load_fragment_arrays(feature_file):
+    with np.load(feature_file) as data:
+        return {key: data[key] for key in data.files}
+
+
+def fragment_features_from_arrays(arrays):
+    pcd_down = point_cloud_from_arrays(arrays)
+    pcd_fpfh = o3d.pipelines.registration.Feature()
+    pcd_fpfh.data = arrays["fpfh"]
+    return (pcd_down, pcd_fpfh)
+
+
+def load_fragment_features(feature_file):
+    return fragment_features_from_arrays(load_fragment_arrays(feature_file))
+
+
+def precompute_features_for_scene(ply_file_names, config, pool=None):
+    folder = join(config["path_dataset"], config["folder_fragment_fpfh"])
+    if not exists(folder):
+        os.makedirs(folder)
+    if pool is not None:
+        args = [(ply_file_name, config) for ply_file_name in ply_file_names]
+        feature_files = pool.starmap(precompute_fragment_features, args)
+    else:
+        feature_files = [
+            precompute_fragment_features(ply_file_name, config)
+            for ply_file_name in ply_file_names
+        ]
+    return feature_files
+
+
+def register_point_cloud_ransac(source, target, source_fpfh, target_fpfh,
+                                distance_threshold, max_iteration):
+    return o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
+        source, target, source_fpfh, target_fpfh, False, distance_threshold,
+        o3d.pipelines.registration.TransformationEstimationPointToPoint(False),
+        4, [
+            o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(
+                0.9),
+            o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(
+                distance_threshold)
+        ],
+        o3d.pipelines.registration.RANSACConvergenceCriteria(
+            max_iteration, 0.999))
+
+
+def validate_global_registration(source, target, transformation,
+                                 distance_threshold):
+    if (transformation.trace() == 4.0):
+        return (False, np.identity(4), np.zeros((6, 6)))
+    information = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
+        source, target, distance_threshold, transformation)
+    if information[5, 5] / min(len(source.points), len(target.points)) < 0.3:
+        return (False, np.identity(4), np.zeros((6, 6)))
+    return (True, transformation, information)
+
+
+def register_point_cloud_fpfh(source,
+                              target,
+                              source_fpfh,
+                              target_fpfh,
+                              config,
+                              pair_name=""):
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Debug)
     distance_threshold = config["voxel_size"] * 1.4
+    if config["global_registration"] == "adaptive":
+        return register_point_cloud_fpfh_adaptive(source, target, source_fpfh,
+                                                  target_fpfh, config,
+                                                  pair_name)
     if config["global_registration"] == "fgr":
         result = o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
             source, target, source_fpfh, target_fpfh,
@@ -47,46 +150,88 @@ def register_point_cloud_fpfh(source, target, source_fpfh, target_fpfh, config):
                 maximum_correspondence_distance=distance_threshold))
     if config["global_registration"] == "ransac":
         # Fallback to preset parameters that works better
-        result = o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
-            source, target, source_fpfh, target_fpfh, False, distance_threshold,
-            o3d.pipelines.registration.TransformationEstimationPointToPoint(
-                False), 4,
-            [
-                o3d.pipelines.registration.
-                CorrespondenceCheckerBasedOnEdgeLength(0.9),
-                o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(
-                    distance_threshold)
-            ],
-            o3d.pipelines.registration.RANSACConvergenceCriteria(
-                1000000, 0.999))
-    if (result.transformation.trace() == 4.0):
-        return (False, np.identity(4), np.zeros((6, 6)))
-    information = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
-        source, target, distance_threshold, result.transformation)
-    if information[5, 5] / min(len(source.points), len(target.points)) < 0.3:
-        return (False, np.identity(4), np.zeros((6, 6)))
-    return (True, result.transformation, information)
+        result = register_point_cloud_ransac(source, target, source_fpfh,
+                                             target_fpfh, distance_threshold,
+                                             1000000)
+    return validate_global_registration(source, target, result.transformation,
+                                        distance_threshold)
+
+
+def register_point_cloud_fpfh_adaptive(source, target, source_fpfh,
+                                       target_fpfh, config, pair_name):
+    # FGR, then RANSAC with a small and a large iteration budget. RANSAC runs
+    # in independent chunks, keeping the best result, until it is good
+    # enough, the tier has spent its iterations or the wall-clock budget of
+    # the pair is spent.
+    distance_threshold = config["voxel_size"] * 1.4
+    time_budget = config["global_registration_time_budget"]
+    chunk = config["global_registration_ransac_chunk"]
+    tiers = [("fgr", 0),
+             ("ransac_small", config["global_registration_ransac_small"]),
+             ("ransac_large", config["global_registration_ransac_large"])]
+    start_time = time.time()
+
+    def good_enough(result):
+        return result.fitness >= config["global_registration_min_fitness"] \
+                and result.inlier_rmse <= \
+                config["global_registration_max_rmse"]
+
+    for (tier, max_iteration) in tiers:
+        if time.time() - start_time > time_budget:
+            break
+        n_iteration = 0
+        if tier == "fgr":
+            best = o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
+                source, target, source_fpfh, target_fpfh,
+                o3d.pipelines.registration.FastGlobalRegistrationOption(
+                    maximum_correspondence_distance=distance_threshold))
+        else:
+            best = None
+            while n_iteration < max_iteration and \
+                    time.time() - start_time <= time_budget:
+                n_chunk = min(chunk, max_iteration - n_iteration)
+                result = register_point_cloud_ransac(source, target,
+                                                     source_fpfh, target_fpfh,
+                                                     distance_threshold,
+                                                     n_chunk)
+                n_iteration += n_chunk
+                if best is None or result.fitness > best.fitness:
+                    best = result
+                if good_enough(best):
+                    break
+            if best is None:
+                break
+        if good_enough(best):
+            (success, transformation,
+             information) = validate_global_registration(
+                 source, target, best.transformation, distance_threshold)
+            if success:
+                if tier != "fgr":
+                    tier = "%s after %d iterations" % (tier, n_iteration)
+                print("%s :: global registration succeeded with %s "
+                      "(fitness %.3f, rmse %.4f, %.1f s)." %
+                      (pair_name, tier, best.fitness, best.inlier_rmse,
+                       time.time() - start_time))
+                return (success, transformation, information)
+    print("%s :: global registration failed in all tiers (%.1f s)." %
+          (pair_name, time.time() - start_time))
+    return (False, np.identity(4), np.zeros((6, 6)))
 
 
 def compute_initial_registration(s, t, source_down, target_down, source_fpfh,
-                                 target_fpfh, path_dataset, config):
+                                 target_fpfh, odometry_pose, config):
 
     if t == s + 1:  # odometry case
         print("Using RGBD odometry")
-        pose_graph_frag = o3d.io.read_pose_graph(
-            join(path_dataset,
-                 config["template_fragment_posegraph_optimized"] % s))
-        n_nodes = len(pose_graph_frag.nodes)
-        transformation_init = np.linalg.inv(pose_graph_frag.nodes[n_nodes -
-                                                                  1].pose)
+        transformation_init = np.linalg.inv(odometry_pose)
         (transformation, information) = \
                 multiscale_icp(source_down, target_down,
                 [config["voxel_size"]], [50], config, transformation_init)
     else:  # loop closure case
         (success, transformation,
-         information) = register_point_cloud_fpfh(source_down, target_down,
-                                                  source_fpfh, target_fpfh,
-                                                  config)
+         information) = register_point_cloud_fpfh(
+             source_down, target_down, source_fpfh, target_fpfh, config,
+             "Fragment pair %03d - %03d" % (s, t))
         if not success:
             print("No reasonable solution. Skip this pair")
             return (False, np.identity(4), np.zeros((6, 6)))
@@ -119,17 +264,15 @@ def update_posegraph_for_scene(s, t, transformation, information, odometry,
     return (odometry, pose_graph)
 
 
-def register_point_cloud_pair(ply_file_names, s, t, config):
-    print("reading %s ..." % ply_file_names[s])
-    source = o3d.io.read_point_cloud(ply_file_names[s])
-    print("reading %s ..." % ply_file_names[t])
-    target = o3d.io.read_point_cloud(ply_file_names[t])
-    (source_down, source_fpfh) = preprocess_point_cloud(source, config)
-    (target_down, target_fpfh) = preprocess_point_cloud(target, config)
+def register_point_cloud_pair(source, target, s, t, odometry_pose, config):
+    # odometry_pose is the last frame pose of fragment s for odometry pairs,
+    # None otherwise
+    (source_down, source_fpfh) = source
+    (target_down, target_fpfh) = target
     (success, transformation, information) = \
             compute_initial_registration(
             s, t, source_down, target_down,
-            source_fpfh, target_fpfh, config["path_dataset"], config)
+            source_fpfh, target_fpfh, odometry_pose, config)
     if t != s + 1 and not success:
         return (False, np.identity(4), np.identity(6))
     #if config["debug_mode"]:
@@ -138,6 +281,21 @@ def register_point_cloud_pair(ply_file_names, s, t, config):
     return (True, transformation, information)
 
 
+def register_shared_point_cloud_pair(source_handle, target_handle, s, t,
+                                     odometry_pose, config):
+    # the fragment features live in shared memory owned by the parent
+    source = attach_arrays(source_handle, fragment_features_from_arrays)
+    target = attach_arrays(target_handle, fragment_features_from_arrays)
+    return register_point_cloud_pair(source, target, s, t, odometry_pose,
+                                     config)
+
+
+def registration_cost(n_source, n_target, odometry):
+    # global registration of a loop closure pair costs roughly an order of
+    # magnitude more than the ICP of an odometry pair
+    return (n_source + n_target) * (1.0 if odometry else 10.0)
+
+
 # other types instead of class?
 class matching_result:
 
@@ -149,37 +307,115 @@ class matching_result:
         self.infomation = np.identity(6)
 
 
-def make_posegraph_for_scene(ply_file_names, config):
+def odometry_pose(store, s, t):
+    # odometry pairs start from the last frame pose of fragment s
+    return store.fragment(s).poses[-1] if t == s + 1 else None
+
+
+def pair_manifest(s, t, fragment_hashes, store, config):
+    values = [fragment_hashes[s], fragment_hashes[t]]
+    if t == s + 1:
+        values.append(odometry_pose(store, s, t).tolist())
+        config_keys = MANIFEST_CONFIG_KEYS["register_fragments odometry"]
+    else:
+        config_keys = MANIFEST_CONFIG_KEYS["register_fragments loop closure"]
+    return Manifest(config, "register_fragments/pair_%03d_%03d" % (s, t),
+                    config_keys, values=values)
+
+
+def make_posegraph_for_scene(ply_file_names, fragment_hashes, store, config,
+                             pool=None):
     pose_graph = o3d.pipelines.registration.PoseGraph()
     odometry = np.identity(4)
     pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(odometry))
 
+    # downsampling, normals and FPFH are computed once per fragment
+    feature_files = precompute_features_for_scene(ply_file_names, config,
+                                                  pool)
+
+    # every fragment is read once here instead of once per pair
+    fragment_arrays = [
+        load_fragment_arrays(feature_file) for feature_file in feature_files
+    ]
+
     n_files = len(ply_file_names)
+    pairs = [(s, t) for s in range(n_files) for t in range(s + 1, n_files)]
+    if config["pair_selection"] == "overlap":
+        features = [
+            fragment_features_from_arrays(arrays) for arrays in fragment_arrays
+        ]
+        poses = fragment_poses_from_odometry(store, n_files)
+        n_pairs = len(pairs)
+        pairs = select_fragment_pairs(
+            [np.asarray(pcd_down.points) for (pcd_down, _) in features],
+            [pcd_fpfh for (_, pcd_fpfh) in features], poses, config)
+        print("register fragments :: %d of %d fragment pairs selected "
+              "(%d pruned)." % (len(pairs), n_pairs, n_pairs - len(pairs)))
+
     matching_results = {}
-    for s in range(n_files):
-        for t in range(s + 1, n_files):
-            matching_results[s * n_files + t] = matching_result(s, t)
-
-    if config["python_multi_threading"] is True:
-        os.environ['OMP_NUM_THREADS'] = '1'
-        max_workers = max(
-            1, min(multiprocessing.cpu_count() - 1, len(matching_results)))
-        mp_context = multiprocessing.get_context('spawn')
-        with mp_context.Pool(processes=max_workers) as pool:
-            args = [(ply_file_names, v.s, v.t, config)
-                    for k, v in matching_results.items()]
-            results = pool.starmap(register_point_cloud_pair, args)
-
-        for i, r in enumerate(matching_results):
+    for (s, t) in pairs:
+        matching_results[s * n_files + t] = matching_result(s, t)
+
+    # pairs whose fragments and parameters are unchanged take the recorded
+    # result
+    manifests = {
+        r: pair_manifest(v.s, v.t, fragment_hashes, store, config)
+        for r, v in matching_results.items()
+    }
+    cached = {r for r in matching_results if manifests[r].is_current()}
+    for r in cached:
+        (success, transformation, information) = manifests[r].result()
+        matching_results[r].success = success
+        matching_results[r].transformation = np.array(transformation)
+        matching_results[r].information = np.array(information)
+    pending = {
+        r: v for r, v in matching_results.items() if r not in cached
+    }
+    print("register fragments :: %d of %d pairs up to date." %
+          (len(cached), len(matching_results)))
+
+    if pool is not None:
+        n_points = [arrays["points"].shape[0] for arrays in fragment_arrays]
+        with SharedArrays(fragment_arrays) as shared:
+            args = [(shared.handles[v.s], shared.handles[v.t], v.s, v.t,
+                     odometry_pose(store, v.s, v.t), config)
+                    for k, v in pending.items()]
+            keys = [
+                "register_fragments %03d-%03d" % (v.s, v.t)
+                for k, v in pending.items()
+            ]
+            costs = [
+                registration_cost(n_points[v.s], n_points[v.t], v.t == v.s + 1)
+                for k, v in pending.items()
+            ]
+            results = run_scheduled(pool, register_shared_point_cloud_pair,
+                                    args, keys, costs, config, "pairs")
+
+        for i, r in enumerate(pending):
             matching_results[r].success = results[i][0]
             matching_results[r].transformation = results[i][1]
             matching_results[r].information = results[i][2]
     else:
-        for r in matching_results:
+        features = [
+            fragment_features_from_arrays(arrays) for arrays in fragment_arrays
+        ]
+        for (n_done, r) in enumerate(pending):
             (matching_results[r].success, matching_results[r].transformation,
              matching_results[r].information) = \
-                register_point_cloud_pair(ply_file_names,
-                                          matching_results[r].s, matching_results[r].t, config)
+                register_point_cloud_pair(features[matching_results[r].s],
+                                          features[matching_results[r].t],
+                                          matching_results[r].s, matching_results[r].t,
+                                          odometry_pose(store, matching_results[r].s,
+                                                        matching_results[r].t),
+                                          config)
+            report_progress(n_done + 1, len(pending), "pairs")
+
+    for r in pending:
+        manifests[r].record(result=[
+            bool(matching_results[r].success),
+            np.asarray(matching_results[r].transformation).tolist(),
+            np.asarray(matching_results[r].information).tolist()
+        ])
 
     for r in matching_results:
         if matching_results[r].success:
@@ -192,11 +428,37 @@ def make_posegraph_for_scene(ply_file_names, config):
         pose_graph)
 
 
-def run(config):
+def run(config, pool=None):
     print("register fragments.")
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Debug)
     ply_file_names = get_file_list(
         join(config["path_dataset"], config["folder_fragment"]), ".ply")
-    make_clean_folder(join(config["path_dataset"], config["folder_scene"]))
-    make_posegraph_for_scene(ply_file_names, config)
+    fragment_hashes = [
+        file_content_hash(ply_file_name) for ply_file_name in ply_file_names
+    ]
+    # brings the fragment pose store up to date before it is hashed; the
+    # pairs below use this store instead of checking it again
+    store = fragment_pose_store(config["path_dataset"], config)
+    manifest = Manifest(
+        config, "register_fragments", MANIFEST_CONFIG_KEYS["register_fragments"],
+        [join(config["path_dataset"], config["template_fragment_pose_store"])],
+        values=fragment_hashes)
+    if manifest.is_current():
+        print("register fragments :: up to date.")
+        return
+    if config["incremental"]:
+        # the outputs of the later stages are kept for their own manifests
+        os.makedirs(join(config["path_dataset"], config["folder_scene"]),
+                    exist_ok=True)
+    else:
+        make_clean_folder(join(config["path_dataset"],
+                               config["folder_scene"]))
+    with stage_pool(config, pool) as pool:
+        make_posegraph_for_scene(ply_file_names, fragment_hashes, store,
+                                 config, pool)
     optimize_posegraph_for_scene(config["path_dataset"], config)
+    manifest.record([
+        join(config["path_dataset"], config["template_global_posegraph"]),
+        join(config["path_dataset"],
+             config["template_global_posegraph_optimized"])
+    ])
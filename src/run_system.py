@@ -19,6 +19,8 @@ import open3d as o3d
 from src.open3d_example import check_folder_structure
 
 from src.initialize_config import initialize_config, dataset_loader
+from src.progress import start_stage
+from src.worker_pool import stage_pool
 
 def get_pointcloud():
     # load dataset and check folder structure
@@ -37,25 +39,31 @@ def get_pointcloud():
         print("%40s : %s" % (key, str(val)))
 
     times = [0, 0, 0, 0]
-    start_time = time.time()
-    import src.make_fragments
-    src.make_fragments.run(config)
-    times[0] = time.time() - start_time
-
-    start_time = time.time()
-    import src.register_fragments
-    src.register_fragments.run(config)
-    times[1] = time.time() - start_time
-
-    start_time = time.time()
-    import src.refine_registration
-    src.refine_registration.run(config)
-    times[2] = time.time() - start_time
-
-    start_time = time.time()
-    import src.integrate_scene
-    src.integrate_scene.run(config)
-    times[3] = time.time() - start_time
+    # one pool for all stages, so workers start and import open3d only once
+    with stage_pool(config) as pool:
+        start_time = time.time()
+        start_stage("make_fragments", 0, 4)
+        import src.make_fragments
+        src.make_fragments.run(config, pool)
+        times[0] = time.time() - start_time
+
+        start_time = time.time()
+        start_stage("register_fragments", 1, 4)
+        import src.register_fragments
+        src.register_fragments.run(config, pool)
+        times[1] = time.time() - start_time
+
+        start_time = time.time()
+        start_stage("refine_registration", 2, 4)
+        import src.refine_registration
+        src.refine_registration.run(config, pool)
+        times[2] = time.time() - start_time
+
+        start_time = time.time()
+        start_stage("integrate_scene", 3, 4)
+        import src.integrate_scene
+        src.integrate_scene.run(config, pool)
+        times[3] = time.time() - start_time
 
 
 
@@ -0,0 +1,69 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import open3d as o3d
+
+
+def asset_key(path):
+    # identifies a version of the file without reading it
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+class SceneAssetManager:
+    """Point clouds of PLY files and their KD-trees, loaded once per version.
+
+    Assets are keyed by path, modification time and size, so a file that
+    the reconstruction rewrote is read again the next time it is asked for,
+    and the same cloud object is returned until then. Clouds are read by a
+    background thread; the KD-tree of a cloud is built on first use. Only
+    the latest version of every path is kept.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        # absolute path -> [key, future of the cloud, KD-tree or None]
+        self._assets = {}
+
+    def load(self, path):
+        # future of the cloud of the current version of path; starts reading
+        # it unless that version is loaded or being loaded
+        key = asset_key(path)
+        with self._lock:
+            asset = self._assets.get(key[0])
+            if asset is None or asset[0] != key:
+                asset = [
+                    key,
+                    self._executor.submit(o3d.io.read_point_cloud, path), None
+                ]
+                self._assets[key[0]] = asset
+            return asset[1]
+
+    def request(self, path, callback):
+        # callback(pcd) once the cloud is loaded, right away if it already
+        # is; otherwise called from the loading thread
+        self.load(path).add_done_callback(
+            lambda future: callback(future.result()))
+
+    def point_cloud(self, path):
+        return self.load(path).result()
+
+    def kdtree(self, pcd):
+        # the KD-tree is kept with the cached cloud it was built for; a cloud
+        # not from this manager gets an uncached one
+        with self._lock:
+            assets = [
+                asset for asset in self._assets.values()
+                if asset[1].done() and asset[1].exception() is None and
+                asset[1].result() is pcd
+            ]
+        if len(assets) == 0:
+            return o3d.geometry.KDTreeFlann(pcd)
+        if assets[0][2] is None:
+            assets[0][2] = o3d.geometry.KDTreeFlann(pcd)
+        return assets[0][2]
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
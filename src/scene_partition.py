@@ -0,0 +1,109 @@
+import numpy as np
+import open3d as o3d
+
+
+def frame_tiles(depth, pose, intrinsic, config):
+    """Keys of the tiles a depth frame can write to.
+
+    Every pixel is backprojected at its depth and at the two ends of its
+    truncation band; a frame is assigned to every tile within two voxel
+    blocks of the blocks those points fall in, which covers the blocks the
+    tensor integration allocates for it.
+    """
+    tile_size = config["scene_integration_tile_size"]
+    block_size = config["tsdf_cubic_size"] / 512.0 * 16
+    trunc = config["sdf_trunc"]
+    fx, fy = intrinsic.get_focal_length()
+    cx, cy = intrinsic.get_principal_point()
+    depth = np.asarray(depth).astype(np.float64) / config["depth_scale"]
+    (v, u) = np.nonzero((depth > 0) & (depth <= config["depth_max"]))
+    if v.shape[0] == 0:
+        return set()
+    z = depth[v, u]
+    rays = np.stack([(u - cx) / fx, (v - cy) / fy, np.ones_like(z)])
+    blocks = []
+    for offset in (-trunc, 0.0, trunc):
+        points = pose[:3, :3] @ (rays * (z + offset)) + pose[:3, 3:]
+        blocks.append(np.floor(points.T / block_size).astype(np.int64))
+    blocks = np.unique(np.concatenate(blocks), axis=0)
+    # the slack is smaller than a tile, so a block touches at most two tiles
+    # per axis
+    first = np.floor((blocks - 2) * block_size / tile_size).astype(np.int64)
+    last = np.floor((blocks + 3) * block_size / tile_size).astype(np.int64)
+    keys = []
+    for i in (first[:, 0], last[:, 0]):
+        for j in (first[:, 1], last[:, 1]):
+            for k in (first[:, 2], last[:, 2]):
+                keys.append(np.stack([i, j, k], axis=1))
+    return set(map(tuple, np.unique(np.concatenate(keys), axis=0).tolist()))
+
+
+def partition_frames(poses, tiles_of_frames, config):
+    """Groups frames by tile.
+
+    ``tiles_of_frames`` holds the tile keys of every frame (see
+    ``frame_tiles``). Returns (tile_min, tile_max, poses) for the tiles
+    that see at least one frame.
+    """
+    tile_size = config["scene_integration_tile_size"]
+    tiles = {}
+    for (frame, keys) in zip(poses, tiles_of_frames):
+        for key in keys:
+            tiles.setdefault(key, []).append(frame)
+    return [(np.array(key, dtype=np.float64) * tile_size,
+             (np.array(key, dtype=np.float64) + 1) * tile_size, frames)
+            for key, frames in sorted(tiles.items())]
+
+
+def crop_mesh_indices(mesh, tile_min, tile_max):
+    # keeps the triangles whose centroid lies in the half-open tile, so every
+    # triangle of the scene is kept by exactly one tile; returns the indices
+    # of the vertices they use and the triangles indexing those
+    vertices = np.asarray(mesh.vertices)
+    triangles = np.asarray(mesh.triangles)
+    if triangles.shape[0] == 0:
+        return (np.zeros(0, np.int64), np.zeros((0, 3), np.int64))
+    centroids = vertices[triangles].mean(axis=1)
+    inside = np.all((centroids >= tile_min) & (centroids < tile_max), axis=1)
+    triangles = triangles[inside]
+    used = np.unique(triangles)
+    remap = np.full(vertices.shape[0], -1, dtype=np.int64)
+    remap[used] = np.arange(used.shape[0])
+    return (used, remap[triangles])
+
+
+def crop_mesh_arrays(mesh, tile_min, tile_max):
+    (used, triangles) = crop_mesh_indices(mesh, tile_min, tile_max)
+    colors = np.asarray(mesh.vertex_colors)
+    return (np.asarray(mesh.vertices)[used], colors[used]
+            if colors.shape[0] > 0 else np.zeros((used.shape[0], 3)), triangles)
+
+
+def merge_mesh_arrays(tile_meshes):
+    # vertices on tile seams are produced identically by both tiles and are
+    # merged into one
+    vertices = []
+    colors = []
+    triangles = []
+    offset = 0
+    for (tile_vertices, tile_colors, tile_triangles) in tile_meshes:
+        vertices.append(tile_vertices)
+        colors.append(tile_colors)
+        triangles.append(tile_triangles + offset)
+        offset += tile_vertices.shape[0]
+    mesh = o3d.geometry.TriangleMesh()
+    if offset == 0:
+        return mesh
+    vertices = np.concatenate(vertices)
+    colors = np.concatenate(colors)
+    triangles = np.concatenate(triangles)
+    (vertices, first, inverse) = np.unique(vertices,
+                                           axis=0,
+                                           return_index=True,
+                                           return_inverse=True)
+    mesh.vertices = o3d.utility.Vector3dVector(vertices)
+    mesh.vertex_colors = o3d.utility.Vector3dVector(colors[first])
+    mesh.triangles = o3d.utility.Vector3iVector(
+        inverse.reshape(-1)[triangles].astype(np.int32))
+    mesh.compute_vertex_normals()
+    return mesh
@@ -0,0 +1,87 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+import open3d as o3d
+
+
+class SharedArrays:
+    """Named numpy arrays of several items placed in shared memory blocks.
+
+    Created once by the parent process; ``handles`` is a small picklable
+    description of the blocks that worker processes pass to
+    ``attach_arrays`` to map them without copying or touching the disk.
+    The parent owns the blocks and releases them with ``close``.
+    """
+
+    def __init__(self, items):
+        self.handles = []
+        self._blocks = []
+        try:
+            for arrays in items:
+                handle = {}
+                for key, array in arrays.items():
+                    array = np.ascontiguousarray(array)
+                    block = shared_memory.SharedMemory(create=True,
+                                                       size=max(
+                                                           array.nbytes, 1))
+                    self._blocks.append(block)
+                    np.ndarray(array.shape, array.dtype,
+                               buffer=block.buf)[...] = array
+                    handle[key] = (block.name, array.shape, array.dtype.str)
+                self.handles.append(handle)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach_arrays(handle, function):
+    # calls function with the attached arrays; the views are only valid
+    # during the call, so function has to copy whatever it keeps
+    blocks = []
+    try:
+        arrays = {}
+        for key, (name, shape, dtype) in handle.items():
+            block = shared_memory.SharedMemory(name=name)
+            blocks.append(block)
+            arrays[key] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        result = function(arrays)
+        del arrays
+        return result
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def point_cloud_to_arrays(pcd):
+    arrays = {"points": np.asarray(pcd.points)}
+    if pcd.has_colors():
+        arrays["colors"] = np.asarray(pcd.colors)
+    if pcd.has_normals():
+        arrays["normals"] = np.asarray(pcd.normals)
+    return arrays
+
+
+def point_cloud_from_arrays(arrays):
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(arrays["points"])
+    if "colors" in arrays:
+        pcd.colors = o3d.utility.Vector3dVector(arrays["colors"])
+    if "normals" in arrays:
+        pcd.normals = o3d.utility.Vector3dVector(arrays["normals"])
+    return pcd
+
+
+def attach_point_cloud(handle):
+    return attach_arrays(handle, point_cloud_from_arrays)
@@ -15,6 +15,7 @@ pyexample_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(pyexample_path)
 
 from open3d_example import join, get_file_list, write_poses_to_log
+from src.pose_store import fragment_pose_store, posegraph_poses
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
@@ -83,16 +84,13 @@ def run(config):
              config["template_optimized_posegraph_slac"]), pose_graph_updated)
 
     # Write trajectory for slac-integrate stage.
-    fragment_folder = join(path_dataset, config["folder_fragment"])
     params = []
-    for i in range(len(pose_graph_updated.nodes)):
-        fragment_pose_graph = o3d.io.read_pose_graph(
-            join(fragment_folder, "fragment_optimized_%03d.json" % i))
-        for node in fragment_pose_graph.nodes:
-            pose = np.dot(pose_graph_updated.nodes[i].pose, node.pose)
-            param = o3d.camera.PinholeCameraParameters()
-            param.extrinsic = np.linalg.inv(pose)
-            params.append(param)
+    scene_poses = fragment_pose_store(path_dataset, config).compose(
+        posegraph_poses(pose_graph_updated))
+    for extrinsic in np.linalg.inv(scene_poses.poses):
+        param = o3d.camera.PinholeCameraParameters()
+        param.extrinsic = extrinsic
+        params.append(param)
 
     trajectory = o3d.camera.PinholeCameraTrajectory()
     trajectory.parameters = params
@@ -16,10 +16,37 @@ pyexample_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(pyexample_path)
 
 from open3d_example import join, get_rgbd_file_lists
+from src.out_of_core_volume import OutOfCoreVolume
+from src.pose_store import fragment_pose_store
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 
+def deformed_frames(posegraph, fragment_poses, color_files, depth_files,
+                    ctr_grid, intrinsic_t, device, config):
+    # depth, color and extrinsic of every frame, deformed by the control grid
+    k = 0
+    depth_scale = float(config['depth_scale'])
+    depth_max = float(config['depth_max'])
+    for i in range(len(posegraph.nodes)):
+        for pose_local in fragment_poses.fragment(i).poses:
+            extrinsic_local_t = o3d.core.Tensor(np.linalg.inv(pose_local))
+
+            pose = np.dot(posegraph.nodes[i].pose, pose_local)
+            extrinsic_t = o3d.core.Tensor(np.linalg.inv(pose))
+
+            depth = o3d.t.io.read_image(depth_files[k]).to(device)
+            color = o3d.t.io.read_image(color_files[k]).to(device)
+            rgbd = o3d.t.geometry.RGBDImage(color, depth)
+
+            print('Deforming and integrating Frame {:3d}'.format(k))
+            rgbd_projected = ctr_grid.deform(rgbd, intrinsic_t,
+                                             extrinsic_local_t, depth_scale,
+                                             depth_max)
+            yield (rgbd_projected.depth, rgbd_projected.color, extrinsic_t)
+            k = k + 1
+
+
 def run(config):
     print("slac non-rigid optimization.")
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Debug)
@@ -58,14 +85,10 @@ def run(config):
 
     device = o3d.core.Device(
         'CUDA:0' if o3d.core.cuda.is_available() else 'CPU:0')
-    voxel_grid = o3d.t.geometry.VoxelBlockGrid(
-        attr_names=('tsdf', 'weight', 'color'),
-        attr_dtypes=(o3c.float32, o3c.float32, o3c.float32),
-        attr_channels=((1), (1), (3)),
-        voxel_size=config['tsdf_cubic_size'] / 512,
-        block_resolution=16,
-        block_count=config['block_count'],
-        device=device)
+    if config["tsdf_memory_limit_mb"] > 0:
+        # blocks beyond the memory cap are spilled to disk, so the volume
+        # stays on the CPU
+        device = o3d.core.Device('CPU:0')
 
     # Load control grid.
     ctr_grid_keys = o3d.core.Tensor.load(slac_folder + "ctr_grid_keys.npy")
@@ -76,38 +99,45 @@ def run(config):
                                                  ctr_grid_values.to(device),
                                                  device)
 
-    fragment_folder = join(path_dataset, config["folder_fragment"])
+    frames = deformed_frames(posegraph,
+                             fragment_pose_store(path_dataset, config),
+                             color_files, depth_files, ctr_grid, intrinsic_t,
+                             device, config)
+
+    if config["tsdf_memory_limit_mb"] > 0:
+        with OutOfCoreVolume(intrinsic,
+                             config,
+                             slac_folder,
+                             trunc_voxel_multiplier=8.0) as volume:
+            for (depth, color, extrinsic_t) in frames:
+                volume.integrate_images(depth, color, extrinsic_t)
+            # extracted tile by tile, straight into the output file
+            print("slac integrate :: %s." % volume.summary())
+            if (config["save_output_as"] == "pointcloud"):
+                volume.write_point_cloud(
+                    join(slac_folder, "output_slac_pointcloud.ply"))
+            else:
+                volume.write_triangle_mesh(
+                    join(slac_folder, "output_slac_mesh.ply"))
+        return
+
+    voxel_grid = o3d.t.geometry.VoxelBlockGrid(
+        attr_names=('tsdf', 'weight', 'color'),
+        attr_dtypes=(o3c.float32, o3c.float32, o3c.float32),
+        attr_channels=((1), (1), (3)),
+        voxel_size=config['tsdf_cubic_size'] / 512,
+        block_resolution=16,
+        block_count=config['block_count'],
+        device=device)
 
-    k = 0
     depth_scale = float(config['depth_scale'])
     depth_max = float(config['depth_max'])
-    for i in range(len(posegraph.nodes)):
-        fragment_pose_graph = o3d.io.read_pose_graph(
-            join(fragment_folder, "fragment_optimized_%03d.json" % i))
-        for node in fragment_pose_graph.nodes:
-            pose_local = node.pose
-            extrinsic_local_t = o3d.core.Tensor(np.linalg.inv(pose_local))
+    for (depth, color, extrinsic_t) in frames:
+        frustum_block_coords = voxel_grid.compute_unique_block_coordinates(
+            depth, intrinsic_t, extrinsic_t, depth_scale, depth_max)
 
-            pose = np.dot(posegraph.nodes[i].pose, node.pose)
-            extrinsic_t = o3d.core.Tensor(np.linalg.inv(pose))
-
-            depth = o3d.t.io.read_image(depth_files[k]).to(device)
-            color = o3d.t.io.read_image(color_files[k]).to(device)
-            rgbd = o3d.t.geometry.RGBDImage(color, depth)
-
-            print('Deforming and integrating Frame {:3d}'.format(k))
-            rgbd_projected = ctr_grid.deform(rgbd, intrinsic_t,
-                                             extrinsic_local_t, depth_scale,
-                                             depth_max)
-
-            frustum_block_coords = voxel_grid.compute_unique_block_coordinates(
-                rgbd_projected.depth, intrinsic_t, extrinsic_t, depth_scale,
-                depth_max)
-
-            voxel_grid.integrate(frustum_block_coords, rgbd_projected.depth,
-                                 rgbd_projected.color, intrinsic_t, extrinsic_t,
-                                 depth_scale, depth_max)
-            k = k + 1
+        voxel_grid.integrate(frustum_block_coords, depth, color, intrinsic_t,
+                             extrinsic_t, depth_scale, depth_max)
 
     if (config["save_output_as"] == "pointcloud"):
         pcd = voxel_grid.extract_point_cloud().to(o3d.core.Device("CPU:0"))
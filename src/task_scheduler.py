@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from src.open3d_example import join, exists
+from src.progress import report_progress
+
+
+class TaskTimings:
+    """Measured task durations in seconds, kept across runs in a json file.
+
+    Tasks are identified by string keys such as
+    ``"register_fragments 000-003"``. Recorded durations are used as cost
+    estimates by later runs.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.seconds = {}
+        if exists(filename):
+            try:
+                with open(filename) as f:
+                    self.seconds = json.load(f)
+            except (OSError, ValueError):
+                self.seconds = {}
+
+    def estimate_costs(self, keys, heuristic_costs):
+        # recorded durations where available; heuristic costs elsewhere,
+        # scaled to seconds by the median ratio of the tasks that have both
+        heuristic_costs = np.asarray(heuristic_costs, dtype=np.float64)
+        recorded = np.array([self.seconds.get(key, np.nan) for key in keys],
+                            dtype=np.float64)
+        known = ~np.isnan(recorded) & (heuristic_costs > 0)
+        scale = np.median(recorded[known] /
+                          heuristic_costs[known]) if np.any(known) else 1.0
+        return np.where(np.isnan(recorded), heuristic_costs * scale, recorded)
+
+    def record(self, keys, seconds):
+        for key, s in zip(keys, seconds):
+            self.seconds[key] = s
+
+    def save(self):
+        tmp_file = self.filename + ".%d.%d.tmp" % (os.getpid(),
+                                                   threading.get_ident())
+        with open(tmp_file, "w") as f:
+            json.dump(self.seconds, f, indent=4, sort_keys=True)
+        os.replace(tmp_file, self.filename)
+
+
+def timed_call(task):
+    (index, function, args) = task
+    start_time = time.time()
+    result = function(*args)
+    return (index, result, time.time() - start_time)
+
+
+def run_scheduled(pool, function, args, keys, heuristic_costs, config,
+                  unit="tasks"):
+    """Runs function(*args[i]) for every task on pool, most expensive first.
+
+    Tasks are handed out one at a time, so a long task that would otherwise
+    be dispatched late cannot stretch the tail of the stage. Results are
+    returned in the order of args, and the measured durations are recorded
+    for the cost estimates of later runs. Progress is reported in ``unit``
+    as tasks complete.
+    """
+    timings = TaskTimings(
+        join(config["path_dataset"], config["template_task_timings"]))
+    costs = timings.estimate_costs(keys, heuristic_costs)
+    order = np.argsort(-costs, kind="stable")
+    results = [None] * len(args)
+    seconds = [0.0] * len(args)
+    for (n_done, (index, result, s)) in enumerate(
+            pool.imap_unordered(timed_call,
+                                [(int(i), function, args[i]) for i in order])):
+        results[index] = result
+        seconds[index] = s
+        report_progress(n_done + 1, len(args), unit)
+    timings.record(keys, seconds)
+    timings.save()
+    return results
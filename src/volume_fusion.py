@@ -0,0 +1,146 @@
+import numpy as np
+import open3d as o3d
+import open3d.core as o3c
+
+from src.block_store import pack_block_keys, unpack_block_keys
+
+# (dx, dy, dz) of the eight corners of a trilinear interpolation cell
+_CORNERS = np.array([[x, y, z] for z in (0, 1) for y in (0, 1) for x in (0, 1)],
+                    dtype=np.int64)
+
+
+def _unique_keys(keys):
+    # np.unique over rows is slow, the packed keys are sorted instead
+    return unpack_block_keys(np.unique(pack_block_keys(keys)))
+
+
+def _block_voxels(block_keys, block_resolution):
+    # integer voxel coordinates of all voxels of the blocks, in the memory
+    # order of the VoxelBlockGrid (x fastest, then y, then z)
+    r = np.arange(block_resolution)
+    (z, y, x) = np.meshgrid(r, r, r, indexing="ij")
+    local = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1)
+    return (block_keys[:, None, :] * block_resolution +
+            local[None, :, :]).reshape(-1, 3)
+
+
+def _buf_indices(hashmap, blocks):
+    # buffer index of the blocks, -1 where the block is not allocated
+    (buf_indices, masks) = hashmap.find(o3c.Tensor(blocks.astype(np.int32)))
+    buf_indices = buf_indices.numpy().astype(np.int64)
+    buf_indices[~masks.numpy()] = -1
+    return buf_indices
+
+
+def fuse_volume(scene_grid, fragment_grid, pose, voxel_size, block_resolution,
+                chunk_blocks=256):
+    """Fuses a fragment VoxelBlockGrid into the scene grid.
+
+    ``pose`` maps fragment to scene coordinates. Every scene voxel near the
+    transformed fragment surface samples the fragment TSDF, weight and color
+    by trilinear interpolation at its position in the fragment frame
+    (backward resampling, so the scene grid has no holes), and is merged
+    with the scene values as a weighted running average, as integrating the
+    fragment's frames would. Both grids have to live on the CPU.
+    """
+    fragment_hashmap = fragment_grid.hashmap()
+    fragment_buf = fragment_hashmap.active_buf_indices().numpy()
+    if fragment_buf.shape[0] == 0:
+        return
+    fragment_keys = fragment_hashmap.key_tensor().numpy()[fragment_buf].astype(
+        np.int64)
+    fragment_tsdf = fragment_grid.attribute("tsdf").numpy().reshape(-1)
+    fragment_weight = fragment_grid.attribute("weight").numpy().reshape(-1)
+    fragment_color = fragment_grid.attribute("color").numpy().reshape(-1, 3)
+    n_voxels = block_resolution**3
+    block_size = voxel_size * block_resolution
+
+    # scene blocks reached by the observed fragment voxels
+    scene_blocks = []
+    for i in range(0, fragment_keys.shape[0], chunk_blocks):
+        keys = fragment_keys[i:i + chunk_blocks]
+        buf = fragment_buf[i:i + chunk_blocks].astype(np.int64)
+        flat = (buf[:, None] * n_voxels + np.arange(n_voxels)).reshape(-1)
+        observed = fragment_weight[flat] > 0
+        points = _block_voxels(keys, block_resolution)[observed] * voxel_size
+        points = points @ pose[:3, :3].T + pose[:3, 3]
+        scene_blocks.append(
+            _unique_keys(np.floor(points / block_size).astype(np.int64)))
+    scene_blocks = _unique_keys(np.concatenate(scene_blocks))
+    if scene_blocks.shape[0] == 0:
+        return
+
+    scene_hashmap = scene_grid.hashmap()
+    if scene_hashmap.size() + scene_blocks.shape[0] > scene_hashmap.capacity():
+        scene_hashmap.reserve(
+            int((scene_hashmap.size() + scene_blocks.shape[0]) * 1.5))
+    scene_hashmap.activate(o3c.Tensor(scene_blocks.astype(np.int32)))
+    (scene_buf, _) = scene_hashmap.find(
+        o3c.Tensor(scene_blocks.astype(np.int32)))
+    scene_buf = scene_buf.numpy().astype(np.int64)
+    # views of the scene attributes, fetched after activation since reserve
+    # reallocates them
+    scene_tsdf = scene_grid.attribute("tsdf").numpy().reshape(-1)
+    scene_weight = scene_grid.attribute("weight").numpy().reshape(-1)
+    scene_color = scene_grid.attribute("color").numpy().reshape(-1, 3)
+
+    inverse_pose = np.linalg.inv(pose)
+    for i in range(0, scene_blocks.shape[0], chunk_blocks):
+        keys = scene_blocks[i:i + chunk_blocks]
+        buf = scene_buf[i:i + chunk_blocks]
+        flat = (buf[:, None] * n_voxels + np.arange(n_voxels)).reshape(-1)
+        points = _block_voxels(keys, block_resolution) * voxel_size
+        grid_points = (points @ inverse_pose[:3, :3].T +
+                       inverse_pose[:3, 3]) / voxel_size
+        base = np.floor(grid_points).astype(np.int64)
+        frac = (grid_points - base).astype(np.float32)
+        base_block = np.floor_divide(base, block_resolution)
+        base_local = base - base_block * block_resolution
+        base_buf = _buf_indices(fragment_hashmap, base_block)
+        # a corner leaves the block of the cell base only on the last layer of
+        # voxels, those are looked up separately
+        on_face = base_local == block_resolution - 1
+
+        weight = np.zeros(points.shape[0], dtype=np.float32)
+        tsdf = np.zeros(points.shape[0], dtype=np.float32)
+        color = np.zeros((points.shape[0], 3), dtype=np.float32)
+        for corner in _CORNERS:
+            coefficient = np.ones(points.shape[0], dtype=np.float32)
+            for axis in range(3):
+                coefficient *= frac[:, axis] if corner[axis] else \
+                        1.0 - frac[:, axis]
+            local = base_local + corner
+            buf = base_buf
+            crossing = np.any(on_face & (corner == 1), axis=1)
+            if np.any(crossing):
+                buf = base_buf.copy()
+                carry = local[crossing] // block_resolution
+                buf[crossing] = _buf_indices(fragment_hashmap,
+                                             base_block[crossing] + carry)
+                local[crossing] -= carry * block_resolution
+            found = buf >= 0
+            source = np.where(
+                found, buf * n_voxels + local[:, 0] +
+                block_resolution * local[:, 1] +
+                block_resolution * block_resolution * local[:, 2], 0)
+            w = fragment_weight[source] * (coefficient * found)
+            weight += w
+            tsdf += w * fragment_tsdf[source]
+            color += w[:, None] * fragment_color[source]
+
+        update = weight > 0
+        flat = flat[update]
+        weight = weight[update]
+        tsdf = tsdf[update] / weight
+        color = color[update] / weight[:, None]
+        old_weight = scene_weight[flat]
+        new_weight = old_weight + weight
+        scene_tsdf[flat] = (scene_tsdf[flat] * old_weight +
+                            tsdf * weight) / new_weight
+        scene_color[flat] = (scene_color[flat] * old_weight[:, None] +
+                             color * weight[:, None]) / new_weight[:, None]
+        scene_weight[flat] = new_weight
+
+
+def load_volume(filename):
+    return o3d.t.geometry.VoxelBlockGrid.load(filename).cpu()
@@ -0,0 +1,118 @@
+import multiprocessing
+import multiprocessing.pool
+import os
+import threading
+from contextlib import contextmanager
+
+
+class WorkerPool:
+    """Long-lived pool of workers shared by the reconstruction stages.
+
+    ``config["worker_pool_backend"]`` selects ``"process"`` (spawned
+    processes, one OpenMP thread each) or ``"thread"`` (threads of the
+    calling process; Open3D releases the GIL in its heavy kernels). The
+    workers live until ``close``, so their imports and per-process state
+    (see ``process_state``) are paid for once per run instead of per stage.
+    """
+
+    def __init__(self, config, max_workers=None):
+        if max_workers is None:
+            max_workers = max(1, multiprocessing.cpu_count() - 1)
+        self.backend = config["worker_pool_backend"]
+        self.max_workers = max_workers
+        if self.backend == "process":
+            # Prevent over allocation of open mp threads in child processes
+            os.environ['OMP_NUM_THREADS'] = '1'
+            mp_context = multiprocessing.get_context('spawn')
+            barrier = mp_context.Barrier(max_workers)
+            self._pool = mp_context.Pool(processes=max_workers,
+                                         initializer=_init_worker,
+                                         initargs=(barrier,))
+        elif self.backend == "thread":
+            barrier = threading.Barrier(max_workers)
+            self._pool = multiprocessing.pool.ThreadPool(
+                processes=max_workers,
+                initializer=_init_worker,
+                initargs=(barrier,))
+        else:
+            raise ValueError("unknown worker_pool_backend %s" % self.backend)
+
+    def starmap(self, function, args):
+        args = list(args)
+        if len(args) == 0:
+            return []
+        return self._pool.starmap(function, args, chunksize=1)
+
+    def imap_unordered(self, function, iterable):
+        return self._pool.imap_unordered(function, iterable, chunksize=1)
+
+    def broadcast(self, function, args=()):
+        # function(*args) once in every worker: each task waits for all
+        # others, so no worker can take two of them
+        return self.starmap(_broadcast_task,
+                            [(function, args)] * self.max_workers)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+@contextmanager
+def stage_pool(config, pool=None):
+    # the pool passed in by run_system, or a pool for a stage run on its own
+    if pool is not None:
+        yield pool
+    elif config["python_multi_threading"] is True:
+        with WorkerPool(config) as pool:
+            yield pool
+    else:
+        yield None
+
+
+_worker_barrier = None
+
+
+def _init_worker(barrier):
+    global _worker_barrier
+    _worker_barrier = barrier
+
+
+def _broadcast_task(function, args):
+    result = function(*args)
+    _worker_barrier.wait()
+    return result
+
+
+_process_state = {}
+_process_state_lock = threading.Lock()
+
+
+def process_state(key, factory):
+    # value kept for the lifetime of the process, so pool workers reuse it
+    # across tasks and stages
+    with _process_state_lock:
+        if key not in _process_state:
+            _process_state[key] = factory()
+        return _process_state[key]
+
+
+def release_process_state(name):
+    # drops the values whose key starts with name, e.g. the per-worker state
+    # of a stage that has finished
+    with _process_state_lock:
+        for key in list(_process_state):
+            if isinstance(key, tuple) and key[0] == name:
+                del _process_state[key]